@@ -1,5 +1,5 @@
 """
-$ python adlookup.py "full-length video filename" "ad video-clip folder"
+$ python adlookup.py "full-length video filename" ["more video filenames or globs" ...] "ad video-clip folder"
 
 Debe generar archivo <<detecciones.txt>>  con  todas  las  apariciones  de  los  comerciales
 encontradas  en  el  video  de  televisión
@@ -10,41 +10,240 @@ cada  aparición  en  una  línea siguiendo el siguiente formato:
     video_television \t segundos_inicio \t segundos_largo \t video_comercial .
 """
 
-import sys
+import argparse
+from glob import glob
+from multiprocessing import Pool
+from os.path import relpath
 
 
-from src import feature_extraction, video_tools
+from src import cache_manager, feature_extraction, video_tools
 from src.feature_extraction import FeatureType
-from src.video_tools import get_ad_lengths_in_frames
-from src.configurations import K
+from src.ann_index import load_or_build_index
+from src.coarse_to_fine import coarse_to_fine_ads_detector
+from src.fingerprint import load_or_build_fingerprints
+from src.frame_dedup import load_or_build_dedup
+from src.online_detector import online_ads_detector, temporal_nms
+from src.projection import load_or_build_projection
+from src.metrics import METRICS
+from src.video_tools import get_ad_lengths_in_frames, flatten_ads_features
+from src.configurations import K, USE_ANN_INDEX, USE_PROJECTION, DEDUP_ADS_FRAMES, ADAPTIVE_SAMPLING, DATA_FOLDER, \
+    APPEARANCES_OUTFILE
 
-if __name__ == '__main__':
-    if len(sys.argv) != 3:
-        raise AttributeError("Script receives 2 parameters: \"full-length video filename\" "
-                             "and \"ad video-clip folder\"")
-    print("Welcome to the advertising clip detector!")
-    video_filename = sys.argv[1]
-    video_name = video_filename.split('.')[0]
-    ads_foldername = sys.argv[2]
-    ft_type = FeatureType.SOBEL_THRESH_BINARY
+# ads are found by KNN over their frames, or by lookups of their shingles in a fingerprint.FingerprintIndex
+ENGINES = ("knn", "fingerprint")
+
+# ad library loaded once and shared by the worker processes of batch mode
+_worker_library = {}
+
+
+def find_ads(video_filename, ads_features, ad_video_names, ft_type, index=None, stream=False, workers=1,
+             coarse=False, deduped=None, fingerprints=None):
+    """
+    Detect the appearances of the ads of a library in a TV video
+    :param video_filename: TV video filename in DATA_FOLDER
+    :param ads_features: Features of the ad library, as returned by extract_features_from_video_folder
+    :param ad_video_names: Name of each ad
+    :param ft_type: Feature type of ads_features
+    :param index: Optional ANN index over ads_features
+    :param stream: Flag to process the video in chunks, in constant memory, reporting each airing once it ends
+    :param workers: Amount of processes extracting the features of the video and searching its KNN
+    :param coarse: Flag to sample densely only around the candidates found by a coarse pass
+    :param deduped: Optional frame_dedup.DedupedAds of the library, searched instead of every ad frame; index must
+        then be built over its searched_matrix
+    :param fingerprints: Optional fingerprint.FingerprintIndex of the library, looked up instead of searching the
+        KNN; ads_features isn't used then, and only single pass detection is available
+    :return: List of detections, as video_tools.ads_detector, one per airing (see online_detector.temporal_nms)
+    """
+    hamming = ft_type == FeatureType.SOBEL_THRESH_PACKED
+    if stream:
+        print("info: Streaming {} through feature extraction, KNN and ad detection".format(video_filename))
+        video_features_chunks = feature_extraction.iter_features_from_video(video_filename, ft_type=ft_type,
+                                                                            with_timestamps=True)
+
+        def report(event):
+            print("info: {} at {}s in {}".format(ad_video_names[event['ad_idx']], event['starting_second'],
+                                                 video_filename))
+        return online_ads_detector(video_features_chunks, ads_features, k=K, hamming=hamming, index=index,
+                                   on_event=report)
+
+    if fingerprints is not None:
+        print("info: Extracting (or loading cached) {} features".format(video_filename))
+        video_features, timestamps = feature_extraction.extract_features_from_video(
+            video_filename,
+            ft_type=ft_type,
+            workers=workers,
+            with_timestamps=True
+        )  # [frame, feature], [frame]
+        print("info: Looking up fingerprints")
+        return temporal_nms(fingerprints.detect(video_features, timestamps), fingerprints.ad_lengths)
+
+    ad_lengths_in_frames = get_ad_lengths_in_frames(ads_features)
+    if coarse:
+        return temporal_nms(coarse_to_fine_ads_detector(video_filename, ads_features, ad_video_names, ft_type, k=K,
+                                                        index=index, outfile=None, workers=workers),
+                            ad_lengths_in_frames)
 
     print("info: Extracting (or loading cached) {} features".format(video_filename))
-    video_features = feature_extraction.extract_features_from_video(
+    video_features, timestamps = feature_extraction.extract_features_from_video(
         video_filename,
-        ft_type=ft_type
-    )  # [frame, feature]
+        ft_type=ft_type,
+        workers=workers,
+        with_timestamps=True,
+        adaptive=ADAPTIVE_SAMPLING
+    )  # [frame, feature], [frame]
+    # samples kept by adaptive sampling stand for the ones skipped after them
+    positions = video_tools.sample_positions(timestamps) if ADAPTIVE_SAMPLING else None
+
+    if deduped is not None:
+        print("info: Starting KNN over {} representative ad frames".format(len(deduped.searched)))
+        with METRICS.timer("knn"):
+            representative_knn = deduped.search(video_features, K, hamming=hamming, index=index)
+        print("info: Detecting ads")
+        return temporal_nms(video_tools.detect_ads(deduped.hits(representative_knn), len(representative_knn),
+                                                   ad_lengths_in_frames, timestamps, positions), ad_lengths_in_frames)
+
+    print("info: Starting (or loading cached) KNN")
+    knn = video_tools.batch_knn(video_features, ads_features, k=K, hamming=hamming, index=index, workers=workers)
+    # ([video_frame, i_nearest_neighbor], [video_frame, i_nearest_neighbor])
+
+    print("info: Detecting ads")
+    return temporal_nms(video_tools.ads_detector(knn, video_filename, ad_lengths_in_frames, ad_video_names,
+                                                 outfile=None, timestamps=timestamps, sample_positions=positions),
+                        ad_lengths_in_frames)
+
+
+def load_library(ads_foldername, ft_type, workers=1, dedup=True, engine="knn"):
+    """
+    Load the features of an ad library, deduplicating them and building the search index set in the configuration,
+    or its fingerprint index
+    :param ads_foldername: Ad video-clip folder in DATA_FOLDER
+    :param ft_type: Feature type to be extracted
+    :param workers: Amount of processes extracting the features of different ads
+    :param dedup: Flag to deduplicate ad frames when DEDUP_ADS_FRAMES is set; only single pass detection supports it
+    :param engine: One of ENGINES
+    :return: Dict with the ads_features, ad_video_names, ft_type, index, deduped and fingerprints arguments of
+        find_ads
+    """
+    if engine == "fingerprint":
+        print("info: Building (or loading cached) fingerprint index")
+        fingerprints, ad_video_names = load_or_build_fingerprints(ads_foldername, ft_type, workers=workers)
+        return {'ads_features': None, 'ad_video_names': ad_video_names, 'ft_type': ft_type, 'index': None,
+                'deduped': None, 'fingerprints': fingerprints}
 
     print("info: Extracting (or loading cached) {} folder features".format(ads_foldername))
     ads_features, ad_video_names = feature_extraction.extract_features_from_video_folder(
         ads_foldername,
-        ft_type=ft_type
+        ft_type=ft_type,
+        workers=workers
     )  # [clip_no, frame, feature]
 
-    print("info: Starting (or loading cached) KNN")
-    knn_list = video_tools.batch_knn(video_features, ads_features, k=K)  # [video_frame, i_nearest_neighbor]
+    hamming = ft_type == FeatureType.SOBEL_THRESH_PACKED
+    deduped = None
+    searched_matrix = flatten_ads_features(ads_features)[0]
+    if DEDUP_ADS_FRAMES and not dedup:
+        print("warning: ad frame deduplication only applies to single pass detection, searching every ad frame")
+    elif DEDUP_ADS_FRAMES:
+        print("info: Deduplicating (or loading cached) ad frames")
+        deduped = load_or_build_dedup(ads_features, hamming=hamming)
+        searched_matrix = deduped.searched_matrix
 
-    print("info: Detecting ads")
-    # get ad lengths in frames
+    index = None
+    if USE_ANN_INDEX:
+        print("info: Building (or loading cached) ANN index")
+        index = load_or_build_index(searched_matrix, hamming=hamming)
+    elif USE_PROJECTION:
+        print("info: Fitting (or loading cached) projection")
+        index = load_or_build_projection(searched_matrix, hamming=hamming)
+    return {'ads_features': ads_features, 'ad_video_names': ad_video_names, 'ft_type': ft_type, 'index': index,
+            'deduped': deduped, 'fingerprints': None}
 
-    ad_lengths_in_frames = get_ad_lengths_in_frames(ads_features)
-    video_tools.ads_detector(knn_list, video_filename, ad_lengths_in_frames, ad_video_names)
+
+def expand_video_filenames(patterns):
+    """
+    Expand glob patterns relative to DATA_FOLDER into video filenames, keeping the order of the patterns and
+    skipping repeated videos. Filenames that match nothing are kept as given.
+    """
+    video_filenames = []
+    for pattern in patterns:
+        matches = sorted(relpath(path, str(DATA_FOLDER)) for path in glob(str(DATA_FOLDER / pattern)))
+        for video_filename in matches or [pattern]:
+            if video_filename not in video_filenames:
+                video_filenames.append(video_filename)
+    return video_filenames
+
+
+def _init_worker(ads_features, ad_video_names, ft_type, index, stream, coarse, deduped, fingerprints):
+    _worker_library.update(ads_features=ads_features, ad_video_names=ad_video_names, ft_type=ft_type, index=index,
+                           stream=stream, coarse=coarse, deduped=deduped, fingerprints=fingerprints)
+
+
+def _find_ads_in_worker(video_filename, options=None):
+    # send back only the metrics of this video, to be merged into the parent's
+    METRICS.reset()
+    detections = find_ads(video_filename, **dict(_worker_library, **(options or {})))
+    # pool workers exit without running atexit handlers
+    cache_manager.flush_accesses()
+    return detections, METRICS
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Find the appearances of the ad clips of a folder in TV videos.")
+    parser.add_argument("video_filenames", nargs="+",
+                        help="full-length video filenames, or glob patterns, relative to DATA_FOLDER")
+    parser.add_argument("ads_foldername", help="ad video-clip folder")
+    parser.add_argument("--stream", action="store_true",
+                        help="process the video in chunks, in constant memory (no feature or KNN cache), "
+                             "reporting each airing once it ends")
+    parser.add_argument("--coarse", action="store_true",
+                        help="find candidates at COARSE_SAMPLES_PER_SECOND and sample densely only around them")
+    parser.add_argument("--engine", choices=ENGINES, default="knn",
+                        help="find ads by KNN over their frames, or by lookups in an inverted index of their "
+                             "fingerprints (single pass only)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processes working at the same time: on different TV videos when several are given, "
+                             "otherwise extracting features from different ad clips or time ranges of the TV video, "
+                             "and searching the KNN of different time ranges and ads")
+    parser.add_argument("--outfile", default=APPEARANCES_OUTFILE, help="detections file to be written")
+    parser.add_argument("--metrics", help="JSON file where counters, stage timers and score statistics are written")
+    parser.add_argument("--progress", action="store_true", help="report decoding progress, with frames/s and ETA")
+    args = parser.parse_args()
+    if args.stream and args.coarse:
+        parser.error("--stream and --coarse can't be combined")
+    if args.engine == "fingerprint" and (args.stream or args.coarse):
+        parser.error("the fingerprint engine only runs single pass detection")
+    if ADAPTIVE_SAMPLING and (args.stream or args.coarse or args.engine == "fingerprint"):
+        print("warning: adaptive sampling only applies to single pass KNN detection, sampling at SAMPLES_PER_SECOND")
+    print("Welcome to the advertising clip detector!")
+    METRICS.show_progress = args.progress
+    video_filenames = expand_video_filenames(args.video_filenames)
+    ads_foldername = args.ads_foldername
+    ft_type = FeatureType.SOBEL_THRESH_PACKED
+
+    library = load_library(ads_foldername, ft_type, args.workers, dedup=not (args.stream or args.coarse),
+                           engine=args.engine)
+    ads_features, ad_video_names, index, deduped, fingerprints = (
+        library['ads_features'], library['ad_video_names'], library['index'], library['deduped'],
+        library['fingerprints'])
+
+    if len(video_filenames) > 1 and args.workers > 1:
+        print("info: Processing {} TV videos in {} workers".format(len(video_filenames), args.workers))
+        with Pool(min(args.workers, len(video_filenames)), initializer=_init_worker,
+                  initargs=(ads_features, ad_video_names, ft_type, index, args.stream, args.coarse,
+                            deduped, fingerprints)) as pool:
+            detections = []
+            for video_detections, worker_metrics in pool.map(_find_ads_in_worker, video_filenames):
+                detections.append(video_detections)
+                METRICS.merge(worker_metrics)
+    else:
+        detections = [find_ads(video_filename, ads_features, ad_video_names, ft_type, index, args.stream,
+                               args.workers, args.coarse, deduped, fingerprints)
+                      for video_filename in video_filenames]
+    video_tools.write_detections_of_videos(list(zip(video_filenames, detections)), ad_video_names, args.outfile)
+
+    for stage, timer in METRICS.timers.items():
+        print("info: {} took {:.2f}s".format(stage, timer['seconds']))
+    if "score" in METRICS.stats:
+        print("info: score mean {mean}, std {std}".format(**METRICS.stats["score"].report()))
+        print("info: passed score mean {mean}, std {std}".format(**METRICS.stats["passed_score"].report()))
+    if args.metrics:
+        METRICS.write_report(args.metrics)
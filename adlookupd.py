@@ -0,0 +1,247 @@
+"""
+$ python adlookupd.py "ad video-clip folder" [--socket PATH | --port PORT] [--workers N] [--engine ENGINE]
+
+Daemon version of adlookup.py: the ad library features and its search structures are loaded once and kept in memory,
+and TV videos are submitted as jobs over a local Unix socket (or a localhost TCP port). Jobs run concurrently on a
+pool of worker processes, and the library is reloaded when the files of the ad folder change.
+
+The protocol is one JSON object per line each way. A job is
+    {"video": "TV video filename in DATA_FOLDER", "stream": false, "coarse": false, "id": "optional, echoed back"}
+and its answer, once detected,
+    {"id": ..., "video": ..., "library": <library version>, "detections": [{"ad": ..., "start": <seconds>,
+     "length": <seconds>, "score": ...}, ...], "seconds": <seconds since submitted>, "timers": {<stage>: ...}}
+or {"id": ..., "error": "message"}. {"command": "status"} answers the library version, its ads, the jobs running
+and done, and the metrics of every job done so far.
+"""
+import argparse
+import asyncio
+import json
+import socket
+import time
+from concurrent.futures import ProcessPoolExecutor
+from os import listdir, stat, unlink
+from os.path import exists
+
+from adlookup import ENGINES, load_library, _init_worker, _find_ads_in_worker
+from src.configurations import DATA_FOLDER, SUPPORTED_EXTENSIONS, DEDUP_ADS_FRAMES, DAEMON_SOCKET, \
+    LIBRARY_POLL_SECONDS
+from src.feature_extraction import FeatureType
+from src.metrics import METRICS
+from src.video_tools import detection_seconds
+
+JOB_OPTIONS = ('stream', 'coarse')
+
+
+class DetectionDaemon:
+    """
+    Ad library in memory plus the pool of worker processes detecting its ads, swapped together on reload so each job
+    runs, and names its ads, with a single version of the library.
+    """
+
+    def __init__(self, ads_foldername, workers=1, poll_seconds=LIBRARY_POLL_SECONDS,
+                 ft_type=FeatureType.SOBEL_THRESH_PACKED, engine="knn"):
+        """
+        :param ads_foldername: Ad video-clip folder in DATA_FOLDER
+        :param workers: Amount of worker processes, i.e. of jobs detected at the same time
+        :param poll_seconds: Seconds between checks of the ad folder for changes
+        :param ft_type: Feature type of the library
+        :param engine: One of adlookup.ENGINES
+        """
+        self.ads_foldername = ads_foldername
+        self.workers = workers
+        self.poll_seconds = poll_seconds
+        self.ft_type = ft_type
+        self.engine = engine
+        self.version = 0
+        self.library = None
+        self.pool = None
+        self.signature = None
+        self.running = 0
+        self.done = 0
+
+    async def load(self):
+        """
+        Load (or reload) the library without blocking the jobs of the current one, and swap the worker pool
+        """
+        signature = folder_signature(self.ads_foldername)
+        library = await asyncio.get_running_loop().run_in_executor(None, load_library, self.ads_foldername,
+                                                                   self.ft_type, 1, True, self.engine)
+        pool = ProcessPoolExecutor(self.workers, initializer=_init_worker,
+                                   initargs=(library['ads_features'], library['ad_video_names'], self.ft_type,
+                                             library['index'], False, False, library['deduped'],
+                                             library['fingerprints']))
+        old_pool = self.pool
+        self.library, self.pool, self.signature = library, pool, signature
+        self.version += 1
+        print("info: ad library version {} loaded, {} ads".format(self.version, len(library['ad_video_names'])))
+        if old_pool is not None:
+            # jobs already submitted finish on the previous library
+            old_pool.shutdown(wait=False)
+
+    async def watch(self):
+        """
+        Reload the library when the files of the ad folder change, once they stay the same for a whole poll, so
+        clips still being copied aren't loaded
+        """
+        previous = self.signature
+        while True:
+            await asyncio.sleep(self.poll_seconds)
+            try:
+                signature = folder_signature(self.ads_foldername)
+                if signature != self.signature and signature == previous:
+                    print("info: ad folder {} changed, reloading".format(self.ads_foldername))
+                    await self.load()
+                previous = signature
+            except Exception as error:
+                # keep serving the loaded library
+                print("warning: ad library reload failed: {!r}".format(error))
+
+    async def detect(self, job):
+        """
+        Run a detection job on the worker pool
+        :param job: Dict with the video filename in DATA_FOLDER and the find_ads options in JOB_OPTIONS
+        :return: Answer of the job, see the module docstring
+        """
+        start = time.perf_counter()
+        answer = {'id': job.get('id'), 'video': job.get('video')}
+        options = {option: bool(job.get(option, False)) for option in JOB_OPTIONS}
+        unknown = set(job) - set(JOB_OPTIONS) - {'id', 'video'}
+        if unknown:
+            return dict(answer, error="unknown job keys: {}".format(", ".join(sorted(unknown))))
+        if not isinstance(job.get('video'), str) or not (DATA_FOLDER / job['video']).is_file():
+            return dict(answer, error="video not found in {}".format(DATA_FOLDER))
+        if options['stream'] and options['coarse']:
+            return dict(answer, error="stream and coarse can't be combined")
+        if self.engine == "fingerprint" and (options['stream'] or options['coarse']):
+            return dict(answer, error="the fingerprint engine only runs single pass detection")
+        if DEDUP_ADS_FRAMES and (options['stream'] or options['coarse']):
+            return dict(answer, error="the library is deduplicated, only single pass detection is available")
+
+        library, pool, version = self.library, self.pool, self.version
+        self.running += 1
+        try:
+            detections, job_metrics = await asyncio.get_running_loop().run_in_executor(
+                pool, _find_ads_in_worker, job['video'], options)
+        except Exception as error:
+            return dict(answer, error=repr(error))
+        finally:
+            self.running -= 1
+        self.done += 1
+        METRICS.merge(job_metrics)
+        answer_detections = []
+        for detection in detections:
+            detection_start, detection_length = detection_seconds(detection)
+            answer_detections.append({'ad': library['ad_video_names'][detection['ad_idx']], 'start': detection_start,
+                                      'length': detection_length, 'score': detection['score']})
+        return dict(answer, library=version, detections=answer_detections, seconds=time.perf_counter() - start,
+                    timers=job_metrics.timers)
+
+    def status(self):
+        return {'library': self.version, 'ads': list(self.library['ad_video_names']), 'running': self.running,
+                'done': self.done, 'metrics': METRICS.report()}
+
+    async def answer(self, line):
+        try:
+            request = json.loads(line)
+        except ValueError as error:
+            return {'error': "invalid JSON: {}".format(error)}
+        if not isinstance(request, dict):
+            return {'error': "requests are JSON objects"}
+        if request.get('command') == 'status':
+            return self.status()
+        return await self.detect(request)
+
+    async def handle_connection(self, reader, writer):
+        """
+        Answer every request of a connection, each as soon as it is done, so one client can submit several jobs
+        """
+        write_lock = asyncio.Lock()
+        tasks = []
+
+        async def answer_request(line):
+            answer = await self.answer(line)
+            async with write_lock:
+                writer.write((json.dumps(answer) + "\n").encode())
+                await writer.drain()
+
+        try:
+            async for line in reader:
+                if line.strip():
+                    tasks.append(asyncio.ensure_future(answer_request(line)))
+            await asyncio.gather(*tasks)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, socket_path=DAEMON_SOCKET, port=None):
+        """
+        Load the library and answer requests until cancelled
+        :param socket_path: Path of the Unix socket to listen on, if port is None
+        :param port: Localhost TCP port to listen on
+        """
+        await self.load()
+        if port is not None:
+            server = await asyncio.start_server(self.handle_connection, "127.0.0.1", port)
+            print("info: listening on 127.0.0.1:{}".format(port))
+        else:
+            if exists(socket_path):
+                unlink(socket_path)
+            server = await asyncio.start_unix_server(self.handle_connection, socket_path)
+            print("info: listening on {}".format(socket_path))
+        watcher = asyncio.ensure_future(self.watch())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            watcher.cancel()
+            self.pool.shutdown()
+            if port is None and exists(socket_path):
+                unlink(socket_path)
+
+
+def folder_signature(ads_foldername):
+    """
+    Name, size and modification time of each video of the ad folder, which change when clips are added, removed or
+    replaced
+    """
+    folder = DATA_FOLDER / ads_foldername
+    return tuple((filename, stat(str(folder / filename)).st_size, stat(str(folder / filename)).st_mtime_ns)
+                 for filename in sorted(listdir(str(folder))) if filename[-3:] in SUPPORTED_EXTENSIONS)
+
+
+def submit(job, socket_path=DAEMON_SOCKET, port=None):
+    """
+    Send a request to a running daemon and wait for its answer
+    :param job: Request, see the module docstring
+    :param socket_path: Unix socket of the daemon, if port is None
+    :param port: Localhost TCP port of the daemon
+    :return: Answer of the daemon, as a dict
+    """
+    if port is not None:
+        connection = socket.create_connection(("127.0.0.1", port))
+    else:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(socket_path)
+    with connection, connection.makefile('rwb') as stream:
+        stream.write((json.dumps(job) + "\n").encode())
+        stream.flush()
+        connection.shutdown(socket.SHUT_WR)
+        return json.loads(stream.readline())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Keep an ad library in memory and detect its ads in TV videos "
+                                                 "submitted over a local socket.")
+    parser.add_argument("ads_foldername", help="ad video-clip folder")
+    parser.add_argument("--socket", default=DAEMON_SOCKET, help="Unix socket to listen on")
+    parser.add_argument("--port", type=int, help="localhost TCP port to listen on, instead of a Unix socket")
+    parser.add_argument("--workers", type=int, default=1, help="TV videos processed at the same time")
+    parser.add_argument("--engine", choices=ENGINES, default="knn",
+                        help="find ads by KNN over their frames, or by lookups of their fingerprints")
+    args = parser.parse_args()
+    try:
+        asyncio.run(DetectionDaemon(args.ads_foldername, args.workers, engine=args.engine).serve(args.socket,
+                                                                                                 args.port))
+    except KeyboardInterrupt:
+        print("info: daemon stopped")
@@ -0,0 +1,230 @@
+"""
+$ python benchmark.py [--video-seconds 60 120] [--ads 2 4] [--k 1 5] [--output bench.json] [--compare baseline.json]
+
+Benchmark of every stage of the pipeline over synthetic videos generated locally.
+
+Ad clips and TV videos are synthesized with cv2.VideoWriter: each video is a sequence of random scenes (blocky
+images panning slowly), and the ads are spliced into the TV videos at known offsets. Feature extraction, batch_knn
+and ads_detector are timed separately across video length, ad library size and K, and since the ground truth is
+known the detection accuracy is reported next to the timings.
+
+Results are written as JSON. With --compare, results are checked against a saved baseline and regressions (stages
+slower than the tolerance, or lower accuracy) are reported; the exit status is 1 if there is any.
+"""
+import argparse
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import cv2
+import numpy
+
+from src import cache_manager, feature_extraction, video_tools
+from src.configurations import SAMPLES_PER_SECOND
+from src.feature_extraction import FeatureType
+
+FPS = 30
+FRAME_SIZE = (160, 120)
+SCENE_SECONDS = 2.5
+AD_SECONDS = (10, 20)
+AD_GAP_SECONDS = 20
+# slowdowns smaller than this are timer noise, whatever the tolerance
+MIN_REGRESSION_SECONDS = 0.005
+
+
+def synthetic_frames(seconds, seed):
+    """
+    Frames of a synthetic video made of random scenes; different seeds give different footage
+    :param seconds: Length of the video
+    :param seed: Seed of the scenes
+    :return: List of BGR frames
+    """
+    random = numpy.random.RandomState(seed)
+    frames = []
+    scene = None
+    for frame_idx in range(int(seconds * FPS)):
+        if frame_idx % int(SCENE_SECONDS * FPS) == 0:
+            scene = cv2.resize(random.randint(0, 256, (FRAME_SIZE[1] // 8, FRAME_SIZE[0] // 4, 3)).astype(numpy.uint8),
+                               (FRAME_SIZE[0] * 2, FRAME_SIZE[1]), interpolation=cv2.INTER_NEAREST)
+        pan = frame_idx % int(SCENE_SECONDS * FPS)
+        frames.append(numpy.ascontiguousarray(scene[:, pan:pan + FRAME_SIZE[0]]))
+    return frames
+
+
+def write_video(path, frames):
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*'mp4v'), FPS, FRAME_SIZE)
+    for frame in frames:
+        writer.write(frame)
+    writer.release()
+
+
+def generate_dataset(folder, video_seconds, ads):
+    """
+    Write the ad clips and one TV video per length, with every ad spliced once into each TV video
+    :param folder: Folder where videos are written; ads are written in its "ads" subfolder
+    :param video_seconds: Lengths of the TV videos
+    :param ads: Amount of ad clips
+    :return: Tuple (ad_filenames, ground_truth), ground_truth being a dict of TV video filename to a list of
+        (ad_idx, start_seconds, length_seconds)
+    """
+    (folder / "ads").mkdir()
+    ad_frames = []
+    for ad_idx in range(ads):
+        seconds = AD_SECONDS[0] + (AD_SECONDS[1] - AD_SECONDS[0]) * ad_idx / max(1, ads - 1)
+        ad_frames.append(synthetic_frames(seconds, seed=1000 + ad_idx))
+        write_video(folder / "ads" / "ad{:03d}.mp4".format(ad_idx), ad_frames[-1])
+
+    ground_truth = {}
+    for seconds in video_seconds:
+        filename = "tv_{}s.mp4".format(seconds)
+        frames = synthetic_frames(seconds, seed=seconds)
+        ground_truth[filename] = []
+        # splice ads after a gap of filler, until the video is full
+        position = AD_GAP_SECONDS * FPS
+        for ad_idx, clip in enumerate(ad_frames):
+            if position + len(clip) > len(frames):
+                break
+            frames[position:position + len(clip)] = clip
+            ground_truth[filename].append((ad_idx, 1.0 * position / FPS, 1.0 * len(clip) / FPS))
+            position += len(clip) + AD_GAP_SECONDS * FPS
+        write_video(folder / filename, frames)
+    return ["ad{:03d}.mp4".format(ad_idx) for ad_idx in range(ads)], ground_truth
+
+
+def detection_accuracy(detections, ground_truth):
+    """
+    Evaluate detections as evaluar.py does: a detection is correct if it overlaps an appearance of the same ad,
+    repeated if that appearance was already found, and false otherwise.
+    :param detections: Detections, as returned by ads_detector
+    :param ground_truth: List of (ad_idx, start_seconds, length_seconds)
+    :return: Dict with correct, repeated, false and missed counts, mean IoU and the final score of evaluar.py
+    """
+    found = {}
+    false = repeated = 0
+    for detection in detections:
+        start = video_tools.frame_idx_to_seconds(detection['starting_frame'])
+        end = start + video_tools.frame_idx_to_seconds(detection['ad_length_in_frames'])
+        best, best_iou = None, 0
+        for gt_idx, (ad_idx, gt_start, gt_length) in enumerate(ground_truth):
+            if ad_idx != detection['ad_idx']:
+                continue
+            intersection = min(end, gt_start + gt_length) - max(start, gt_start)
+            union = max(end, gt_start + gt_length) - min(start, gt_start)
+            if intersection > 0 and union > 0 and intersection / union > best_iou:
+                best, best_iou = gt_idx, intersection / union
+        if best is None:
+            false += 1
+        elif best in found:
+            repeated += 1
+        else:
+            found[best] = best_iou
+    correct = len(found)
+    return {'correct': correct, 'repeated': repeated, 'false': false, 'missed': len(ground_truth) - correct,
+            'iou': float(numpy.mean(list(found.values()))) if found else 0.0,
+            'score': 1.0 * max(0, correct - false) / len(ground_truth) if ground_truth else 1.0}
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def run(video_seconds, ads, ks, ft_type, repeat):
+    """
+    Benchmark every stage over every combination of video length, ad library size and K
+    :return: List of result dicts, one per stage and configuration
+    """
+    hamming = ft_type == FeatureType.SOBEL_THRESH_PACKED
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        folder = Path(folder)
+        # keep the user's cache untouched; every stage is timed without cache anyway
+        cache_manager.CACHE_FOLDER = folder / "cache"
+        (folder / "cache").mkdir()
+        print("info: generating synthetic videos in {}".format(folder))
+        ad_filenames, ground_truth = generate_dataset(folder, video_seconds, max(ads))
+        ads_features = [feature_extraction.extract_features_from_video(
+            filename, ft_type=ft_type, data_folder_path=folder / "ads", use_cache=False) for filename in ad_filenames]
+
+        for seconds in video_seconds:
+            filename = "tv_{}s.mp4".format(seconds)
+            video_features, extraction_seconds = min(
+                (timed(feature_extraction.extract_features_from_video, filename, ft_type=ft_type,
+                       data_folder_path=folder, use_cache=False) for _ in range(repeat)), key=lambda result: result[1])
+            results.append({'stage': 'extract_features_from_video', 'video_seconds': seconds, 'ads': None,
+                            'k': None, 'seconds': extraction_seconds})
+            for ads_amount in ads:
+                library = ads_features[:ads_amount]
+                ad_lengths = video_tools.get_ad_lengths_in_frames(library)
+                for k in ks:
+                    knn, knn_seconds = min((timed(video_tools.batch_knn, video_features, library, k=k,
+                                                  use_cache=False, hamming=hamming) for _ in range(repeat)),
+                                           key=lambda result: result[1])
+                    detections, detection_seconds = min(
+                        (timed(video_tools.ads_detector, knn, filename, ad_lengths, ad_filenames, outfile=None)
+                         for _ in range(repeat)), key=lambda result: result[1])
+                    configuration = {'video_seconds': seconds, 'ads': ads_amount, 'k': k}
+                    accuracy = detection_accuracy(
+                        detections, [gt for gt in ground_truth[filename] if gt[0] < ads_amount])
+                    results.append(dict(configuration, stage='batch_knn', seconds=knn_seconds))
+                    results.append(dict(configuration, stage='ads_detector', seconds=detection_seconds,
+                                        accuracy=accuracy))
+                    print("info: {}s video, {} ads, k={}: knn {:.3f}s, detector {:.3f}s, score {:.2f}".format(
+                        seconds, ads_amount, k, knn_seconds, detection_seconds, accuracy['score']))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Find regressions of results against a baseline run with the same configurations
+    :param tolerance: Allowed relative slowdown, e.g. 0.2 for 20%
+    :return: List of regression descriptions
+    """
+    def configuration(result):
+        return result['stage'], result['video_seconds'], result['ads'], result['k']
+
+    baseline_results = {configuration(result): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        previous = baseline_results.get(configuration(result))
+        if previous is None:
+            continue
+        if result['seconds'] > max(previous['seconds'] * (1 + tolerance),
+                                   previous['seconds'] + MIN_REGRESSION_SECONDS):
+            regressions.append("{} slower: {:.3f}s -> {:.3f}s".format(
+                configuration(result), previous['seconds'], result['seconds']))
+        if 'accuracy' in result and result['accuracy']['score'] < previous['accuracy']['score']:
+            regressions.append("{} less accurate: score {:.3f} -> {:.3f}".format(
+                configuration(result), previous['accuracy']['score'], result['accuracy']['score']))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages over synthetic videos.")
+    parser.add_argument("--video-seconds", type=int, nargs="+", default=[60, 120], help="TV video lengths")
+    parser.add_argument("--ads", type=int, nargs="+", default=[2, 4], help="ad library sizes")
+    parser.add_argument("--k", type=int, nargs="+", default=[1, 5], help="k values of the KNN")
+    parser.add_argument("--ft-type", default=FeatureType.SOBEL_THRESH_PACKED.name,
+                        choices=[ft_type.name for ft_type in FeatureType], help="feature type")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement; the fastest is kept")
+    parser.add_argument("--output", default="bench.json", help="JSON file where results are written")
+    parser.add_argument("--compare", help="baseline JSON file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown before flagging")
+    args = parser.parse_args()
+
+    results = run(args.video_seconds, args.ads, args.k, FeatureType[args.ft_type], args.repeat)
+    report = {'ft_type': args.ft_type, 'samples_per_second': SAMPLES_PER_SECOND, 'results': results}
+    with open(args.output, 'w') as fp:
+        json.dump(report, fp, indent=1)
+    print("info: results written to {}".format(args.output))
+
+    if args.compare:
+        with open(args.compare) as fp:
+            regressions = compare(results, json.load(fp), args.tolerance)
+        for regression in regressions:
+            print("regression: {}".format(regression))
+        print("info: {} regressions against {}".format(len(regressions), args.compare))
+        sys.exit(1 if regressions else 0)
@@ -1,4 +1,5 @@
 """
 Files are generated automatically.
-Remove files manually for cache cleansing.
-"""
\ No newline at end of file
+Entries are keyed by the content of their inputs and every extraction parameter, so stale entries are never
+served. Least recently used entries are evicted when the cache grows over CACHE_MAX_BYTES.
+"""
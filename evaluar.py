@@ -1,3 +1,5 @@
+import bisect
+import itertools
 import sys
 import os.path
 
@@ -36,19 +38,24 @@ class Deteccion:
 def leer_archivo_detecciones(filename):
     if not os.path.isfile(filename):
         raise Exception("no existe el archivo {}".format(filename))
+    with open(filename) as f:
+        return leer_lineas_detecciones(f, filename)
+
+
+# lineas en el formato de detecciones.txt, por ejemplo generadas en memoria
+def leer_lineas_detecciones(lineas, origen="memoria"):
     detecciones = []
     cont_lineas = 0
-    with open(filename) as f:
-        for linea in f:
-            cont_lineas += 1
-            try:
-                linea = linea.rstrip("\r\n")
-                if linea == "" or linea.startswith("#"):
-                    continue
-                det = Deteccion(cont_lineas, linea)
-                detecciones.append(det)
-            except Exception as ex:
-                print("Error {} (linea {}): {}".format(filename, cont_lineas, ex))
+    for linea in lineas:
+        cont_lineas += 1
+        try:
+            linea = linea.rstrip("\r\n")
+            if linea == "" or linea.startswith("#"):
+                continue
+            det = Deteccion(cont_lineas, linea)
+            detecciones.append(det)
+        except Exception as ex:
+            print("Error {} (linea {}): {}".format(origen, cont_lineas, ex))
     return detecciones
 
 
@@ -56,6 +63,11 @@ def filtrar_gt(detecciones, lista_gt):
     videos_tv = set()
     for det in detecciones:
         videos_tv.add(det.television)
+    return filtrar_gt_videos(videos_tv, lista_gt)
+
+
+# ground-truth de los videos de television indicados, aunque no tengan detecciones
+def filtrar_gt_videos(videos_tv, lista_gt):
     lista = []
     for gt in lista_gt:
         if gt.television in videos_tv:
@@ -75,12 +87,39 @@ def interseccion(deteccion1, deteccion2):
     return inter / union
 
 
-def buscar_gt(det, lista_gt):
+class IndiceGT:
+    # ground-truth agrupado por television y comercial, y ordenado por inicio, para buscar los que intersectan
+    # una deteccion con busqueda binaria en vez de recorrerlo entero
+    def __init__(self, lista_gt):
+        grupos = {}
+        for det_gt in lista_gt:
+            grupos.setdefault((det_gt.television, det_gt.comercial), []).append(det_gt)
+        self.grupos = {}
+        for llave, grupo in grupos.items():
+            grupo.sort(key=lambda det_gt: det_gt.desde)
+            inicios = [det_gt.desde for det_gt in grupo]
+            # fin maximo de cada prefijo: antes de i ninguno termina despues de fines[i]
+            fines = list(itertools.accumulate((det_gt.desde + det_gt.largo for det_gt in grupo), max))
+            self.grupos[llave] = (grupo, inicios, fines)
+
+    def intersectan(self, det):
+        if (det.television, det.comercial) not in self.grupos:
+            return []
+        grupo, inicios, fines = self.grupos[(det.television, det.comercial)]
+        # los que empiezan despues del fin de la deteccion no la intersectan
+        i = bisect.bisect_left(inicios, det.desde + det.largo)
+        encontrados = []
+        while i > 0 and fines[i - 1] > det.desde:
+            i -= 1
+            encontrados.append(grupo[i])
+        # en el orden del archivo, como el recorrido lineal
+        return sorted(encontrados, key=lambda det_gt: det_gt.num_linea)
+
+
+def buscar_gt(det, indice_gt):
     gt_found = None
     best_inter = 0
-    for det_gt in lista_gt:
-        if det.television != det_gt.television or det.comercial != det_gt.comercial:
-            continue
+    for det_gt in indice_gt.intersectan(det):
         inter = interseccion(det, det_gt)
         if inter > best_inter:
             gt_found = det_gt
@@ -100,8 +139,9 @@ def evaluar_detecciones(detecciones, detecciones_gt):
     repetidas = []
     incorrectas = []
     correctas_ids = set()
+    indice_gt = IndiceGT(detecciones_gt)
     for det in detecciones:
-        gt_found, inter = buscar_gt(det, detecciones_gt)
+        gt_found, inter = buscar_gt(det, indice_gt)
         if gt_found is None:
             incorrectas.append(det)
         elif gt_found.num_linea in correctas_ids:
@@ -112,52 +152,74 @@ def evaluar_detecciones(detecciones, detecciones_gt):
     return correctas, repetidas, incorrectas
 
 
-if len(sys.argv) < 2:
-    print("CC5213 - Evaluacion Tarea 1 (version 1)")
-    print("Uso: {} [archivo_detecciones.txt]".format(sys.argv[0]))
-    sys.exit(1)
-
-filename = sys.argv[1]
-
-detecciones = leer_archivo_detecciones(filename)
-
-print("{} detecciones en archivo {}".format(len(detecciones), filename))
-
-# cargar el ground-truth
-detecciones_gt = leer_archivo_detecciones("gt.txt")
-
-# seleccionar del ground-truth solo las detecciones que los videos de television
-relevantes_gt = filtrar_gt(detecciones, detecciones_gt)
-
-# evaluar, retorna las detecciones separadas por su resultado
-correctas, repetidas, incorrectas = evaluar_detecciones(detecciones, relevantes_gt)
-
-# imprimir las correctas
-if len(correctas) > 0:
-    print("CORRECTAS={}".format(len(correctas)))
-    for cor in correctas:
-        print("    #{}: {}    //Real: {} {} (IoU={}%)".format(cor.det.num_linea, cor.det.linea, cor.gt.desde,
-                                                              cor.gt.largo, round(100 * cor.inter, 1)))
-# imprimir las repetidas
-if len(repetidas) > 0:
-    print("REPETIDAS={}".format(len(repetidas)))
-    for det in repetidas:
-        print("    #{}: {}".format(det.num_linea, det.linea))
-# imprimir las incorrectas
-if len(incorrectas) > 0:
-    print("INCORRECTAS={}".format(len(incorrectas)))
-    for det in incorrectas:
-        print("    #{}: {}".format(det.num_linea, det.linea))
-# resumen
-print("Evaluacion:")
-print("  Comerciales detectados correctamente: {}".format(len(correctas)))
-if len(correctas) > 0:
-    suma = 0
-    for cor in correctas:
-        suma += cor.inter
-    pct_inter = suma / len(correctas)
-    print("  Exactitud de las detecciones (promedio IoU): {}%".format(round(100 * pct_inter, 1)))
-print("  Detecciones falsas: {}".format(len(incorrectas)))
-real = max(0, len(correctas) - len(incorrectas))
-print("  Resultado final (correctas menos falsas): {}% ({} de {})".format(
-    round(100 * real / float(len(relevantes_gt)), 1), real, len(relevantes_gt)))
+def resumen(correctas, incorrectas, relevantes_gt):
+    real = max(0, len(correctas) - len(incorrectas))
+    return {'correctas': len(correctas),
+            'iou': sum(cor.inter for cor in correctas) / len(correctas) if correctas else 0,
+            'falsas': len(incorrectas),
+            'real': real,
+            'resultado': real / float(len(relevantes_gt)) if relevantes_gt else 0,
+            'relevantes': len(relevantes_gt)}
+
+
+# evalua en memoria, sin imprimir; con videos_tv el ground-truth es el de esos videos, y no solo el de los videos
+# con detecciones
+def evaluar(detecciones, detecciones_gt, videos_tv=None):
+    if videos_tv is None:
+        relevantes_gt = filtrar_gt(detecciones, detecciones_gt)
+    else:
+        relevantes_gt = filtrar_gt_videos(videos_tv, detecciones_gt)
+    correctas, repetidas, incorrectas = evaluar_detecciones(detecciones, relevantes_gt)
+    return dict(resumen(correctas, incorrectas, relevantes_gt), repetidas=len(repetidas))
+
+
+def main(argv):
+    if len(argv) < 2:
+        print("CC5213 - Evaluacion Tarea 1 (version 1)")
+        print("Uso: {} [archivo_detecciones.txt]".format(argv[0]))
+        sys.exit(1)
+
+    filename = argv[1]
+
+    detecciones = leer_archivo_detecciones(filename)
+
+    print("{} detecciones en archivo {}".format(len(detecciones), filename))
+
+    # cargar el ground-truth
+    detecciones_gt = leer_archivo_detecciones("gt.txt")
+
+    # seleccionar del ground-truth solo las detecciones que los videos de television
+    relevantes_gt = filtrar_gt(detecciones, detecciones_gt)
+
+    # evaluar, retorna las detecciones separadas por su resultado
+    correctas, repetidas, incorrectas = evaluar_detecciones(detecciones, relevantes_gt)
+
+    # imprimir las correctas
+    if len(correctas) > 0:
+        print("CORRECTAS={}".format(len(correctas)))
+        for cor in correctas:
+            print("    #{}: {}    //Real: {} {} (IoU={}%)".format(cor.det.num_linea, cor.det.linea, cor.gt.desde,
+                                                                  cor.gt.largo, round(100 * cor.inter, 1)))
+    # imprimir las repetidas
+    if len(repetidas) > 0:
+        print("REPETIDAS={}".format(len(repetidas)))
+        for det in repetidas:
+            print("    #{}: {}".format(det.num_linea, det.linea))
+    # imprimir las incorrectas
+    if len(incorrectas) > 0:
+        print("INCORRECTAS={}".format(len(incorrectas)))
+        for det in incorrectas:
+            print("    #{}: {}".format(det.num_linea, det.linea))
+    # resumen
+    print("Evaluacion:")
+    res = resumen(correctas, incorrectas, relevantes_gt)
+    print("  Comerciales detectados correctamente: {}".format(res['correctas']))
+    if len(correctas) > 0:
+        print("  Exactitud de las detecciones (promedio IoU): {}%".format(round(100 * res['iou'], 1)))
+    print("  Detecciones falsas: {}".format(res['falsas']))
+    print("  Resultado final (correctas menos falsas): {}% ({} de {})".format(
+        round(100 * res['resultado'], 1), res['real'], res['relevantes']))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,85 @@
+"""
+Consolidated feature store of an ad library: the frames of every ad in one contiguous matrix, plus tables of the
+offset, length, name and feature cache key of each ad. The matrix is opened memory-mapped, so loading a library is
+near-instant and processes scanning different broadcasts share the same physical pages.
+"""
+import numpy
+
+from src import cache_manager
+
+
+class AdLibrary:
+    """
+    Features of each frame, of each ad. Behaves as the sequence [ad_no, sampled_frames, features] of per-ad
+    features (each item is a view of the consolidated matrix), so it can be passed wherever ads_features is taken.
+    """
+
+    def __init__(self, matrix, offsets, lengths, names, ad_keys, key):
+        self.matrix = matrix
+        self.offsets = offsets
+        self.lengths = lengths
+        self.names = names
+        self.ad_keys = ad_keys
+        self.key = key
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, ad_idx):
+        return self.matrix[self.offsets[ad_idx]:self.offsets[ad_idx] + self.lengths[ad_idx]]
+
+    def __iter__(self):
+        return (self[ad_idx] for ad_idx in range(len(self)))
+
+    def flattened(self):
+        """
+        Same as video_tools.flatten_ads_features, without copying the frame matrix
+        :return: Tuple (ads_matrix, row_ad_idx, row_frame_idx)
+        """
+        row_ad_idx = numpy.repeat(numpy.arange(len(self)), self.lengths)
+        row_frame_idx = numpy.arange(self.matrix.shape[0]) - numpy.repeat(self.offsets, self.lengths)
+        return self.matrix, row_ad_idx, row_frame_idx
+
+    @staticmethod
+    def library_key(ad_keys, names):
+        return cache_manager.cache_key("library", *(list(ad_keys) + list(names)))
+
+    @classmethod
+    def load(cls, ad_keys, names):
+        """
+        Open a cached library
+        :param ad_keys: Feature cache key of each ad, see feature_extraction.features_cache_key
+        :param names: Name of each ad
+        :return: AdLibrary, or None if it isn't cached
+        """
+        key = cls.library_key(ad_keys, names)
+        tables = cache_manager.load_arrays("library", key + "_tables")
+        matrix = cache_manager.load("library", key, mmap_mode='r')
+        if tables is None or matrix is None:
+            return None
+        return cls(matrix, tables['offsets'], tables['lengths'], [str(name) for name in tables['names']],
+                   [str(ad_key) for ad_key in tables['ad_keys']], key)
+
+    @classmethod
+    def build(cls, ads_features, ad_keys, names):
+        """
+        Consolidate the features of each ad into a cached library, and open it
+        :param ads_features: Features of each frame, of each ad (shape: [ad_no, sampled_frames, features])
+        :param ad_keys: Feature cache key of each ad, see feature_extraction.features_cache_key
+        :param names: Name of each ad
+        :return: AdLibrary
+        """
+        key = cls.library_key(ad_keys, names)
+        lengths = numpy.array([len(ad_features) for ad_features in ads_features], dtype=numpy.int64)
+        offsets = numpy.concatenate(([0], numpy.cumsum(lengths)[:-1])).astype(numpy.int64)
+        ads = [numpy.asarray(ad_features) for ad_features in ads_features]
+        matrix = numpy.concatenate([ad.reshape(ad.shape[0], -1) for ad in ads if ad.size] or [numpy.zeros((0, 0))])
+        with cache_manager.batch_writes():
+            cache_manager.save("library", key, matrix)
+            cache_manager.save_arrays("library", key + "_tables", offsets=offsets, lengths=lengths,
+                                      names=numpy.array(names, dtype=str), ad_keys=numpy.array(ad_keys, dtype=str))
+        library = cls.load(ad_keys, names)
+        if library is None:
+            # cache unavailable; keep the library in memory
+            library = cls(matrix, offsets, lengths, list(names), list(ad_keys), key)
+        return library
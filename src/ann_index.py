@@ -0,0 +1,224 @@
+"""
+Approximate nearest neighbor index over every ad frame of the library.
+
+The index is an inverted file (IVF): ad frames are clustered with k-means and each query frame is compared
+exactly only against the frames of the nprobe clusters nearest to it. It is built once per ad library and
+persisted in the "knn" cache, so later runs over new broadcasts only pay for the queries.
+
+Usage (recall vs brute force report):
+$ python -m src.ann_index "full-length video filename" "ad video-clip folder"
+"""
+import sys
+import time
+
+import numpy
+
+from src import cache_manager
+from src.metrics import METRICS
+from src.configurations import K, KNN_BLOCK_SIZE, ANN_NLIST, ANN_NPROBE
+from src.video_tools import knn_search, hamming_knn_search
+
+KMEANS_ITERATIONS = 20
+KMEANS_MAX_TRAINING_ROWS = 20000
+
+
+class IVFIndex:
+    """
+    Inverted file index: k-means centroids plus, for each centroid, the ads_matrix rows assigned to it.
+    Candidates are re-ranked with exact distances (Hamming for bit-packed features, euclidean otherwise), so
+    probing every list returns exactly the brute force result.
+    """
+
+    def __init__(self, ads_matrix, centroids, list_offsets, list_rows, hamming):
+        self.ads_matrix = ads_matrix
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_rows = list_rows
+        self.hamming = hamming
+
+    @property
+    def nlist(self):
+        return self.centroids.shape[0]
+
+    @classmethod
+    def build(cls, ads_matrix, hamming=False, nlist=ANN_NLIST, seed=0):
+        """
+        Cluster the ad frames and build the inverted lists
+        :param ads_matrix: Features of every ad frame (shape: [total_ad_frames, features])
+        :param hamming: Flag indicating ads_matrix holds bit-packed features
+        :param nlist: Amount of clusters; by default 4 * sqrt(total_ad_frames)
+        :param seed: Seed of the k-means initialization
+        :return: IVFIndex
+        """
+        ads_matrix = numpy.asarray(ads_matrix)
+        if nlist is None:
+            nlist = int(4 * numpy.sqrt(ads_matrix.shape[0]))
+        nlist = max(1, min(nlist, ads_matrix.shape[0]))
+        vectors = _as_vectors(ads_matrix, hamming)
+        random = numpy.random.RandomState(seed)
+
+        training = vectors
+        if training.shape[0] > KMEANS_MAX_TRAINING_ROWS:
+            training = training[random.choice(training.shape[0], KMEANS_MAX_TRAINING_ROWS, replace=False)]
+        centroids = training[random.choice(training.shape[0], nlist, replace=False)].copy()
+        for _ in range(KMEANS_ITERATIONS):
+            assignment = knn_search(training, centroids, k=1)[0][:, 0]
+            counts = numpy.bincount(assignment, minlength=nlist)
+            sums = numpy.zeros_like(centroids)
+            numpy.add.at(sums, assignment, training)
+            empty = counts == 0
+            centroids[~empty] = sums[~empty] / counts[~empty, None]
+            # re-seed empty clusters with random training rows
+            centroids[empty] = training[random.choice(training.shape[0], empty.sum())]
+
+        assignment = knn_search(vectors, centroids, k=1)[0][:, 0]
+        list_rows = numpy.argsort(assignment, kind='stable')
+        list_offsets = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(assignment, minlength=nlist))))
+        print("info: ann index built with {} lists over {} ad frames".format(nlist, ads_matrix.shape[0]))
+        return cls(ads_matrix, centroids, list_offsets, list_rows, hamming)
+
+    def cache_tag(self, nprobe=ANN_NPROBE):
+        """
+        Part of the cache key of KNN results searched with this index
+        """
+        return "ivf{}p{}".format(self.nlist, nprobe)
+
+    def search(self, video_features, k=K, nprobe=ANN_NPROBE, block_size=KNN_BLOCK_SIZE):
+        """
+        Approximate KNN of each video frame against the indexed ad frames.
+        Each frame is compared against the frames of its nprobe nearest lists (more if those hold less than k).
+        Frames are grouped by the lists they probe, so each list is searched once for all of its frames, and the
+        neighbors found in each list are merged into a running top k.
+        :param video_features: Features of each frame of the video (shape: [sampled_frames, features])
+        :param k: k of the KNN
+        :param nprobe: Amount of lists probed per frame; higher is slower and more accurate
+        :param block_size: Number of video frames assigned to lists, or searched in a list, at once
+        :return: Tuple (columns, distances) with shape [video_frame, i_nearest_neighbor], as knn_search
+        """
+        k = min(k, self.ads_matrix.shape[0])
+        video_features = numpy.asarray(video_features)
+        video_features = video_features.reshape(video_features.shape[0], -1)
+        search = hamming_knn_search if self.hamming else knn_search
+        list_sizes = numpy.diff(self.list_offsets)
+
+        probing_frames, probed_lists = [], []
+        for block_start in range(0, video_features.shape[0], block_size):
+            block = video_features[block_start:block_start + block_size]
+            probe_order = knn_search(_as_vectors(block, self.hamming), self.centroids, k=self.nlist)[0]
+            probed = numpy.maximum(nprobe, (numpy.cumsum(list_sizes[probe_order], axis=1) < k).sum(axis=1) + 1)
+            probing = numpy.arange(self.nlist) < probed[:, None]
+            probing_frames.append(numpy.nonzero(probing)[0] + block_start)
+            probed_lists.append(probe_order[probing])
+        probing_frames = numpy.concatenate(probing_frames) if probing_frames else numpy.empty(0, dtype=numpy.int64)
+        probed_lists = numpy.concatenate(probed_lists) if probed_lists else numpy.empty(0, dtype=numpy.int64)
+        order = numpy.argsort(probed_lists, kind='stable')
+        probing_frames = probing_frames[order]
+        list_bounds = numpy.searchsorted(probed_lists[order], numpy.arange(self.nlist + 1))
+
+        # neighbors sorted by distance and then by column, as brute force sorts them
+        columns = numpy.full((video_features.shape[0], k), -1, dtype=numpy.int64)
+        distances = numpy.full((video_features.shape[0], k), numpy.inf)
+        for l in range(self.nlist):
+            frames = probing_frames[list_bounds[l]:list_bounds[l + 1]]
+            rows = self.list_rows[self.list_offsets[l]:self.list_offsets[l + 1]]
+            if len(frames) == 0 or len(rows) == 0:
+                continue
+            list_columns, list_distances = search(video_features[frames], self.ads_matrix[rows], k, block_size)
+            merged_columns = numpy.concatenate((columns[frames], rows[list_columns]), axis=1)
+            merged_distances = numpy.concatenate((distances[frames], list_distances), axis=1)
+            merged_order = numpy.lexsort((merged_columns, merged_distances), axis=1)[:, :k]
+            columns[frames] = numpy.take_along_axis(merged_columns, merged_order, axis=1)
+            distances[frames] = numpy.take_along_axis(merged_distances, merged_order, axis=1)
+        return columns, distances.astype(numpy.uint32 if self.hamming else numpy.float64)
+
+    def to_arrays(self):
+        """
+        Arrays needed to rebuild the index with from_arrays, other than the ad frame matrix
+        """
+        return {'centroids': self.centroids, 'list_offsets': self.list_offsets, 'list_rows': self.list_rows,
+                'hamming': numpy.asarray(self.hamming)}
+
+    @classmethod
+    def from_arrays(cls, arrays, ads_matrix):
+        return cls(ads_matrix, arrays['centroids'], arrays['list_offsets'], arrays['list_rows'],
+                   bool(arrays['hamming']))
+
+
+def load_or_build_index(ads_matrix, hamming=False, nlist=ANN_NLIST, use_cache=True):
+    """
+    Load the index of an ad library from cache, building and caching it if it isn't available.
+    The cache is keyed by the content of the ad frame matrix, so it is rebuilt whenever the library changes.
+    :param ads_matrix: Features of every ad frame (shape: [total_ad_frames, features]), see flatten_ads_features
+    :param hamming: Flag indicating ads_matrix holds bit-packed features
+    :param nlist: Amount of clusters of the index
+    :param use_cache: Flag to use cached version if available
+    :return: IVFIndex
+    """
+    cache_key = cache_manager.cache_key(cache_manager.array_digest(ads_matrix), hamming, nlist)
+    if use_cache:
+        stored = cache_manager.load_arrays("knn", cache_key)
+        if stored is not None:
+            print("info: loading ann index from cache")
+            return IVFIndex.from_arrays(stored, ads_matrix)
+
+    with METRICS.timer("ann_index_build"):
+        index = IVFIndex.build(ads_matrix, hamming, nlist)
+    cache_manager.save_arrays("knn", cache_key, **index.to_arrays())
+    return index
+
+
+def recall_report(index, video_features, k=K, nprobes=(1, 2, 4, 8, 16, 32)):
+    """
+    Compare the index against brute force search for several nprobe settings, and print the results.
+    :param index: IVFIndex to be evaluated
+    :param video_features: Features of the query frames (shape: [sampled_frames, features])
+    :param k: k of the KNN
+    :param nprobes: nprobe settings to be evaluated
+    :return: List of dicts with nprobe, recall (fraction of the exact top k found), seconds and speedup, the first
+        one (nprobe None) being brute force search
+    """
+    search = hamming_knn_search if index.hamming else knn_search
+    start = time.time()
+    exact_columns, _ = search(video_features, index.ads_matrix, k)
+    brute_force_seconds = time.time() - start
+
+    report = [{'nprobe': None, 'recall': 1.0, 'seconds': brute_force_seconds, 'speedup': 1.0}]
+    print("nprobe\trecall@{}\tseconds\tspeedup".format(k))
+    print("brute\t1.0000\t{:.3f}\t1.00".format(brute_force_seconds))
+    for nprobe in nprobes:
+        if nprobe > index.nlist:
+            break
+        start = time.time()
+        columns, _ = index.search(video_features, k, nprobe)
+        seconds = time.time() - start
+        found = sum(numpy.intersect1d(row, exact_row).size for row, exact_row in zip(columns, exact_columns))
+        recall = 1.0 * found / exact_columns.size
+        report.append({'nprobe': nprobe, 'recall': recall, 'seconds': seconds,
+                       'speedup': brute_force_seconds / seconds if seconds else float('inf')})
+        print("{}\t{:.4f}\t{:.3f}\t{:.2f}".format(nprobe, recall, seconds, report[-1]['speedup']))
+    return report
+
+
+def _as_vectors(features, hamming):
+    """
+    Features as float vectors for clustering; bit-packed features are unpacked to one 0/1 value per bit.
+    """
+    features = numpy.asarray(features)
+    if hamming:
+        return numpy.unpackbits(features.reshape(features.shape[0], -1), axis=1).astype(numpy.float32)
+    return features.reshape(features.shape[0], -1).astype(numpy.float32)
+
+
+if __name__ == '__main__':
+    from src import feature_extraction
+    from src.feature_extraction import FeatureType
+    from src.video_tools import flatten_ads_features
+
+    if len(sys.argv) != 3:
+        raise AttributeError("Script receives 2 parameters: \"full-length video filename\" "
+                             "and \"ad video-clip folder\"")
+    ft_type = FeatureType.SOBEL_THRESH_PACKED
+    video_features = feature_extraction.extract_features_from_video(sys.argv[1], ft_type=ft_type)
+    ads_features, _ = feature_extraction.extract_features_from_video_folder(sys.argv[2], ft_type=ft_type)
+    ads_matrix, _, _ = flatten_ads_features(ads_features)
+    recall_report(load_or_build_index(ads_matrix, hamming=True), video_features)
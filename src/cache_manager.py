@@ -0,0 +1,279 @@
+"""
+Content-addressed cache shared by feature extraction, KNN and the ANN index.
+
+Entries live in CACHE_FOLDER / namespace / key, where the key is a digest of everything the cached result depends
+on: the content of the input files or arrays and every parameter of the computation. A manifest keeps the size and
+last access time of each entry; when the cache grows over CACHE_MAX_BYTES the least recently used entries are
+evicted, once per write or once per batch_writes block, which never evicts the entries written inside it. Writes go
+through a temporary file and a rename, so concurrent processes never read partial entries.
+Access times of cache hits are kept in memory and written to the manifest with its next update, or at exit.
+"""
+import atexit
+import json
+import time
+from contextlib import contextmanager
+from hashlib import sha256
+from os import getpid, makedirs, replace, remove, stat
+from os.path import dirname, exists, getsize
+
+import numpy
+
+from src.configurations import CACHE_FOLDER, CACHE_MAX_BYTES
+from src.metrics import METRICS
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows; manifest updates aren't serialized between processes there
+    fcntl = None
+
+MANIFEST_FILENAME = "manifest.json"
+DIGEST_CHUNK_BYTES = 1 << 20
+
+# last access time of the entries loaded since the manifest was last written, by relative path
+_pending_accesses = {}
+# relative paths of the entries written inside the open batch_writes block, None outside of one
+_batch = None
+
+
+def file_fingerprint(path):
+    """
+    Fast fingerprint of a file: its size, modification time and a digest of its first, middle and last MiB.
+    :param path: Path of the file
+    :return: Fingerprint string, which changes whenever the file is replaced or modified
+    """
+    file_stat = stat(str(path))
+    digest = sha256()
+    with open(str(path), 'rb') as fp:
+        for offset in (0, file_stat.st_size // 2, file_stat.st_size - DIGEST_CHUNK_BYTES):
+            fp.seek(max(0, offset))
+            digest.update(fp.read(DIGEST_CHUNK_BYTES))
+    return "{}-{}-{}".format(file_stat.st_size, file_stat.st_mtime_ns, digest.hexdigest())
+
+
+def array_digest(array):
+    """
+    Digest of the content of an array, or of a sequence of arrays (e.g. the features of each ad).
+    :param array: Numpy array, or list/object array of arrays
+    :return: Hex digest
+    """
+    digest = sha256()
+    arrays = array if isinstance(array, (list, tuple)) or numpy.asarray(array).dtype == object else [array]
+    for element in arrays:
+        element = numpy.ascontiguousarray(element)
+        digest.update("{}{}".format(element.dtype.str, element.shape).encode())
+        digest.update(element.tobytes())
+    return digest.hexdigest()
+
+
+def cache_key(*parts):
+    """
+    Key of a cache entry from the fingerprints, digests and parameters it depends on.
+    :param parts: Values whose str() identifies the entry
+    :return: Hex digest
+    """
+    return sha256("\0".join(str(part) for part in parts).encode()).hexdigest()
+
+
+def load(namespace, key, mmap_mode=None):
+    """
+    Load a cached array
+    :param namespace: Cache subfolder, e.g. "features" or "knn"
+    :param key: Key of the entry, see cache_key
+    :param mmap_mode: Memory-map mode of numpy.load, e.g. 'r' to share the pages of large read-only arrays
+    :return: The cached array, or None if it isn't cached
+    """
+    path = _entry_path(namespace, key, ".npy")
+    try:
+        array = numpy.load(path, mmap_mode=mmap_mode)
+    except (FileNotFoundError, ValueError):
+        METRICS.count("cache_misses")
+        return None
+    METRICS.count("cache_hits")
+    _touch(path)
+    return array
+
+
+def load_arrays(namespace, key):
+    """
+    Load several arrays cached together with save_arrays
+    :return: Dict of the cached arrays by name, or None if they aren't cached
+    """
+    path = _entry_path(namespace, key, ".npz")
+    try:
+        with numpy.load(path) as stored:
+            arrays = {name: stored[name] for name in stored.files}
+    except (FileNotFoundError, ValueError):
+        METRICS.count("cache_misses")
+        return None
+    METRICS.count("cache_hits")
+    _touch(path)
+    return arrays
+
+
+def save(namespace, key, array):
+    """
+    Cache an array. Errors are reported as warnings, since the cache is only an optimization.
+    :param namespace: Cache subfolder, e.g. "features" or "knn"
+    :param key: Key of the entry, see cache_key
+    :param array: Array to be cached
+    :return: None
+    """
+    _save(_entry_path(namespace, key, ".npy"), lambda fp: numpy.save(fp, array))
+
+
+def save_arrays(namespace, key, **arrays):
+    """
+    Cache several arrays together as one entry
+    """
+    _save(_entry_path(namespace, key, ".npz"), lambda fp: numpy.savez(fp, **arrays))
+
+
+def save_atomically(path, write):
+    """
+    Write a file through a temporary file and a rename, so concurrent readers and writers of the same path never
+    see a partially written file.
+    :param path: Path of the file
+    :param write: Function writing the content to the binary file object it receives
+    :return: None
+    """
+    temporary_path = "{}.{}.tmp".format(path, getpid())
+    try:
+        with open(temporary_path, 'wb') as fp:
+            write(fp)
+        replace(temporary_path, path)
+    except BaseException:
+        if exists(temporary_path):
+            remove(temporary_path)
+        raise
+
+
+def evict(max_bytes=CACHE_MAX_BYTES, keep=()):
+    """
+    Remove the least recently used entries until the cache fits in max_bytes.
+    :param max_bytes: Byte budget of the cache
+    :param keep: Relative paths of entries that mustn't be evicted
+    :return: Amount of bytes freed
+    """
+    with _manifest() as manifest:
+        return _evict(manifest, max_bytes, keep)
+
+
+@contextmanager
+def batch_writes():
+    """
+    Context manager deferring the eviction of the entries saved inside it to a single pass when it exits, which
+    keeps all of them: entries read together (e.g. the matrix of an ad library and its tables) can't be evicted
+    while the rest are written. Nested blocks belong to the outermost one.
+    """
+    global _batch
+    if _batch is not None:
+        yield
+        return
+    _batch = []
+    try:
+        yield
+    finally:
+        written, _batch = _batch, None
+        if written:
+            evict(CACHE_MAX_BYTES, keep=written)
+
+
+def _evict(manifest, max_bytes, keep):
+    """
+    Evict least recently used entries from an open manifest, see evict
+    """
+    freed = 0
+    total = sum(entry['bytes'] for entry in manifest.values())
+    for relative_path in sorted(manifest, key=lambda path: manifest[path]['last_access']):
+        if total <= max_bytes:
+            break
+        if relative_path in keep:
+            continue
+        try:
+            remove(str(CACHE_FOLDER / relative_path))
+        except FileNotFoundError:
+            pass
+        total -= manifest[relative_path]['bytes']
+        freed += manifest.pop(relative_path)['bytes']
+    if freed:
+        print("info: evicted {} bytes from cache".format(freed))
+    return freed
+
+
+def _entry_path(namespace, key, extension):
+    return str(CACHE_FOLDER / namespace / key) + extension
+
+
+def _relative_path(path):
+    return str(path)[len(str(CACHE_FOLDER)) + 1:]
+
+
+def _save(path, write):
+    try:
+        makedirs(dirname(path), exist_ok=True)
+        save_atomically(path, write)
+    except IOError as e:
+        print("warning: error saving cache entry to {}; stacktrace: {}".format(path, e))
+        return
+    relative_path = _relative_path(path)
+    with _manifest() as manifest:
+        manifest[relative_path] = {'bytes': getsize(path), 'last_access': time.time()}
+        if _batch is None:
+            _evict(manifest, CACHE_MAX_BYTES, (relative_path,))
+        else:
+            _batch.append(relative_path)
+
+
+def _touch(path):
+    _pending_accesses[_relative_path(path)] = time.time()
+
+
+def flush_accesses():
+    """
+    Write the access times of the entries loaded so far to the manifest. Every manifest update writes them, and
+    they are flushed at exit; processes exiting without running atexit handlers (pool workers) call it themselves.
+    :return: None
+    """
+    if _pending_accesses:
+        with _manifest():
+            pass
+
+
+@atexit.register
+def _flush_accesses_at_exit():
+    try:
+        flush_accesses()
+    except OSError as e:
+        print("warning: error writing cache access times; stacktrace: {}".format(e))
+
+
+class _manifest:
+    """
+    Context manager giving exclusive read-modify-write access to the manifest, as a dict of relative entry path
+    to {'bytes', 'last_access'}. Entries whose files no longer exist are dropped.
+    """
+
+    def __enter__(self):
+        self.lock = open(str(CACHE_FOLDER / (MANIFEST_FILENAME + ".lock")), 'a')
+        if fcntl is not None:
+            fcntl.flock(self.lock, fcntl.LOCK_EX)
+        try:
+            with open(str(CACHE_FOLDER / MANIFEST_FILENAME)) as fp:
+                manifest = json.load(fp)
+        except (FileNotFoundError, ValueError):
+            manifest = {}
+        self.manifest = {path: entry for path, entry in manifest.items() if exists(str(CACHE_FOLDER / path))}
+        for path, last_access in _pending_accesses.items():
+            if exists(str(CACHE_FOLDER / path)):
+                self.manifest[path] = {'bytes': getsize(str(CACHE_FOLDER / path)), 'last_access': last_access}
+        _pending_accesses.clear()
+        return self.manifest
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                save_atomically(str(CACHE_FOLDER / MANIFEST_FILENAME),
+                                lambda fp: fp.write(json.dumps(self.manifest, indent=1).encode()))
+        finally:
+            self.lock.close()
+        return False
@@ -0,0 +1,162 @@
+"""
+Coarse-to-fine search of ads in a TV video, sampling densely only where ads may be.
+
+A first pass samples the video at COARSE_SAMPLES_PER_SECOND, seeking instead of decoding the frames between samples,
+and scores it against the ad library with COARSE_SCORE_THRESHOLD, relaxed below SCORE_THRESHOLD since coarse scores
+are noisier, finding candidate ranges. Only those ranges, plus COARSE_MARGIN_SECONDS on each side, are
+then sampled at SAMPLES_PER_SECOND and searched and scored as the single-pass pipeline does, so detections found
+inside candidate ranges are exactly the single-pass ones.
+
+The coarse sampling timestamps are a subset of the fine ones (every step-th sample), so coarse hits vote for the
+same starting frames, in fine sample units, as the fine hits of the same video frames would.
+"""
+import time
+from multiprocessing import Pool
+
+import numpy
+
+from src import feature_extraction, video_tools
+from src.configurations import DATA_FOLDER, SAMPLES_PER_SECOND, APPEARANCES_OUTFILE, K, \
+    COARSE_SAMPLES_PER_SECOND, COARSE_SCORE_THRESHOLD, COARSE_MARGIN_SECONDS, COARSE_SEEK_MIN_FRAMES, SEEK_MIN_FRAMES
+from src.feature_extraction import FeatureType
+from src.metrics import METRICS
+
+
+def coarse_to_fine_ads_detector(video_filename,
+                                ads_features,
+                                ad_names,
+                                ft_type=FeatureType.SOBEL_THRESH_BINARY,
+                                fps=None,
+                                sps=SAMPLES_PER_SECOND,
+                                coarse_sps=COARSE_SAMPLES_PER_SECOND,
+                                coarse_threshold=COARSE_SCORE_THRESHOLD,
+                                margin_seconds=COARSE_MARGIN_SECONDS,
+                                k=K,
+                                index=None,
+                                data_folder_path=DATA_FOLDER,
+                                use_cache=True,
+                                outfile=APPEARANCES_OUTFILE,
+                                workers=1,
+                                coarse_seek_min_frames=COARSE_SEEK_MIN_FRAMES,
+                                seek_min_frames=SEEK_MIN_FRAMES):
+    """
+    Identify ad appearances in a video with a coarse pass followed by a dense pass over candidate ranges.
+    Export results to outfile.
+    :param video_filename: Filename of the TV video in data_folder_path
+    :param ads_features: Features of each frame, of each ad, sampled at sps
+    :param ad_names: names of ads to be shown in outfile
+    :param ft_type: Feature type of ads_features
+    :param fps: Frames per second of the video; None to read it from the container
+    :param sps: Samples per second of ads_features and of the dense pass
+    :param coarse_sps: Samples per second of the coarse pass; sps must be a multiple of it
+    :param coarse_threshold: Score threshold of the coarse pass; coarse scores are noisier than dense ones
+    :param margin_seconds: Seconds sampled densely before and after each candidate
+    :param k: k of the KNN
+    :param index: Optional ann_index.IVFIndex built over ads_features
+    :param use_cache: Flag to use cached coarse features and KNN if available
+    :param outfile: Path of the file to be written, None to skip exporting
+    :param workers: Amount of processes extracting features and searching the KNN, in both passes
+    :param coarse_seek_min_frames: Seek to coarse samples more than this many frames ahead, see FrameSampler
+    :param seek_min_frames: Seek to dense samples more than this many frames ahead inside a candidate range
+    :return: List of detections, as ads_detector, with the timestamp of their starting frame
+    """
+    hamming = ft_type == FeatureType.SOBEL_THRESH_PACKED
+    step = int(round(sps / coarse_sps))
+    if step < 1 or abs(step * coarse_sps - sps) > 1e-9:
+        raise ValueError("samples per second ({}) must be a multiple of the coarse samples per second ({})".format(
+            sps, coarse_sps))
+    ad_lengths = video_tools.get_ad_lengths_in_frames(ads_features)
+
+    print("info: Coarse pass over {} at {} samples per second".format(video_filename, coarse_sps))
+    coarse_features = feature_extraction.extract_features_from_video(
+        video_filename, fps, coarse_sps, ft_type, data_folder_path, use_cache=use_cache, workers=workers,
+        seek_min_frames=coarse_seek_min_frames)
+    coarse_knn = video_tools.batch_knn(coarse_features, ads_features, k, use_cache=use_cache, hamming=hamming,
+                                       index=index, workers=workers)
+    candidates = coarse_candidates(coarse_knn, ad_lengths, step, coarse_threshold)
+    sample_ranges = candidate_sample_ranges(candidates, ad_lengths, int(margin_seconds * sps))
+
+    start = time.perf_counter()
+    features_of_ranges, timestamps_of_ranges, decoded_frames = extract_features_of_ranges(
+        str(data_folder_path / video_filename), sample_ranges, sps, fps, ft_type, seek_min_frames, workers)
+    METRICS.add_time("feature_extraction", time.perf_counter() - start)
+    METRICS.count("frames_decoded", decoded_frames)
+    dense_samples = sum(len(range_features) for range_features in features_of_ranges)
+    METRICS.count("frames_sampled", dense_samples)
+    dense_fraction = 1.0 * dense_samples / max(1, len(coarse_features) * step)
+    METRICS.observe("densely_decoded_fraction", [dense_fraction])
+    print("info: {} candidate ranges, {:.1%} of {} sampled densely".format(len(sample_ranges), dense_fraction,
+                                                                          video_filename))
+
+    flattened_ads = video_tools.flatten_ads_features(ads_features)
+    ad_matching_list = []
+    for (range_start, _), range_features, range_timestamps in zip(sample_ranges, features_of_ranges,
+                                                                  timestamps_of_ranges):
+        if not len(range_features):
+            continue
+        with METRICS.timer("knn"):
+            knn = video_tools.search_knn(range_features, flattened_ads, k, hamming=hamming, index=index,
+                                         workers=workers)
+        for detection in video_tools.ads_detector(knn, video_filename, ad_lengths, ad_names, outfile=None,
+                                                  timestamps=range_timestamps):
+            # first row of the range is the sample range_start of the video
+            detection['starting_frame'] += range_start
+            ad_matching_list.append(detection)
+    if outfile is not None:
+        video_tools.write_detections(ad_matching_list, video_filename, ad_names, outfile)
+    return ad_matching_list
+
+
+def extract_features_of_ranges(video_path, sample_ranges, sps, fps, ft_type, seek_min_frames=None, workers=1):
+    """
+    feature_extraction.extract_features_of_ranges, with the ranges split among worker processes
+    :return: Tuple (features, timestamps, decoded_frames), as feature_extraction.extract_features_of_ranges
+    """
+    if workers <= 1 or len(sample_ranges) <= 1:
+        return feature_extraction.extract_features_of_ranges(video_path, sample_ranges, sps, fps, ft_type,
+                                                             seek_min_frames)
+    # consecutive ranges per worker, so each one seeks forward only
+    bounds = numpy.linspace(0, len(sample_ranges), min(workers, len(sample_ranges)) + 1).astype(int)
+    with Pool(len(bounds) - 1) as pool:
+        results = pool.starmap(feature_extraction.extract_features_of_ranges,
+                               [(video_path, sample_ranges[start:end], sps, fps, ft_type, seek_min_frames)
+                                for start, end in zip(bounds[:-1], bounds[1:])])
+    return ([features for result in results for features in result[0]],
+            [timestamps for result in results for timestamps in result[1]],
+            sum(result[2] for result in results))
+
+
+def coarse_candidates(coarse_knn, ad_lengths, step, threshold=COARSE_SCORE_THRESHOLD):
+    """
+    Score the coarse pass as ads_detector does, with starting frames in fine sample units
+    :param coarse_knn: Tuple (knn_ad_idx, knn_frame_idx) of the coarse video frames, as returned by batch_knn
+    :param ad_lengths: List of frames sampled for each ad, at the fine sampling rate
+    :param step: Fine samples per coarse sample
+    :param threshold: Minimum score of a candidate
+    :return: List of candidate (ad_idx, starting_frame), starting_frame being a fine sample index
+    """
+    video_frame_idx, ad_idx, ad_frame_idx, rank = video_tools.knn_hits(coarse_knn)
+    # coarse sample j is the fine sample j * step, and each ad gets a vote every step samples
+    hits = (video_frame_idx * step, ad_idx, ad_frame_idx, rank)
+    scores, _ = video_tools.score_sequences(hits, numpy.asarray(ad_lengths, dtype=numpy.float64) / step,
+                                            len(coarse_knn[0]) * step)
+    return [(int(ad_idx), int(starting_frame)) for ad_idx, starting_frame in zip(*numpy.nonzero(scores > threshold))]
+
+
+def candidate_sample_ranges(candidates, ad_lengths, margin):
+    """
+    Sample ranges covering every candidate plus margins, merging those that overlap
+    :param candidates: List of (ad_idx, starting_frame), see coarse_candidates
+    :param ad_lengths: List of frames sampled for each ad
+    :param margin: Samples added before and after each candidate
+    :return: Sorted list of (start, end) sample ranges
+    """
+    sample_ranges = sorted((max(0, starting_frame - margin), starting_frame + ad_lengths[ad_idx] + margin)
+                           for ad_idx, starting_frame in candidates)
+    merged = []
+    for start, end in sample_ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [(start, end) for start, end in merged]
@@ -3,15 +3,54 @@ from pathlib import Path
 DATA_FOLDER = Path("data/")
 CACHE_FOLDER = Path("cache/")
 SUPPORTED_EXTENSIONS = ["mpg", "mp4"]
+CACHE_MAX_BYTES = 4 * 1024 ** 3
 
 # FEATURE EXTRACTION
 SAMPLES_PER_SECOND = 2
 SOBEL_THRESH = 100
 SAMPLING_DIMENSIONS = (32, 32)
+STREAM_CHUNK_SIZE = 1024
+FEATURE_BATCH_SIZE = 64
+SEEK_MIN_FRAMES = None
+ADAPTIVE_SAMPLING = False
+ADAPTIVE_MIN_CHANGE = 0.02
+ADAPTIVE_MAX_GAP_SECONDS = 5
 
 # KNN
 K = 5
+KNN_BLOCK_SIZE = 256
+KNN_WORKERS = 1
+USE_ANN_INDEX = False
+ANN_NLIST = None
+ANN_NPROBE = 8
+USE_PROJECTION = False
+PROJECTION_METHOD = "pca"
+PROJECTION_DIMENSIONS = 48
+PROJECTION_SHORTLIST = 32
+DEDUP_ADS_FRAMES = False
+DEDUP_MAX_DISTANCE = 0.02
+STOP_FRAME_MIN_INFORMATION = None
+STOP_FRAME_MAX_ADS = None
+
+# FINGERPRINT
+FINGERPRINT_GRID = 4
+FINGERPRINT_SHINGLE = 3
+FINGERPRINT_PHASES = 4
+FINGERPRINT_PROBE_BITS = 1
+FINGERPRINT_MAX_POSTINGS = 64
+FINGERPRINT_SCORE_THRESHOLD = 0.1
 
 # AD DETECTION
 APPEARANCES_OUTFILE = "detecciones.txt"
 SCORE_THRESHOLD = 0.25
+NMS_MAX_OVERLAP = 0.5
+NMS_MAX_WINDOW = 256
+COARSE_SAMPLES_PER_SECOND = 0.5
+# relaxed, so the coarse pass keeps the candidates of every airing the dense pass scores over SCORE_THRESHOLD
+COARSE_SCORE_THRESHOLD = SCORE_THRESHOLD / 2
+COARSE_SEEK_MIN_FRAMES = 30
+COARSE_MARGIN_SECONDS = 5
+
+# DAEMON
+DAEMON_SOCKET = "adlookupd.sock"
+LIBRARY_POLL_SECONDS = 5
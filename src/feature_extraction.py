@@ -1,145 +1,591 @@
 from enum import Enum
+from functools import partial
+from multiprocessing import Pool
 from os import listdir
+import time
 import numpy
 
-from src.configurations import DATA_FOLDER, SAMPLES_PER_SECOND, SAMPLING_DIMENSIONS, SOBEL_THRESH, CACHE_FOLDER, \
-    SUPPORTED_EXTENSIONS
+from src import cache_manager
+from src.ad_library import AdLibrary
+from src.metrics import METRICS
+from src.configurations import DATA_FOLDER, SAMPLES_PER_SECOND, SAMPLING_DIMENSIONS, SOBEL_THRESH, \
+    SUPPORTED_EXTENSIONS, STREAM_CHUNK_SIZE, FEATURE_BATCH_SIZE, SEEK_MIN_FRAMES, ADAPTIVE_MIN_CHANGE, \
+    ADAPTIVE_MAX_GAP_SECONDS
 import cv2
 
 
+# bumped whenever the features computed for the same parameters change, invalidating cached features
+FEATURES_VERSION = 3
+# frame rate assumed when the container doesn't report one
+DEFAULT_FPS = 30
+
+
 class FeatureType(Enum):
     GRAY_SCALE = 1
     SOBEL_GRAD_CONCAT = 2
     SOBEL_GRAD_MAGNITUDE = 4
     SOBEL_THRESH_BINARY = 3
+    SOBEL_THRESH_PACKED = 5
 
 
 def extract_features_from_video(filename,
-                                fps=30,
+                                fps=None,
                                 sps=SAMPLES_PER_SECOND,
                                 ft_type=FeatureType.SOBEL_THRESH_BINARY,
                                 data_folder_path=DATA_FOLDER,
                                 use_cache=True,
-                                cache_prefix=""):
+                                workers=1,
+                                seek_min_frames=SEEK_MIN_FRAMES,
+                                with_timestamps=False,
+                                adaptive=False):
     """
     Extract features from video
-    :param fps: Frames per second of the video to be sampled
+    :param fps: Frames per second of the video to be sampled; None to read it from the container
     :param sps: Samples per second to be sampled
     :param ft_type: Feature type to be extracted, options are in FeatureType Enum
     :param data_folder_path: Path of the folder containing the video file to be sampled
     :param use_cache: Flag to use cache if available
-    :param cache_prefix: Prefix of the cached files
+    :param workers: Amount of processes decoding different time ranges of the video at the same time
+    :param seek_min_frames: Seek to samples more than this many frames ahead instead of decoding every frame; None
+        to never seek, see FrameSampler
+    :param with_timestamps: Flag to also return the timestamp of each sample
+    :param adaptive: Flag to keep only the samples whose content changed, see adaptive_samples; the timestamps
+        then tell which samples were kept
     :param filename: Filename from video in DATA_FOLDER
-    :return: Features of video, with shape [sampled_frames, features]
+    :return: Features of video, with shape [sampled_frames, features]; with with_timestamps, a tuple (features,
+        timestamps), timestamps being the time in seconds of each sampled frame
     """
 
-    video_path = str(data_folder_path / filename)
-    cache_filename = "{}{}_{}{}_{}spd_{}".format(
-        cache_prefix,
-        filename,
-        ft_type.name,
-        SOBEL_THRESH,
-        sps,
-        str(SAMPLING_DIMENSIONS)
-    )
-    cache_path = str(CACHE_FOLDER / "features" / cache_filename) + ".npy"
+    video_path = data_folder_path / filename
+    cache_key = features_cache_key(video_path, fps, sps, ft_type, adaptive)
     if use_cache:
         # check if features are cached
-        try:
-            features = numpy.load(cache_path)
+        features = cache_manager.load("features", cache_key)
+        timestamps = cache_manager.load("features", cache_key + "_timestamps") if with_timestamps else None
+        if features is not None and (timestamps is not None or not with_timestamps):
             print("info: loading features of {} from cache".format(filename))
-            return features
-        except FileNotFoundError:
-            pass
+            return (features, timestamps) if with_timestamps else features
+
+    if workers > 1:
+        chunks = extract_features_in_parallel(str(video_path), fps, sps, ft_type, workers, seek_min_frames,
+                                              adaptive)
+    else:
+        # one chunk holding the whole video, preallocated from its frame count
+        chunks = list(iter_features_from_video(filename, fps, sps, ft_type, data_folder_path, chunk_size=None,
+                                               seek_min_frames=seek_min_frames, with_timestamps=True,
+                                               adaptive=adaptive))
+    if len(chunks) == 1:
+        features, timestamps = chunks[0]
+    elif chunks:
+        features = numpy.concatenate([features for features, _ in chunks])
+        timestamps = numpy.concatenate([timestamps for _, timestamps in chunks])
+    else:
+        features, timestamps = numpy.asarray([]), numpy.asarray([])
+    print("info: features of {} extracted succesfully".format(filename))
 
-    capture = cv2.VideoCapture(video_path)
-    skipped_frames = 0
-    delta = int(fps / sps)
+    with cache_manager.batch_writes():
+        cache_manager.save("features", cache_key, features)
+        cache_manager.save("features", cache_key + "_timestamps", timestamps)
+    return (features, timestamps) if with_timestamps else features
+
+
+def features_cache_key(video_path, fps=None, sps=SAMPLES_PER_SECOND, ft_type=FeatureType.SOBEL_THRESH_BINARY,
+                       adaptive=False):
+    """
+    Key of the cached features of a video: the video content plus every extraction parameter
+    :param video_path: Path of the video file
+    :param adaptive: Flag indicating only the samples kept by adaptive_samples are extracted
+    :return: Cache key, see cache_manager.cache_key
+    """
+    parts = [
+        cache_manager.file_fingerprint(video_path),
+        FEATURES_VERSION,
+        ft_type.name,
+        SOBEL_THRESH,
+        fps,
+        sps,
+        SAMPLING_DIMENSIONS
+    ]
+    if adaptive:
+        parts += ["adaptive", ADAPTIVE_MIN_CHANGE, ADAPTIVE_MAX_GAP_SECONDS]
+    return cache_manager.cache_key(*parts)
 
+
+class FrameSampler:
+    """
+    Decodes the frames of a video nearest to the sampling timestamps n / sps, for n = 0, 1, ...
+
+    The frame rate is read from the container and the timestamp of each frame from CAP_PROP_POS_MSEC, so samples
+    don't drift on 25 or 29.97 fps material. Frames are grabbed one by one and only the sampled ones are retrieved.
+    With seek_min_frames, the sampler seeks to samples more than that many frames ahead instead, which saves
+    decoding when sps is far below the frame rate (how much depends on the keyframe interval of the video).
+    Seeking falls back to sequential decoding on containers that don't support exact seeking.
+    """
+
+    def __init__(self, video_path, sps=SAMPLES_PER_SECOND, fps=None, seek_min_frames=None):
+        self.video_path = str(video_path)
+        self.capture = cv2.VideoCapture(self.video_path)
+        container_fps = self.capture.get(cv2.CAP_PROP_FPS)
+        self.fps = fps or (container_fps if container_fps > 0 else DEFAULT_FPS)
+        self.sps = sps
+        self.seek_min_frames = seek_min_frames
+        self.frame_count = int(self.capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.next_frame = 0  # index of the next frame to be grabbed
+        self.decoded_frames = 0
+        self.seekable = True
+
+    @property
+    def sample_count(self):
+        """
+        Amount of samples of the whole video, estimated from its frame count
+        """
+        return int(numpy.ceil(max(0, self.frame_count) * self.sps / self.fps))
+
+    def samples(self, first_sample=0, end_sample=None):
+        """
+        Decode the sampled frames in [first_sample, end_sample), seeking to first_sample if it is ahead
+        :param end_sample: Sample where to stop; None means until the end of the video
+        :return: Generator of (sample_idx, timestamp, frame), timestamp being the time of the frame in seconds
+        """
+        half_frame = 0.5 / self.fps
+        sample_idx = first_sample
+        while end_sample is None or sample_idx < end_sample:
+            target = sample_idx / self.sps
+            target_frame = int(round(target * self.fps))
+            ahead = target_frame - self.next_frame
+            if ahead > 0 and (sample_idx == first_sample or
+                              self.seek_min_frames is not None and ahead > self.seek_min_frames):
+                # land one frame early, in case the timestamps aren't exactly frame_idx / fps
+                self._seek(target_frame - 1)
+            # grab until the frame nearest to the target
+            while True:
+                if not self.capture.grab():
+                    return
+                timestamp = self._timestamp()
+                self.next_frame += 1
+                self.decoded_frames += 1
+                if timestamp >= target - half_frame:
+                    break
+            retval, frame = self.capture.retrieve()
+            if retval:
+                yield sample_idx, timestamp, frame
+            # targets already passed by this frame aren't sampled again
+            sample_idx = max(sample_idx + 1, int((timestamp + half_frame) * self.sps) + 1)
+
+    def release(self):
+        self.capture.release()
+
+    def _timestamp(self):
+        msec = self.capture.get(cv2.CAP_PROP_POS_MSEC)
+        if msec > 0 or self.next_frame == 0:
+            return msec / 1000.0
+        # container doesn't report timestamps
+        return self.next_frame / self.fps
+
+    def _seek(self, frame_idx):
+        if not self.seekable or frame_idx <= self.next_frame:
+            return
+        self.capture.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+        if int(self.capture.get(cv2.CAP_PROP_POS_FRAMES)) == frame_idx:
+            self.next_frame = frame_idx
+            return
+        # container doesn't support exact seeking; decode sequentially from the beginning instead
+        self.seekable = False
+        self.capture.release()
+        self.capture = cv2.VideoCapture(self.video_path)
+        self.next_frame = 0
+
+
+def iter_features_from_video(filename,
+                             fps=None,
+                             sps=SAMPLES_PER_SECOND,
+                             ft_type=FeatureType.SOBEL_THRESH_BINARY,
+                             data_folder_path=DATA_FOLDER,
+                             chunk_size=STREAM_CHUNK_SIZE,
+                             seek_min_frames=SEEK_MIN_FRAMES,
+                             with_timestamps=False,
+                             adaptive=False):
+    """
+    Extract features from video as a stream of fixed-size chunks, so long videos can be processed in constant
+    memory. No cache is used.
+    :param fps: Frames per second of the video to be sampled; None to read it from the container
+    :param sps: Samples per second to be sampled
+    :param ft_type: Feature type to be extracted, options are in FeatureType Enum
+    :param data_folder_path: Path of the folder containing the video file to be sampled
+    :param chunk_size: Amount of sampled frames of each chunk; None for a single chunk with the whole video
+    :param seek_min_frames: Seek to samples more than this many frames ahead, see FrameSampler
+    :param with_timestamps: Flag to yield (features, timestamps) tuples instead of features
+    :param adaptive: Flag to keep only the samples whose content changed, see adaptive_samples
+    :param filename: Filename from video in DATA_FOLDER
+    :return: Generator of features of consecutive sampled frames, each with shape [chunk_size, features] (the last
+        one may be shorter)
+    """
+    start = time.perf_counter()
+    sampler = FrameSampler(data_folder_path / filename, sps, fps, seek_min_frames)
+    progress = METRICS.progress("decoding {}".format(filename), sampler.frame_count)
+    capacity = chunk_size or sampler.sample_count + 1
+
+    kernel = FeatureKernel(ft_type, capacity)
+    counted_frames = 0
+    samples = sampler.samples()
+    for _, timestamp, frame in adaptive_samples(samples, sps) if adaptive else samples:
+        kernel.add(frame, timestamp)
+        if len(kernel) == chunk_size:
+            chunk = (kernel.features(), kernel.timestamps())
+            _count_decoded(progress, sampler.decoded_frames - counted_frames, chunk_size, start)
+            counted_frames = sampler.decoded_frames
+            yield chunk if with_timestamps else chunk[0]
+            start = time.perf_counter()
+            kernel = FeatureKernel(ft_type, capacity)
+    sampler.release()
+    chunk = (kernel.features(), kernel.timestamps())
+    _count_decoded(progress, sampler.decoded_frames - counted_frames, len(chunk[0]), start)
+    if len(chunk[0]):
+        yield chunk if with_timestamps else chunk[0]
+
+
+def _count_decoded(progress, decoded_frames, sampled_frames, start):
+    """
+    Record frames decoded and sampled since start, leaving out the time spent by the consumer of the features
+    """
+    METRICS.count("frames_decoded", decoded_frames)
+    METRICS.count("frames_sampled", sampled_frames)
+    METRICS.add_time("feature_extraction", time.perf_counter() - start)
+    progress.update(decoded_frames)
+
+
+def extract_features_in_parallel(video_path, fps, sps, ft_type, workers, seek_min_frames=None, adaptive=False):
+    """
+    Split the samples of the video in one range per worker and extract the features of each range in a separate
+    process. Each worker samples exactly the frames the sequential extraction would, also with adaptive sampling,
+    since ranges start at the start of a block of adaptive_samples.
+    :param video_path: Path of the video file
+    :param fps: Frames per second of the video; None to read it from the container
+    :param sps: Samples per second to be sampled
+    :param ft_type: Feature type to be extracted, options are in FeatureType Enum
+    :param workers: Amount of worker processes
+    :param seek_min_frames: Seek to samples more than this many frames ahead, see FrameSampler
+    :param adaptive: Flag to keep only the samples whose content changed, see adaptive_samples
+    :return: Tuples (features, timestamps) of each range, in video order
+    """
+    sampler = FrameSampler(video_path, sps, fps)
+    sampler.release()
+    samples_per_worker = -(-sampler.sample_count // workers)
+    if adaptive:
+        block = adaptive_block_samples(sps)
+        samples_per_worker = -(-samples_per_worker // block) * block
+    boundaries = [min(worker * samples_per_worker, sampler.sample_count) for worker in range(workers)] + [None]
+    # the frame count of some containers is an estimate; the last range reads until the end of the video
+    segments = [(video_path, sampler.fps, sps, start, end, ft_type, seek_min_frames, adaptive)
+                for start, end in zip(boundaries[:-1], boundaries[1:]) if end is None or end > start]
+    with METRICS.timer("feature_extraction"), Pool(len(segments)) as pool:
+        results = pool.map(_extract_segment_features, segments)
+    for features, _, decoded_frames in results:
+        METRICS.count("frames_decoded", decoded_frames)
+        METRICS.count("frames_sampled", len(features))
+    return [(features, timestamps) for features, timestamps, _ in results if len(features)]
+
+
+def _extract_segment_features(segment):
+    """
+    Features and timestamps of the samples in [start, end) of a video; end None means until the end of the video.
+    Also returns the amount of frames decoded, including those skipped to reach start.
+    """
+    video_path, fps, sps, start, end, ft_type, seek_min_frames, adaptive = segment
+    features, timestamps, decoded_frames = extract_features_of_ranges(video_path, [(start, end)], sps, fps,
+                                                                      ft_type, seek_min_frames, adaptive)
+    return features[0], timestamps[0], decoded_frames
+
+
+def extract_features_of_ranges(video_path, sample_ranges, sps=SAMPLES_PER_SECOND, fps=None,
+                               ft_type=FeatureType.SOBEL_THRESH_BINARY, seek_min_frames=None, adaptive=False):
+    """
+    Features of the samples inside some ranges of a video, decoding nothing between ranges when the container
+    supports exact seeking. Sample n is the frame nearest to n / sps seconds, as in the sequential extraction.
+    :param video_path: Path of the video file
+    :param sample_ranges: Sorted, non-overlapping list of (start, end) sample ranges; end None means until the end
+    :param sps: Samples per second to be sampled
+    :param fps: Frames per second of the video; None to read it from the container
+    :param ft_type: Feature type to be extracted, options are in FeatureType Enum
+    :param seek_min_frames: Seek to samples more than this many frames ahead inside a range, see FrameSampler
+    :param adaptive: Flag to keep only the samples whose content changed, see adaptive_samples
+    :return: Tuple (features, timestamps, decoded_frames): the features of each range, with shape
+        [sampled_frames, features], the timestamps of each range, and the amount of frames decoded, including
+        those skipped to reach each range
+    """
+    sampler = FrameSampler(video_path, sps, fps, seek_min_frames)
     features = []
+    timestamps = []
+    for start, end in sample_ranges:
+        kernel = FeatureKernel(ft_type, (end if end is not None else sampler.sample_count + 1) - start)
+        samples = sampler.samples(start, end)
+        for _, timestamp, frame in adaptive_samples(samples, sps) if adaptive else samples:
+            kernel.add(frame, timestamp)
+        features.append(kernel.features())
+        timestamps.append(kernel.timestamps())
+    sampler.release()
+    return features, timestamps, sampler.decoded_frames
 
-    while capture.grab():
-        # sampling mechanism
-        skipped_frames += 1
-        if skipped_frames < delta:
-            continue
-
-        # getting frame
-        retval, frame = capture.retrieve()
-        if not retval:
-            continue
-        skipped_frames = 0
-
-        # down-sampling dimensions
-        frame = cv2.resize(frame, SAMPLING_DIMENSIONS)
-
-        # gray scaling
-        gray_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        if ft_type == FeatureType.GRAY_SCALE:
-            # feature type is Gray Scale; append and continue
-            features.append(gray_frame.flatten())
-            continue
-
-        # sobel filters
-        grad_x = cv2.Sobel(gray_frame, ddepth=cv2.CV_32F, dx=1, dy=0, ksize=3)
-        grad_y = cv2.Sobel(gray_frame, ddepth=cv2.CV_32F, dx=0, dy=1, ksize=3)
-        if ft_type == FeatureType.SOBEL_GRAD_CONCAT:
-            # feature type is Gradient Concatenation; concat, append and continue
-            features.append(numpy.concatenate((grad_x.flatten(), grad_x.flatten())))
-            continue
-
-        # gradient magnitude approximation
-        grad_magnitude = numpy.sqrt(numpy.square(grad_x) + numpy.square(grad_y))
-        if ft_type == FeatureType.SOBEL_GRAD_MAGNITUDE:
-            # feature type is Gradient Magnitude; append and continue
-            features.append(grad_magnitude.flatten())
-            continue
-
-        # to binary (0s and 255s)
-        _, borders = cv2.threshold(grad_magnitude, thresh=SOBEL_THRESH, maxval=255, type=cv2.THRESH_BINARY)
-        # feature type is Thresh; append and continue
-        features.append(borders.flatten())
-    features = numpy.asarray(features)
-    print("info: features of {} extracted succesfully".format(filename))
 
-    try:
-        numpy.save(cache_path, features)
-    except IOError as e:
-        print("warning: error saving cached features to {}; stacktrace: {}".format(cache_path, e))
-        pass
-    return features
+def adaptive_samples(samples, sps=SAMPLES_PER_SECOND, min_change=ADAPTIVE_MIN_CHANGE,
+                     max_gap_seconds=ADAPTIVE_MAX_GAP_SECONDS):
+    """
+    Skip samples that look like the last one kept, e.g. along static shots, so they are neither featurized nor
+    searched. Each sample is compared with the last kept one by the mean absolute difference of their downsized gray
+    frames, and kept if it is over min_change (as a fraction of the gray range). The first sample of each block of
+    adaptive_block_samples is always kept, which bounds the gap between kept samples and makes the samples kept in a
+    block independent from earlier blocks.
+    :param samples: Generator of (sample_idx, timestamp, frame), see FrameSampler.samples
+    :param sps: Samples per second of the samples
+    :param min_change: Smallest change with the last kept sample that keeps a sample
+    :param max_gap_seconds: Seconds of each block
+    :return: Generator of the kept (sample_idx, timestamp, frame)
+    """
+    block = adaptive_block_samples(sps, max_gap_seconds)
+    last_block = None
+    last_kept = None
+    skipped = 0
+    for sample_idx, timestamp, frame in samples:
+        signature = gray_frame(frame).astype(numpy.int16)
+        if sample_idx // block != last_block or \
+                numpy.abs(signature - last_kept).mean() > min_change * 255:
+            last_block = sample_idx // block
+            last_kept = signature
+            yield sample_idx, timestamp, frame
+        else:
+            skipped += 1
+    METRICS.count("samples_skipped", skipped)
+
+
+def adaptive_block_samples(sps=SAMPLES_PER_SECOND, max_gap_seconds=ADAPTIVE_MAX_GAP_SECONDS):
+    """
+    Samples of each block of adaptive_samples, at least one
+    """
+    return max(1, int(round(max_gap_seconds * sps)))
+
+
+class FeatureKernel:
+    """
+    Features of a sequence of decoded frames, computed in batches.
+
+    Frames are downsized and gray scaled into a preallocated stack of batch_size frames; once the stack is full,
+    the features of the whole stack are computed at once (see batch_features) and written straight into a
+    preallocated output array, which only grows if more than capacity frames are added.
+    """
+
+    def __init__(self, ft_type=FeatureType.SOBEL_THRESH_BINARY, capacity=STREAM_CHUNK_SIZE,
+                 batch_size=FEATURE_BATCH_SIZE):
+        self.ft_type = ft_type
+        self.stack = numpy.empty((batch_size, SAMPLING_DIMENSIONS[1], SAMPLING_DIMENSIONS[0]), dtype=numpy.uint8)
+        self.stacked = 0
+        size, dtype = feature_size_and_dtype(ft_type)
+        self.output = numpy.empty((max(1, capacity), size), dtype=dtype)
+        self.length = 0
+        self.frame_timestamps = []
+
+    def __len__(self):
+        return self.length + self.stacked
+
+    def add(self, frame, timestamp=None):
+        """
+        Add a decoded BGR frame, as returned by cv2.VideoCapture, and its timestamp in seconds
+        """
+        self.frame_timestamps.append(timestamp)
+        gray_frame(frame, out=self.stack[self.stacked])
+        self.stacked += 1
+        if self.stacked == len(self.stack):
+            self._flush()
+
+    def features(self):
+        """
+        :return: Features of every frame added, with shape [frames, features]; a view of the output array
+        """
+        self._flush()
+        return self.output[:self.length]
+
+    def timestamps(self):
+        """
+        :return: Timestamp of every frame added, as a float array (nan where none was given)
+        """
+        return numpy.array(self.frame_timestamps, dtype=numpy.float64)
+
+    def _flush(self):
+        if not self.stacked:
+            return
+        end = self.length + self.stacked
+        if end > len(self.output):
+            # the frame count of some containers is an estimate
+            grown = numpy.empty((max(end, 2 * len(self.output)), self.output.shape[1]), dtype=self.output.dtype)
+            grown[:self.length] = self.output[:self.length]
+            self.output = grown
+        batch_features(self.stack[:self.stacked], self.ft_type, out=self.output[self.length:end])
+        self.length = end
+        self.stacked = 0
+
+
+def feature_size_and_dtype(ft_type=FeatureType.SOBEL_THRESH_BINARY):
+    """
+    :return: Tuple (length, dtype) of the feature vector of a frame
+    """
+    pixels = SAMPLING_DIMENSIONS[0] * SAMPLING_DIMENSIONS[1]
+    if ft_type == FeatureType.GRAY_SCALE:
+        return pixels, numpy.uint8
+    if ft_type == FeatureType.SOBEL_GRAD_CONCAT:
+        return 2 * pixels, numpy.float32
+    if ft_type == FeatureType.SOBEL_THRESH_PACKED:
+        return -(-pixels // 8), numpy.uint8
+    return pixels, numpy.float32
+
+
+def gray_frame(frame, out=None):
+    """
+    Downsized gray scale version of a decoded BGR frame
+    :param out: Optional uint8 array with shape [height, width] of SAMPLING_DIMENSIONS to be written
+    """
+    return cv2.cvtColor(cv2.resize(frame, SAMPLING_DIMENSIONS), cv2.COLOR_BGR2GRAY, dst=out)
+
+
+def frame_features(frame, ft_type=FeatureType.SOBEL_THRESH_BINARY):
+    """
+    Features of a single decoded frame
+    :param frame: BGR frame, as returned by cv2.VideoCapture
+    :param ft_type: Feature type to be extracted, options are in FeatureType Enum
+    :return: Flat feature vector
+    """
+    return batch_features(gray_frame(frame)[None], ft_type)[0]
+
+
+def batch_features(gray_frames, ft_type=FeatureType.SOBEL_THRESH_BINARY, out=None):
+    """
+    Features of a stack of downsized gray frames, computed for the whole stack at once.
+    Results are identical to cv2.Sobel (3x3 kernel, reflected borders) and cv2.threshold applied frame by frame.
+    :param gray_frames: uint8 array with shape [frames, height, width], see gray_frame
+    :param ft_type: Feature type to be extracted, options are in FeatureType Enum
+    :param out: Optional output array with shape [frames, features], see feature_size_and_dtype
+    :return: Features of each frame, with shape [frames, features]
+    """
+    frames = gray_frames.shape[0]
+    if out is None:
+        size, dtype = feature_size_and_dtype(ft_type)
+        out = numpy.empty((frames, size), dtype=dtype)
+    if ft_type == FeatureType.GRAY_SCALE:
+        # feature type is Gray Scale
+        out[:] = gray_frames.reshape(frames, -1)
+        return out
+
+    # sobel filters
+    grad_x, grad_y = sobel_gradients(gray_frames)
+    if ft_type == FeatureType.SOBEL_GRAD_CONCAT:
+        # feature type is Gradient Concatenation
+        pixels = grad_x[0].size
+        out[:, :pixels] = grad_x.reshape(frames, -1)
+        out[:, pixels:] = grad_y.reshape(frames, -1)
+        return out
+
+    # gradient magnitude approximation, in place
+    grad_magnitude = numpy.square(grad_x, out=grad_x)
+    grad_magnitude += numpy.square(grad_y, out=grad_y)
+    numpy.sqrt(grad_magnitude, out=grad_magnitude)
+    if ft_type == FeatureType.SOBEL_GRAD_MAGNITUDE:
+        # feature type is Gradient Magnitude
+        out[:] = grad_magnitude.reshape(frames, -1)
+        return out
+
+    # to binary
+    borders = grad_magnitude.reshape(frames, -1) > SOBEL_THRESH
+    if ft_type == FeatureType.SOBEL_THRESH_PACKED:
+        # feature type is Packed Thresh; one bit per pixel
+        out[:] = numpy.packbits(borders, axis=1)
+        return out
+    # feature type is Thresh (0s and 255s)
+    numpy.multiply(borders, 255, out=out)
+    return out
+
+
+def sobel_gradients(gray_frames):
+    """
+    Horizontal and vertical 3x3 Sobel gradients of a stack of gray frames, as cv2.Sobel with its default
+    BORDER_REFLECT_101 border
+    :param gray_frames: Array with shape [frames, height, width]
+    :return: Tuple (grad_x, grad_y) of float32 arrays with the shape of gray_frames
+    """
+    padded = numpy.pad(gray_frames.astype(numpy.float32), ((0, 0), (1, 1), (1, 1)), mode='reflect')
+    # separable kernels: central difference along one axis, [1, 2, 1] smoothing along the other
+    diff = padded[:, :, 2:] - padded[:, :, :-2]
+    grad_x = diff[:, :-2] + diff[:, 2:]
+    grad_x += 2 * diff[:, 1:-1]
+    diff = padded[:, 2:] - padded[:, :-2]
+    grad_y = diff[:, :, :-2] + diff[:, :, 2:]
+    grad_y += 2 * diff[:, :, 1:-1]
+    return grad_x, grad_y
 
 
 def extract_features_from_video_folder(foldername,
                                        video_extensions=SUPPORTED_EXTENSIONS,
-                                       fps=30,
+                                       fps=None,
                                        sps=SAMPLES_PER_SECOND,
-                                       ft_type=FeatureType.SOBEL_THRESH_BINARY):
+                                       ft_type=FeatureType.SOBEL_THRESH_BINARY,
+                                       workers=1):
     """
-    Extract features of each video in the folder
-    :param video_extensions: 
-    :param fps: 
-    :param sps: 
-    :param ft_type: 
+    Extract features of each video in the folder, into a consolidated and memory-mapped AdLibrary.
+    Once the library of a folder is cached, loading it doesn't read any per-video feature file.
+    :param video_extensions: Extensions of the files to be considered videos
+    :param fps: Frames per second of the videos to be sampled; None to read it from each container
+    :param sps: Samples per second to be sampled
+    :param ft_type: Feature type to be extracted, options are in FeatureType Enum
+    :param workers: Amount of processes extracting different videos at the same time
     :param foldername: Folder path containing ad videos in DATA_FOLDER.
-    :return: Features of each video, with shape [videos_in_folder, sampled_frames, features]
+    :return: AdLibrary with the features of each video, with shape [videos_in_folder, sampled_frames, features],
+        and the name of each video; videos are sorted by filename
     """
-    features = []
-    video_names = []
     video_folder_path = DATA_FOLDER / foldername
-    for filename in listdir(str(video_folder_path)):
-        if filename[-3:] not in video_extensions:
-            # file in folder isnt video filetype
-            continue
-        features.append(extract_features_from_video(filename,
-                                                    fps,
-                                                    sps,
-                                                    ft_type,
-                                                    video_folder_path,
-                                                    cache_prefix=foldername+"_"))
-        video_names.append(filename.split(".")[0])
-    if not features:
-        raise AssertionError("Feature vector is empty. Check extensions () and if video folder is empty.".format(
+    # files in folder that aren't video filetype are skipped
+    filenames = [filename for filename in sorted(listdir(str(video_folder_path)))
+                 if filename[-3:] in video_extensions]
+    if not filenames:
+        raise AssertionError("Feature vector is empty. Check extensions {} and if video folder is empty.".format(
             str(video_extensions)
         ))
-    return numpy.asarray(features), video_names
+    video_names = [filename.split(".")[0] for filename in filenames]
+    ad_keys = [features_cache_key(video_folder_path / filename, fps, sps, ft_type) for filename in filenames]
+    library = AdLibrary.load(ad_keys, video_names)
+    if library is not None:
+        print("info: loading features of {} from cache".format(foldername))
+        return library, video_names
+
+    extract = partial(extract_features_from_video,
+                      fps=fps,
+                      sps=sps,
+                      ft_type=ft_type,
+                      data_folder_path=video_folder_path)
+    if workers > 1:
+        with Pool(workers) as pool:
+            results = pool.map(partial(_extract_in_worker, extract), filenames)
+        features = []
+        for video_features, worker_metrics in results:
+            features.append(video_features)
+            METRICS.merge(worker_metrics)
+    else:
+        features = [extract(filename) for filename in filenames]
+    return AdLibrary.build(features, ad_keys, video_names), video_names
+
+
+def _extract_in_worker(extract, filename):
+    # send back only the metrics of this video, to be merged into the parent's
+    METRICS.reset()
+    features = extract(filename)
+    # pool workers exit without running atexit handlers
+    cache_manager.flush_accesses()
+    return features, METRICS
+
+
+def unpack_features(features, dimensions=SAMPLING_DIMENSIONS):
+    """
+    Expand SOBEL_THRESH_PACKED features back to the SOBEL_THRESH_BINARY representation (0s and 255s)
+    :param features: Packed features, with shape [..., packed_bytes]
+    :param dimensions: Sampling dimensions used when the features were extracted
+    :return: Features with shape [..., width * height] and values 0 or 255
+    """
+    features = numpy.asarray(features, dtype=numpy.uint8)
+    bits = numpy.unpackbits(features, axis=-1)[..., :dimensions[0] * dimensions[1]]
+    return bits.astype(numpy.float32) * 255
@@ -0,0 +1,306 @@
+"""
+Temporal fingerprint engine: ads are found by hash lookups in an inverted index instead of a KNN over ad frames.
+
+Each sampled frame is quantized to a short perceptual code: its Sobel edge map is split into FINGERPRINT_GRID x
+FINGERPRINT_GRID blocks, and each bit tells whether a block has more edges than the median block. The codes of
+FINGERPRINT_SHINGLE consecutive samples form a shingle, and the inverted index maps each shingle of each ad to the
+(ad, offset) pairs where it appears. Scanning a broadcast is then a binary search per shingle in the sorted index
+plus voting for the ad starting at (sample - offset), so the cost per sample depends on the postings found and only
+logarithmically on the size of the library.
+
+Codes are exact, so two things make up for the frames of a broadcast not being exactly those of the ad clips:
+ads are indexed at FINGERPRINT_PHASES phases of the sampling period (sampled at FINGERPRINT_PHASES times
+SAMPLES_PER_SECOND), so some phase is close to the one of each airing, and each broadcast sample is also looked up
+with its FINGERPRINT_PROBE_BITS least confident bits (blocks nearest to the median) flipped. Shingles found at more
+than FINGERPRINT_MAX_POSTINGS places of the library (black frames, shared end cards) are left out of the index.
+A detection needs FINGERPRINT_SCORE_THRESHOLD of the shingles of an ad matched at the same offset, and its start
+is rounded to the nearest sample of the broadcast from the phase matched.
+
+Usage (index size, lookup time and detections report):
+$ python -m src.fingerprint "full-length video filename" "ad video-clip folder"
+"""
+import sys
+import time
+from itertools import product
+
+import numpy
+
+from src import cache_manager
+from src.metrics import METRICS
+from src.configurations import SAMPLES_PER_SECOND, SAMPLING_DIMENSIONS, FINGERPRINT_GRID, FINGERPRINT_SHINGLE, \
+    FINGERPRINT_PHASES, FINGERPRINT_PROBE_BITS, FINGERPRINT_MAX_POSTINGS, FINGERPRINT_SCORE_THRESHOLD
+from src.feature_extraction import FeatureType, extract_features_from_video_folder
+from src.video_tools import SCORE_HISTOGRAM
+
+
+class FingerprintIndex:
+    """
+    Inverted index of the shingles of an ad library: sorted shingle keys, and the ad and offset of each of them.
+    Offsets are in phases, i.e. offset o is the shingle starting o / phases samples after the start of the ad.
+    """
+
+    def __init__(self, keys, posting_ads, posting_offsets, ad_lengths, hamming, phases=1, grid=FINGERPRINT_GRID,
+                 shingle=FINGERPRINT_SHINGLE):
+        self.keys = keys
+        self.posting_ads = posting_ads
+        self.posting_offsets = posting_offsets
+        self.ad_lengths = numpy.asarray(ad_lengths, dtype=numpy.int64)
+        self.hamming = hamming
+        self.phases = phases
+        self.grid = grid
+        self.shingle = shingle
+
+    @classmethod
+    def build(cls, ads_phases, hamming=False, grid=FINGERPRINT_GRID, shingle=FINGERPRINT_SHINGLE,
+              max_postings=FINGERPRINT_MAX_POSTINGS):
+        """
+        Index the shingles of every phase of every ad
+        :param ads_phases: For each ad, the features of each of its phases (shape: [ad_no, phases, sampled_frames,
+            features]); phase p of an ad holds the samples at n / sps + p / (sps * phases) seconds
+        :param hamming: Flag indicating the features are bit-packed
+        :param grid: Blocks per side of the frame codes
+        :param shingle: Consecutive codes of each shingle
+        :param max_postings: Shingles found at more (ad, offset) pairs are left out
+        :return: FingerprintIndex
+        """
+        if shingle * grid * grid > 64:
+            raise ValueError("a shingle of {} codes of {} bits doesn't fit in 64 bits".format(shingle, grid * grid))
+        phases = len(ads_phases[0])
+        keys, posting_ads, posting_offsets, ad_lengths = [], [], [], []
+        for ad_idx, ad_phases in enumerate(ads_phases):
+            ad_lengths.append(len(ad_phases[0]))
+            for phase, features in enumerate(ad_phases):
+                phase_keys = shingle_keys(frame_codes(features, hamming, grid)[0], shingle, grid)
+                keys.append(phase_keys)
+                posting_ads.append(numpy.full(len(phase_keys), ad_idx, dtype=numpy.int32))
+                posting_offsets.append(numpy.arange(len(phase_keys), dtype=numpy.int32) * phases + phase)
+        keys, posting_ads, posting_offsets = (numpy.concatenate(arrays) for arrays in
+                                              (keys, posting_ads, posting_offsets))
+        order = numpy.argsort(keys, kind='stable')
+        keys, posting_ads, posting_offsets = keys[order], posting_ads[order], posting_offsets[order]
+
+        _, counts = numpy.unique(keys, return_counts=True)
+        kept = numpy.repeat(counts <= max_postings, counts)
+        print("info: fingerprint index built with {} postings of {} shingles, {} stop-shingles left out".format(
+            kept.sum(), (counts <= max_postings).sum(), (counts > max_postings).sum()))
+        return cls(keys[kept], posting_ads[kept], posting_offsets[kept], ad_lengths, hamming, phases, grid,
+                   shingle)
+
+    def hits(self, video_features, probe_bits=FINGERPRINT_PROBE_BITS):
+        """
+        Look up the shingles of a video, and of its probes
+        :param video_features: Features of each frame of the video (shape: [sampled_frames, features])
+        :param probe_bits: Least confident bits of each code flipped, one at a time, to build the probes
+        :return: Tuple (video_frame_idx, ad_idx, offset) of each posting found, once per video shingle; frame
+            indexes are those of the first sample of the shingles, and offsets in phases
+        """
+        codes, confidence = frame_codes(video_features, self.hamming, self.grid)
+        queries = probe_keys(probe_codes(codes, confidence, probe_bits), self.shingle, self.grid)
+        flat_queries = queries.ravel()
+        first = numpy.searchsorted(self.keys, flat_queries, side='left')
+        counts = numpy.searchsorted(self.keys, flat_queries, side='right') - first
+        METRICS.count("fingerprint_lookups", flat_queries.size)
+        METRICS.count("fingerprint_postings", counts.sum())
+
+        postings = numpy.repeat(first, counts) + numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) -
+                                                                                          counts, counts)
+        video_frame_idx = numpy.repeat(numpy.arange(flat_queries.size) // max(1, queries.shape[1]), counts)
+        # a shingle finding the same posting through several probes votes once
+        found = numpy.unique(numpy.stack((video_frame_idx, self.posting_ads[postings].astype(numpy.int64),
+                                          self.posting_offsets[postings].astype(numpy.int64))), axis=1)
+        return found[0], found[1], found[2]
+
+    def detect(self, video_features, timestamps=None, score_threshold=FINGERPRINT_SCORE_THRESHOLD):
+        """
+        Identify ad appearances in a video by offset voting: each video shingle votes once for each ad starting at
+        its frame minus the offset of a posting found, rounded to the nearest frame, and the votes are divided by
+        the shingles of the ad. Only the starting frames voted are scored, so memory doesn't depend on the size of
+        the library.
+        :param video_features: Features of each frame of the video (shape: [sampled_frames, features])
+        :param timestamps: Optional time in seconds of each sampled frame of the video
+        :param score_threshold: Minimum fraction of the shingles of an ad matched at the same offset
+        :return: List of detections, sorted by starting frame, as video_tools.ads_detector
+        """
+        with METRICS.timer("fingerprint_lookup"):
+            video_frame_idx, ad_idx, offsets = self.hits(video_features)
+
+        with METRICS.timer("ads_detector"):
+            # in phases, rounded half up to frames
+            starting_frame_idx = (video_frame_idx * self.phases - offsets + self.phases // 2) // self.phases
+            valid = starting_frame_idx >= 0
+            frames = max(1, len(video_features))
+            # several phases of a static shot may vote for the same start
+            votes_cast, first_vote = numpy.unique(numpy.stack((ad_idx * frames + starting_frame_idx,
+                                                               video_frame_idx))[:, valid], axis=1,
+                                                  return_index=True)
+            candidates, inverse, votes = numpy.unique(votes_cast[0], return_inverse=True, return_counts=True)
+            # last ad frame of the last shingle matched
+            last_offsets = numpy.zeros(len(candidates), dtype=numpy.int64)
+            numpy.maximum.at(last_offsets, inverse, offsets[valid][first_vote] // self.phases + self.shingle - 1)
+            candidate_ads, candidate_frames = candidates // frames, candidates % frames
+            shingles = numpy.maximum(1, self.ad_lengths - self.shingle + 1)
+            scores = votes / shingles[candidate_ads]
+            METRICS.count("candidates_scored", len(candidates))
+            METRICS.observe("score", scores, SCORE_HISTOGRAM)
+
+            ad_matching_list = []
+            for candidate in numpy.flatnonzero(scores > score_threshold):
+                ad = candidate_ads[candidate]
+                ad_matching_list.append({'ad_idx': int(ad),
+                                         'ad_length_in_frames': int(min(last_offsets[candidate],
+                                                                        self.ad_lengths[ad] - 1)),
+                                         'score': float(scores[candidate]),
+                                         'starting_frame': int(candidate_frames[candidate]),
+                                         })
+                if timestamps is not None:
+                    ad_matching_list[-1]['starting_second'] = round(
+                        float(timestamps[candidate_frames[candidate]]), 3)
+            METRICS.observe("passed_score", [detection['score'] for detection in ad_matching_list],
+                            SCORE_HISTOGRAM)
+        return sorted(ad_matching_list, key=lambda dic: dic['starting_frame'])
+
+    def to_arrays(self):
+        return {'keys': self.keys, 'posting_ads': self.posting_ads, 'posting_offsets': self.posting_offsets}
+
+    def tables(self):
+        """
+        Arrays needed to rebuild the index with from_arrays, other than those of to_arrays
+        """
+        return {'ad_lengths': self.ad_lengths, 'hamming': numpy.asarray(self.hamming),
+                'phases': numpy.asarray(self.phases), 'grid': numpy.asarray(self.grid),
+                'shingle': numpy.asarray(self.shingle)}
+
+    @classmethod
+    def from_arrays(cls, arrays, tables):
+        return cls(arrays['keys'], arrays['posting_ads'], arrays['posting_offsets'], tables['ad_lengths'],
+                   bool(tables['hamming']), int(tables['phases']), int(tables['grid']), int(tables['shingle']))
+
+
+def frame_codes(features, hamming=False, grid=FINGERPRINT_GRID):
+    """
+    Perceptual code of each frame: bit b is set when block b of the edge map has more edges than the median block
+    :param features: SOBEL_THRESH_PACKED (with hamming) or SOBEL_THRESH_BINARY features (shape: [frames, features])
+    :param hamming: Flag indicating the features are bit-packed
+    :param grid: Blocks per side of the edge map
+    :return: Tuple (codes, confidence): uint64 code of each frame, and the distance of each block to the median
+        block (shape: [frames, grid * grid]), small values marking the bits most likely to flip
+    """
+    width, height = SAMPLING_DIMENSIONS
+    features = numpy.asarray(features)
+    features = features.reshape(features.shape[0], -1)
+    if hamming:
+        edges = numpy.unpackbits(features.astype(numpy.uint8), axis=1)[:, :width * height]
+    else:
+        edges = features > 0
+    blocks = edges.reshape(-1, grid, height // grid, grid, width // grid).sum(axis=(2, 4), dtype=numpy.int32)
+    blocks = blocks.reshape(blocks.shape[0], -1)
+    median = numpy.median(blocks, axis=1, keepdims=True)
+    weights = numpy.uint64(1) << numpy.arange(grid * grid, dtype=numpy.uint64)
+    codes = ((blocks > median) * weights).sum(axis=1, dtype=numpy.uint64)
+    return codes, numpy.abs(blocks - median)
+
+
+def probe_codes(codes, confidence, probe_bits=FINGERPRINT_PROBE_BITS):
+    """
+    Each code, followed by the code with each of its probe_bits least confident bits flipped
+    :return: uint64 array with shape [frames, 1 + probe_bits]
+    """
+    least_confident = numpy.argsort(confidence, axis=1, kind='stable')[:, :probe_bits].astype(numpy.uint64)
+    return numpy.concatenate((codes[:, None], codes[:, None] ^ (numpy.uint64(1) << least_confident)), axis=1)
+
+
+def shingle_keys(codes, shingle=FINGERPRINT_SHINGLE, grid=FINGERPRINT_GRID):
+    """
+    Key of each shingle of consecutive codes, the codes of its samples side by side
+    :return: uint64 array with the key of the shingle starting at each sample that has shingle - 1 samples after it
+    """
+    return probe_keys(numpy.asarray(codes, dtype=numpy.uint64)[:, None], shingle, grid)[:, 0]
+
+
+def probe_keys(variants, shingle=FINGERPRINT_SHINGLE, grid=FINGERPRINT_GRID):
+    """
+    Keys of every combination of the variants of the codes of each shingle
+    :param variants: Variants of the code of each sample, see probe_codes (shape: [frames, variants])
+    :return: uint64 array with shape [shingles, variants ** shingle]
+    """
+    shingles = max(0, len(variants) - shingle + 1)
+    combinations = list(product(range(variants.shape[1]), repeat=shingle))
+    keys = numpy.zeros((shingles, len(combinations)), dtype=numpy.uint64)
+    for column, combination in enumerate(combinations):
+        for position, variant in enumerate(combination):
+            keys[:, column] |= variants[position:position + shingles, variant] << numpy.uint64(position * grid * grid)
+    return keys
+
+
+def load_or_build_fingerprints(ads_foldername, ft_type=FeatureType.SOBEL_THRESH_PACKED, phases=FINGERPRINT_PHASES,
+                               workers=1):
+    """
+    Load the fingerprint index of an ad folder from cache, building and caching it if it isn't available. The ads
+    are sampled at phases times SAMPLES_PER_SECOND, and their features cached as a library of their own.
+    The index is opened memory-mapped, so only the pages of the shingles looked up are read.
+    :param ads_foldername: Ad video-clip folder in DATA_FOLDER
+    :param ft_type: SOBEL_THRESH_PACKED or SOBEL_THRESH_BINARY
+    :param phases: Phases of the sampling period indexed
+    :param workers: Amount of processes extracting different ads at the same time
+    :return: Tuple (FingerprintIndex, ad_video_names)
+    """
+    if ft_type not in (FeatureType.SOBEL_THRESH_PACKED, FeatureType.SOBEL_THRESH_BINARY):
+        raise ValueError("fingerprints are computed from SOBEL_THRESH features, not {}".format(ft_type.name))
+    hamming = ft_type == FeatureType.SOBEL_THRESH_PACKED
+    print("info: Extracting (or loading cached) {} folder features at {} phases".format(ads_foldername, phases))
+    dense_features, ad_video_names = extract_features_from_video_folder(
+        ads_foldername, sps=SAMPLES_PER_SECOND * phases, ft_type=ft_type, workers=workers)
+    cache_key = cache_manager.cache_key(dense_features.key, phases, FINGERPRINT_GRID, FINGERPRINT_SHINGLE,
+                                        FINGERPRINT_MAX_POSTINGS)
+
+    tables = cache_manager.load_arrays("library", cache_key + "_tables")
+    arrays = {name: cache_manager.load("library", cache_key + "_" + name, mmap_mode='r')
+              for name in ('keys', 'posting_ads', 'posting_offsets')}
+    if tables is not None and all(array is not None for array in arrays.values()):
+        print("info: loading fingerprint index from cache")
+        return FingerprintIndex.from_arrays(arrays, tables), ad_video_names
+
+    with METRICS.timer("fingerprint_index_build"):
+        index = FingerprintIndex.build([[ad_features[phase::phases] for phase in range(phases)]
+                                        for ad_features in dense_features], hamming)
+    with cache_manager.batch_writes():
+        for name, array in index.to_arrays().items():
+            cache_manager.save("library", cache_key + "_" + name, array)
+        cache_manager.save_arrays("library", cache_key + "_tables", **index.tables())
+    return index, ad_video_names
+
+
+def lookup_report(index, video_features, ad_video_names, repeat=3):
+    """
+    Print the size of the index, the lookup time per video sample and the detections
+    :param index: FingerprintIndex to be evaluated
+    :param video_features: Features of the video (shape: [sampled_frames, features])
+    :param ad_video_names: Name of each ad of the index
+    :param repeat: Lookups timed; the fastest is reported
+    :return: Dict with postings, lookup seconds per sample and detections
+    """
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        index.hits(video_features)
+        seconds.append(time.perf_counter() - start)
+    per_sample = min(seconds) / max(1, len(video_features))
+    detections = index.detect(video_features)
+    print("ads\tpostings\tus/sample")
+    print("{}\t{}\t{:.1f}".format(len(index.ad_lengths), len(index.keys), per_sample * 1e6))
+    for detection in detections:
+        print("{}\t{:.2f}\t{}".format(ad_video_names[detection['ad_idx']], detection['score'],
+                                      detection['starting_frame'] / SAMPLES_PER_SECOND))
+    return {'postings': len(index.keys), 'seconds_per_sample': per_sample, 'detections': detections}
+
+
+if __name__ == '__main__':
+    from src import feature_extraction
+
+    if len(sys.argv) != 3:
+        raise AttributeError("Script receives 2 parameters: \"full-length video filename\" "
+                             "and \"ad video-clip folder\"")
+    ft_type = FeatureType.SOBEL_THRESH_PACKED
+    video_features = feature_extraction.extract_features_from_video(sys.argv[1], ft_type=ft_type)
+    fingerprints, names = load_or_build_fingerprints(sys.argv[2], ft_type)
+    lookup_report(fingerprints, video_features, names)
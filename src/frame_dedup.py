@@ -0,0 +1,289 @@
+"""
+Deduplication of the frames of an ad library, and stop-frame filtering.
+
+Commercials share near-identical frames: black frames, fades, brand end cards and legal text. The frames of the
+whole library are clustered in order: each frame joins the nearest representative within DEDUP_MAX_DISTANCE or
+becomes a representative itself, so the KNN searches one frame per cluster. A hit on a representative votes for
+every (ad, frame) it stands for, with the rank of the representative, so sequences are still scored over every ad
+frame and duplicates no longer crowd the top k.
+
+Representatives with little information can be marked as stop-frames: those with less than
+STOP_FRAME_MIN_INFORMATION of their feature values set (black frames, fades), and those standing for frames of more
+than STOP_FRAME_MAX_ADS ads (end cards of a brand), which vote for all of them alike. Stop-frames are not searched,
+so they cast no votes; scores are still divided by the whole ad length, which keeps SCORE_THRESHOLD calibrated as
+without deduplication (dividing by the frames left would scale the noise of every ad up as much as its matches).
+
+Usage (library reduction and KNN time report):
+$ python -m src.frame_dedup "full-length video filename" "ad video-clip folder"
+"""
+import sys
+import time
+
+import numpy
+
+from src import cache_manager
+from src.ad_library import AdLibrary
+from src.metrics import METRICS
+from src.configurations import K, KNN_BLOCK_SIZE, ANN_NPROBE, DEDUP_MAX_DISTANCE, STOP_FRAME_MIN_INFORMATION, \
+    STOP_FRAME_MAX_ADS
+from src.video_tools import knn_search, hamming_knn_search, flatten_ads_features
+
+# largest feature value, 255 for every unpacked feature type, so distances can be normalized
+FEATURE_RANGE = 255.0
+
+
+class DedupedAds:
+    """
+    Representative frames of an ad library, the (ad, frame) pairs each of them stands for, and its stop-frames.
+    """
+
+    def __init__(self, flattened_ads, representative_rows, assignment, stop):
+        """
+        :param flattened_ads: Ad frames as returned by flatten_ads_features
+        :param representative_rows: Row of ads_matrix kept for each representative
+        :param assignment: Representative of each row of ads_matrix
+        :param stop: Flag of each representative marking it as a stop-frame
+        """
+        ads_matrix, row_ad_idx, row_frame_idx = flattened_ads
+        self.representative_rows = representative_rows
+        self.assignment = assignment
+        self.stop = stop
+        self.representatives = ads_matrix[representative_rows]
+        self.searched = numpy.flatnonzero(~stop)
+        self.searched_matrix = self.representatives[self.searched]
+
+        # members of each representative, contiguous and in library order
+        members = numpy.argsort(assignment, kind='stable')
+        self.member_offsets = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(
+            assignment, minlength=len(representative_rows)))))
+        self.member_ad_idx = row_ad_idx[members]
+        self.member_frame_idx = row_frame_idx[members]
+
+    def search(self, video_features, k=K, block_size=KNN_BLOCK_SIZE, hamming=False, index=None, nprobe=ANN_NPROBE):
+        """
+        KNN of each video frame against the representatives that aren't stop-frames
+        :param video_features: Features of each frame of the video (shape: [sampled_frames, features])
+        :param k: k of the KNN
+        :param block_size: Number of video frames compared at once
+        :param hamming: Flag to compare bit-packed features by Hamming distance
+        :param index: Optional ann_index.IVFIndex or projection.ProjectionIndex built over searched_matrix
+        :param nprobe: Amount of index lists probed per video frame
+        :return: Representative of each neighbor (shape: [video_frame, i_nearest_neighbor]), nearest first
+        """
+        if index is not None:
+            columns, _ = index.search(video_features, k, nprobe, block_size)
+        else:
+            search = hamming_knn_search if hamming else knn_search
+            columns, _ = search(video_features, self.searched_matrix, k, block_size)
+        return self.searched[columns]
+
+    def hits(self, representative_knn):
+        """
+        Hits of every (ad, frame) the neighbors stand for, each with the rank of its representative
+        :param representative_knn: Representatives of each video frame, as returned by search
+        :return: Tuple (video_frame_idx, ad_idx, ad_frame_idx, rank), ordered by video frame and then by rank, as
+            video_tools.knn_hits
+        """
+        frames, k = representative_knn.shape
+        representatives = representative_knn.ravel()
+        counts = numpy.diff(self.member_offsets)[representatives]
+        # position of each hit among the members of its representative
+        first_hit = numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        members = numpy.repeat(self.member_offsets[representatives], counts) + numpy.arange(counts.sum()) - first_hit
+        return (numpy.repeat(numpy.repeat(numpy.arange(frames), k), counts), self.member_ad_idx[members],
+                self.member_frame_idx[members], numpy.repeat(numpy.tile(numpy.arange(1, k + 1), frames), counts))
+
+    def to_arrays(self):
+        """
+        Arrays needed to rebuild the deduplication with from_arrays, other than the ad library
+        """
+        return {'representative_rows': self.representative_rows, 'assignment': self.assignment, 'stop': self.stop}
+
+    @classmethod
+    def from_arrays(cls, arrays, flattened_ads):
+        return cls(flattened_ads, arrays['representative_rows'], arrays['assignment'], arrays['stop'])
+
+
+def deduplicate(ads_features, hamming=False, max_distance=DEDUP_MAX_DISTANCE,
+                min_information=STOP_FRAME_MIN_INFORMATION, max_ads=STOP_FRAME_MAX_ADS, block_size=KNN_BLOCK_SIZE):
+    """
+    Cluster the near-duplicate frames of an ad library and mark its stop-frames
+    :param ads_features: Features of each frame, of each ad (shape: [ad_no, sampled_frames, features])
+    :param hamming: Flag indicating ads_features holds bit-packed features
+    :param max_distance: Largest normalized distance between a frame and its representative, see
+        normalized_distance_scale
+    :param min_information: Representatives with a smaller fraction of non zero feature values (bits, for packed
+        features) are stop-frames; None to disable
+    :param max_ads: Representatives standing for frames of more ads are stop-frames; None to disable
+    :param block_size: Number of frames compared at once against the representatives
+    :return: DedupedAds
+    """
+    flattened_ads = flatten_ads_features(ads_features)
+    ads_matrix, row_ad_idx, _ = flattened_ads
+    representative_rows, assignment = cluster_frames(ads_matrix, hamming, max_distance, block_size)
+    stop = numpy.zeros(len(representative_rows), dtype=bool)
+    if min_information is not None:
+        stop |= information(numpy.asarray(ads_matrix[representative_rows]), hamming) < min_information
+    if max_ads is not None:
+        ads = len(ads_features)
+        representative_ads = numpy.unique(assignment * ads + row_ad_idx) // ads
+        stop |= numpy.bincount(representative_ads, minlength=len(representative_rows)) > max_ads
+    print("info: {} ad frames deduplicated to {} representatives, {} of them stop-frames".format(
+        ads_matrix.shape[0], len(representative_rows), int(stop.sum())))
+    return DedupedAds(flattened_ads, representative_rows, assignment, stop)
+
+
+def cluster_frames(ads_matrix, hamming=False, max_distance=DEDUP_MAX_DISTANCE, block_size=KNN_BLOCK_SIZE):
+    """
+    Leader clustering of the rows of ads_matrix, in order: a row joins its nearest representative if it is within
+    max_distance, and becomes a new representative otherwise. Unlike linking every pair within max_distance, frames
+    that drift slowly (e.g. a fade) can't chain dissimilar frames into one cluster.
+    :param ads_matrix: Features of every ad frame (shape: [total_ad_frames, features])
+    :param hamming: Flag indicating ads_matrix holds bit-packed features
+    :param max_distance: Largest normalized distance between a frame and its representative
+    :param block_size: Number of rows compared at once against the representatives found so far
+    :return: Tuple (representative_rows, assignment): the row of each representative and the representative of
+        each row
+    """
+    search = hamming_knn_search if hamming else knn_search
+    ads_matrix = numpy.asarray(ads_matrix)
+    ads_matrix = ads_matrix.reshape(ads_matrix.shape[0], -1)
+    threshold = max_distance * normalized_distance_scale(ads_matrix.shape[1], hamming)
+
+    assignment = numpy.empty(ads_matrix.shape[0], dtype=numpy.int64)
+    representative_rows = []
+    # features of the representatives found so far, appended to as they are found and grown by doubling, so blocks
+    # search a view of them instead of a copy of every representative; float64, as knn_search compares them
+    dtype = ads_matrix.dtype if hamming else numpy.float64
+    representatives = numpy.empty((min(ads_matrix.shape[0], block_size),) + ads_matrix.shape[1:], dtype)
+    for block_start in range(0, ads_matrix.shape[0], block_size):
+        block = ads_matrix[block_start:block_start + block_size]
+        if representative_rows:
+            nearest, nearest_distances = search(block, representatives[:len(representative_rows)], 1)
+            nearest, nearest_distances = nearest[:, 0], nearest_distances[:, 0].astype(numpy.float64)
+        else:
+            nearest = numpy.full(block.shape[0], -1)
+            nearest_distances = numpy.full(block.shape[0], numpy.inf)
+        # distances between rows of the block, for the representatives found within it
+        columns, distances = search(block, block, block.shape[0])
+        block_distances = numpy.empty(columns.shape)
+        numpy.put_along_axis(block_distances, columns, distances, axis=1)
+
+        first_block_representative = len(representative_rows)
+        block_representatives = []
+        for row in range(block.shape[0]):
+            representative, distance = nearest[row], nearest_distances[row]
+            if block_representatives:
+                block_nearest = numpy.argmin(block_distances[row, block_representatives])
+                if block_distances[row, block_representatives[block_nearest]] < distance:
+                    representative = first_block_representative + block_nearest
+                    distance = block_distances[row, block_representatives[block_nearest]]
+            if distance > threshold:
+                representative = len(representative_rows)
+                representative_rows.append(block_start + row)
+                block_representatives.append(row)
+            assignment[block_start + row] = representative
+        if len(representative_rows) > representatives.shape[0]:
+            grown = numpy.empty((min(ads_matrix.shape[0], 2 * len(representative_rows)),) + ads_matrix.shape[1:],
+                                dtype)
+            grown[:first_block_representative] = representatives[:first_block_representative]
+            representatives = grown
+        representatives[first_block_representative:len(representative_rows)] = block[block_representatives]
+    return numpy.asarray(representative_rows, dtype=numpy.int64), assignment
+
+
+def normalized_distance_scale(features, hamming=False):
+    """
+    Distance between two frames with every feature value at opposite ends of its range, so distances divided by it
+    are the fraction of differing bits of thresholded features (packed or not), and comparable across feature types
+    :param features: Amount of features (packed bytes, for bit-packed features)
+    :param hamming: Flag indicating bit-packed features, compared by Hamming distance
+    :return: Largest distance, in the units of knn_search (squared euclidean) or hamming_knn_search (bits)
+    """
+    if hamming:
+        return 8.0 * features
+    return features * FEATURE_RANGE ** 2
+
+
+def information(features, hamming=False):
+    """
+    Fraction of non zero feature values (set bits, for bit-packed features) of each frame; edge features of black
+    frames, fades and plain backgrounds are almost empty
+    :param features: Features of each frame (shape: [frames, features])
+    :param hamming: Flag indicating bit-packed features
+    :return: Array with the information of each frame
+    """
+    features = numpy.asarray(features)
+    features = features.reshape(features.shape[0], -1)
+    if hamming:
+        return numpy.unpackbits(features, axis=1).mean(axis=1)
+    return numpy.count_nonzero(features, axis=1) / float(features.shape[1])
+
+
+def load_or_build_dedup(ads_features, hamming=False, max_distance=DEDUP_MAX_DISTANCE,
+                        min_information=STOP_FRAME_MIN_INFORMATION, max_ads=STOP_FRAME_MAX_ADS, use_cache=True):
+    """
+    Load the deduplication of an ad library from cache, building and caching it if it isn't available.
+    The cache is keyed by the content of the library, so it is rebuilt whenever the library changes.
+    :param ads_features: Features of each frame, of each ad, or an AdLibrary
+    :param hamming: Flag indicating ads_features holds bit-packed features
+    :param max_distance: Largest normalized distance between a frame and its representative
+    :param min_information: Information below which representatives are stop-frames; None to disable
+    :param max_ads: Ads above which representatives are stop-frames; None to disable
+    :param use_cache: Flag to use cached version if available
+    :return: DedupedAds
+    """
+    library_key = ads_features.key if isinstance(ads_features, AdLibrary) else cache_manager.array_digest(ads_features)
+    cache_key = cache_manager.cache_key("dedup", library_key, hamming, max_distance, min_information, max_ads)
+    if use_cache:
+        stored = cache_manager.load_arrays("features", cache_key)
+        if stored is not None:
+            print("info: loading ad frame deduplication from cache")
+            return DedupedAds.from_arrays(stored, flatten_ads_features(ads_features))
+
+    with METRICS.timer("dedup_build"):
+        deduped = deduplicate(ads_features, hamming, max_distance, min_information, max_ads)
+    cache_manager.save_arrays("features", cache_key, **deduped.to_arrays())
+    return deduped
+
+
+def dedup_report(deduped, ads_features, video_features, k=K, hamming=False):
+    """
+    Compare the KNN over the representatives against the KNN over every ad frame, and print the results.
+    :param deduped: DedupedAds of ads_features
+    :param ads_features: Features of each frame, of each ad
+    :param video_features: Features of the query frames (shape: [sampled_frames, features])
+    :param k: k of the KNN
+    :param hamming: Flag indicating bit-packed features
+    :return: Dict with the amount of ad frames, representatives, stop-frames and searched frames, and the seconds
+        of both searches
+    """
+    search = hamming_knn_search if hamming else knn_search
+    ads_matrix = flatten_ads_features(ads_features)[0]
+    start = time.time()
+    search(video_features, ads_matrix, k)
+    full_seconds = time.time() - start
+    start = time.time()
+    deduped.hits(deduped.search(video_features, k, hamming=hamming))
+    deduped_seconds = time.time() - start
+
+    report = {'ad_frames': int(ads_matrix.shape[0]), 'representatives': len(deduped.representative_rows),
+              'stop_frames': int(deduped.stop.sum()), 'searched': len(deduped.searched),
+              'full_seconds': full_seconds, 'deduped_seconds': deduped_seconds}
+    print("ad frames\trepresentatives\tstop-frames\tsearched\tfull knn s\tdeduped knn s")
+    print("{ad_frames}\t{representatives}\t{stop_frames}\t{searched}\t{full_seconds:.3f}\t{deduped_seconds:.3f}".format(
+        **report))
+    return report
+
+
+if __name__ == '__main__':
+    from src import feature_extraction
+    from src.feature_extraction import FeatureType
+
+    if len(sys.argv) != 3:
+        raise AttributeError("Script receives 2 parameters: \"full-length video filename\" "
+                             "and \"ad video-clip folder\"")
+    ft_type = FeatureType.SOBEL_THRESH_PACKED
+    video_features = feature_extraction.extract_features_from_video(sys.argv[1], ft_type=ft_type)
+    ads_features, _ = feature_extraction.extract_features_from_video_folder(sys.argv[2], ft_type=ft_type)
+    dedup_report(load_or_build_dedup(ads_features, hamming=True), ads_features, video_features, hamming=True)
@@ -0,0 +1,210 @@
+"""
+Instrumentation of the pipeline: counters, running statistics, histograms, stage timers and live progress.
+
+Everything is recorded in METRICS, the registry of the current process, in constant memory and at the cost of a
+few numpy operations per batch of values, so it can stay on in production. The registry can be exported as a JSON
+report. Worker processes have their own registry, which can be sent back and merged into the parent's.
+"""
+import json
+import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy
+
+PROGRESS_INTERVAL_SECONDS = 5
+
+
+class RunningStats:
+    """
+    Count, mean, variance, min and max of a stream of values, updated in batches with Welford's algorithm
+    (merging the statistics of each batch as Chan et al.), without keeping the values.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def update(self, values):
+        values = numpy.asarray(values, dtype=numpy.float64).ravel()
+        if not values.size:
+            return
+        batch_mean = values.mean()
+        batch_m2 = numpy.square(values - batch_mean).sum()
+        count = self.count + values.size
+        delta = batch_mean - self.mean
+        self.mean += delta * values.size / count
+        self.m2 += batch_m2 + delta * delta * self.count * values.size / count
+        self.count = count
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+    def merge(self, other):
+        """
+        Add the values summarized by another RunningStats, e.g. recorded in another process
+        """
+        if not other.count:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def variance(self):
+        return self.m2 / self.count if self.count else 0.0
+
+    def report(self):
+        return OrderedDict([('count', self.count), ('mean', float(self.mean)),
+                            ('std', float(numpy.sqrt(self.variance))),
+                            ('min', self.min if self.count else None), ('max', self.max if self.count else None)])
+
+
+class Histogram:
+    """
+    Counts of a stream of values over fixed bins; values out of range are counted as underflow or overflow.
+    """
+
+    def __init__(self, low=0.0, high=1.0, bins=20):
+        self.edges = numpy.linspace(low, high, bins + 1)
+        self.counts = numpy.zeros(bins, dtype=numpy.int64)
+        self.underflow = 0
+        self.overflow = 0
+
+    def update(self, values):
+        values = numpy.asarray(values, dtype=numpy.float64).ravel()
+        self.counts += numpy.histogram(values, self.edges)[0]
+        self.underflow += int((values < self.edges[0]).sum())
+        self.overflow += int((values > self.edges[-1]).sum())
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+
+    def report(self):
+        return OrderedDict([('edges', self.edges.tolist()), ('counts', self.counts.tolist()),
+                            ('underflow', self.underflow), ('overflow', self.overflow)])
+
+
+class Progress:
+    """
+    Live progress of a stage, printed at most every PROGRESS_INTERVAL_SECONDS, with rate and ETA.
+    """
+
+    def __init__(self, label, total=None, unit="frames", enabled=True):
+        self.label = label
+        self.total = total
+        self.unit = unit
+        self.enabled = enabled
+        self.done = 0
+        self.start = time.time()
+        self.last_print = self.start
+
+    def update(self, amount=1):
+        self.done += amount
+        if not self.enabled:
+            return
+        now = time.time()
+        if now - self.last_print < PROGRESS_INTERVAL_SECONDS:
+            return
+        self.last_print = now
+        rate = self.done / (now - self.start)
+        message = "progress: {} {} {}, {:.1f} {}/s".format(self.label, self.done, self.unit, rate, self.unit)
+        if self.total and rate:
+            message += ", {:.0f}% done, ETA {:.0f}s".format(100.0 * self.done / self.total,
+                                                          max(0, self.total - self.done) / rate)
+        print(message, file=sys.stderr)
+
+
+class Metrics:
+    """
+    Registry of the counters, statistics, histograms and timers of a process.
+    """
+
+    def __init__(self):
+        self.counters = OrderedDict()
+        self.stats = OrderedDict()
+        self.histograms = OrderedDict()
+        self.timers = OrderedDict()
+        self.show_progress = False
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + int(amount)
+
+    def observe(self, name, values, histogram=None):
+        """
+        Add values to the running statistics of name, and to its histogram if a (low, high, bins) range is given
+        """
+        self.stats.setdefault(name, RunningStats()).update(values)
+        if histogram is not None:
+            self.histograms.setdefault(name, Histogram(*histogram)).update(values)
+
+    @contextmanager
+    def timer(self, name):
+        """
+        Context manager accumulating the wall-clock seconds and calls of a stage
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds, calls=1):
+        """
+        Accumulate time measured by the caller, e.g. by generators that mustn't time their consumers
+        """
+        timer = self.timers.setdefault(name, OrderedDict([('seconds', 0.0), ('calls', 0)]))
+        timer['seconds'] += seconds
+        timer['calls'] += calls
+
+    def progress(self, label, total=None, unit="frames"):
+        return Progress(label, total, unit, enabled=self.show_progress)
+
+    def merge(self, other):
+        """
+        Add everything recorded by another registry, e.g. the METRICS of a worker process
+        """
+        for name, amount in other.counters.items():
+            self.count(name, amount)
+        for name, timer in other.timers.items():
+            self.add_time(name, timer['seconds'], timer['calls'])
+        for name, stats in other.stats.items():
+            self.stats.setdefault(name, RunningStats()).merge(stats)
+        for name, histogram in other.histograms.items():
+            if name in self.histograms:
+                self.histograms[name].merge(histogram)
+            else:
+                self.histograms[name] = histogram
+
+    def report(self):
+        return OrderedDict([
+            ('counters', self.counters),
+            ('timers', self.timers),
+            ('stats', OrderedDict((name, stats.report()) for name, stats in self.stats.items())),
+            ('histograms', OrderedDict((name, histogram.report()) for name, histogram in self.histograms.items())),
+        ])
+
+    def write_report(self, path):
+        with open(path, 'w') as fp:
+            json.dump(self.report(), fp, indent=1)
+        print("info: metrics report written to {}".format(path))
+
+    def reset(self):
+        """
+        Drop everything recorded so far, keeping the progress setting
+        """
+        show_progress = self.show_progress
+        self.__init__()
+        self.show_progress = show_progress
+
+
+METRICS = Metrics()
@@ -0,0 +1,269 @@
+"""
+Online ad detection, one video frame at a time, with temporal non-maximum suppression.
+
+Votes of each ad are kept in a ring buffer with one slot per starting frame that can still receive hits, so ad
+lengths, and not the broadcast length, bound memory. The score of a starting frame is final once the last frame of
+the ad starting there has been pushed, which is when ads_detector would have scored it, with the same votes.
+
+Candidates above SCORE_THRESHOLD whose ad intervals overlap more than NMS_MAX_OVERLAP of the shorter one are the same
+airing (or two ads that can't air at once). Candidates chained by overlaps form a window, which closes once no
+candidate that could overlap it is left to close, max(ad_lengths) - 1 frames after its last ad ends; then candidates
+are kept by decreasing score unless they overlap one already kept, as temporal_nms does over a whole video.
+A window of more than NMS_MAX_WINDOW candidates (e.g. back-to-back airings of similar ads) emits the detections
+it keeps that can't overlap later candidates, so memory doesn't grow with the length of the chain.
+"""
+from bisect import bisect_left, bisect_right
+
+import numpy
+
+from src.configurations import SCORE_THRESHOLD, NMS_MAX_OVERLAP, NMS_MAX_WINDOW, K
+from src.metrics import METRICS
+from src.video_tools import SCORE_HISTOGRAM, search_knn, flatten_ads_features, get_ad_lengths_in_frames
+
+
+class OnlineAdsDetector:
+    """
+    Incremental ads_detector fed with the KNN row of each video frame, emitting one event per airing.
+    """
+
+    def __init__(self, ad_lengths, score_threshold=SCORE_THRESHOLD, max_overlap=NMS_MAX_OVERLAP,
+                 max_window=NMS_MAX_WINDOW):
+        """
+        :param ad_lengths: List of frames sampled for each ad
+        :param score_threshold: Minimum score of a detection
+        :param max_overlap: Largest overlap, as a fraction of the shorter ad, between two events; None to emit every
+            candidate
+        :param max_window: Candidates of a window over which its final detections are emitted before it closes
+        """
+        self.ad_lengths = numpy.asarray(ad_lengths, dtype=numpy.int64)
+        self.max_length = int(self.ad_lengths.max())
+        self.score_threshold = score_threshold
+        self.max_overlap = max_overlap
+        self.max_window = max_window
+        self.frames = 0  # video frames pushed so far
+        # slot s % ad_length of each ad holds the starting frame s, while it can still receive hits
+        self.votes = numpy.zeros((len(ad_lengths), self.max_length))
+        self.matched_lengths = numpy.zeros((len(ad_lengths), self.max_length), dtype=numpy.int64)
+        self.timestamps = numpy.zeros(self.max_length)
+        self.has_timestamps = False
+        # windows still open, as dicts with their 'candidates', the 'end' of their last ad and their 'closing_frame'
+        self.windows = []
+
+    def push(self, ad_idx, ad_frame_idx, timestamp=None):
+        """
+        Add the KNN row of the next video frame
+        :param ad_idx: Ad index of each neighbor of the frame, nearest first
+        :param ad_frame_idx: Ad frame index of each neighbor of the frame
+        :param timestamp: Optional time in seconds of the frame; events then carry their 'starting_second'
+        :return: Events that became final, sorted by starting frame, as the detections of ads_detector
+        """
+        frame = self.frames
+        ad_idx = numpy.asarray(ad_idx)
+        ad_frame_idx = numpy.asarray(ad_frame_idx)
+        rank = numpy.arange(1, len(ad_idx) + 1)
+        starting_frame_idx = frame - ad_frame_idx
+        valid = starting_frame_idx >= 0
+        slots = (ad_idx[valid], starting_frame_idx[valid] % self.ad_lengths[ad_idx[valid]])
+        numpy.add.at(self.votes, slots, 1.0 / rank[valid])
+        numpy.maximum.at(self.matched_lengths, slots, ad_frame_idx[valid])
+        if timestamp is not None:
+            self.timestamps[frame % self.max_length] = timestamp
+        self.has_timestamps = timestamp is not None
+        self.frames += 1
+        # no later frame can vote for the sequence of each ad starting an ad length before this frame
+        self._close(frame - self.ad_lengths + 1)
+        return self._emit(frame)
+
+    def feed(self, knn, timestamps=None):
+        """
+        Add the KNN rows of the next video frames
+        :param knn: Tuple (knn_ad_idx, knn_frame_idx) of the next frames, as returned by batch_knn
+        :param timestamps: Optional time in seconds of each frame
+        :return: Events that became final
+        """
+        events = []
+        for row, (ad_idx, ad_frame_idx) in enumerate(zip(*knn)):
+            events += self.push(ad_idx, ad_frame_idx, None if timestamps is None else timestamps[row])
+        return events
+
+    def flush(self):
+        """
+        End of the video: every remaining starting frame is scored, and every window left is closed
+        :return: Remaining events, sorted by starting frame
+        """
+        for frame in range(self.frames, self.frames + self.max_length - 1):
+            starting_frame_idx = frame - self.ad_lengths + 1
+            # starting frames past the end of the video were never voted
+            starting_frame_idx[starting_frame_idx >= self.frames] = -1
+            self._close(starting_frame_idx)
+        events = []
+        for window in self.windows:
+            events += score_ordered_nms(window['candidates'], self.ad_lengths, self.max_overlap)
+        self._observe_latency(events, self.frames + self.max_length - 2)
+        self.windows = []
+        return sorted(events, key=lambda candidate: candidate['starting_frame'])
+
+    def _close(self, starting_frame_idx):
+        """
+        Score the given starting frame of each ad (negative for none), which can't receive more votes
+        """
+        ad_idx = numpy.flatnonzero(starting_frame_idx >= 0)
+        starting_frame_idx = starting_frame_idx[ad_idx]
+        slots = (ad_idx, starting_frame_idx % self.ad_lengths[ad_idx])
+        scores = self.votes[slots] / self.ad_lengths[ad_idx]
+        METRICS.count("candidates_scored", len(scores))
+        METRICS.observe("score", scores, SCORE_HISTOGRAM)
+        for candidate in numpy.flatnonzero(scores > self.score_threshold):
+            detection = {'ad_idx': int(ad_idx[candidate]),
+                         'ad_length_in_frames': int(self.matched_lengths[slots][candidate]),
+                         'score': float(scores[candidate]),
+                         'starting_frame': int(starting_frame_idx[candidate]),
+                         }
+            if self.has_timestamps:
+                detection['starting_second'] = round(float(
+                    self.timestamps[starting_frame_idx[candidate] % self.max_length]), 3)
+            METRICS.observe("passed_score", [detection['score']], SCORE_HISTOGRAM)
+            self._chain(detection)
+        self.votes[slots] = 0
+        self.matched_lengths[slots] = 0
+
+    def _chain(self, candidate):
+        """
+        Add a candidate to the window of the candidates it overlaps, merging the windows it chains
+        """
+        end = candidate['starting_frame'] + int(self.ad_lengths[candidate['ad_idx']])
+        window = {'candidates': [candidate], 'end': end, 'closing_frame': self._closing_frame(candidate)}
+        for chained in [chained for chained in self.windows if chained['end'] > candidate['starting_frame'] and any(
+                overlaps(candidate, detection, self.ad_lengths, self.max_overlap)
+                for detection in chained['candidates'])]:
+            self.windows.remove(chained)
+            window['candidates'] += chained['candidates']
+            window['end'] = max(window['end'], chained['end'])
+            window['closing_frame'] = max(window['closing_frame'], chained['closing_frame'])
+        self.windows.append(window)
+
+    def _closing_frame(self, candidate):
+        # starting frames that could overlap a candidate are closed max_length - 1 frames after its ad ends
+        return candidate['starting_frame'] + int(self.ad_lengths[candidate['ad_idx']]) + self.max_length - 2
+
+    def _emit(self, frame):
+        events = []
+        for window in list(self.windows):
+            if window['closing_frame'] <= frame:
+                self.windows.remove(window)
+                events += score_ordered_nms(window['candidates'], self.ad_lengths, self.max_overlap)
+            elif len(window['candidates']) > self.max_window:
+                events += self._emit_final(window, frame)
+        if events:
+            self._observe_latency(events, frame)
+        return sorted(events, key=lambda candidate: candidate['starting_frame'])
+
+    def _emit_final(self, window, frame):
+        """
+        Emit the detections a long window keeps that no later candidate can overlap, dropping the candidates they
+        suppress; the rest of the window stays open
+        """
+        final = [detection for detection in score_ordered_nms(window['candidates'], self.ad_lengths, self.max_overlap)
+                 if self._closing_frame(detection) <= frame]
+        window['candidates'] = [candidate for candidate in window['candidates']
+                                if self._closing_frame(candidate) > frame and not any(
+                                    overlaps(candidate, detection, self.ad_lengths, self.max_overlap)
+                                    for detection in final)]
+        if not window['candidates']:
+            self.windows.remove(window)
+        METRICS.count("nms_windows_split")
+        return final
+
+    def _observe_latency(self, events, frame):
+        METRICS.observe("event_latency_frames", [frame - (event['starting_frame'] +
+                                                          self.ad_lengths[event['ad_idx']] - 1)
+                                                 for event in events])
+
+
+def overlaps(detection, other, ad_lengths, max_overlap=NMS_MAX_OVERLAP):
+    """
+    Whether two detections overlap more than max_overlap of the shorter ad, i.e. are the same airing
+    :param detection: Detection, as ads_detector returns them
+    :param other: Detection
+    :param ad_lengths: List of frames sampled for each ad
+    :param max_overlap: Largest overlap, as a fraction of the shorter ad, between kept detections; None to keep all
+    :return: bool
+    """
+    if max_overlap is None:
+        return False
+    start, other_start = detection['starting_frame'], other['starting_frame']
+    length, other_length = ad_lengths[detection['ad_idx']], ad_lengths[other['ad_idx']]
+    overlap = min(start + length, other_start + other_length) - max(start, other_start)
+    return overlap > max_overlap * min(length, other_length)
+
+
+def score_ordered_nms(candidates, ad_lengths, max_overlap=NMS_MAX_OVERLAP):
+    """
+    Temporal non-maximum suppression: candidates are kept by decreasing score (then by starting frame and ad), unless
+    they overlap a detection already kept. A candidate suppressed by a higher scoring one doesn't suppress others,
+    so of three chained airings the first and the last are kept when the middle one scores below the last.
+    :param candidates: Detections, as ads_detector returns them
+    :param ad_lengths: List of frames sampled for each ad
+    :param max_overlap: Largest overlap, as a fraction of the shorter ad, between kept detections; None to keep all
+    :return: Kept detections, sorted by starting frame
+    """
+    max_length = int(numpy.max(ad_lengths)) if len(candidates) else 0
+    kept_starts, kept = [], []
+    for candidate in sorted(candidates, key=lambda candidate: (-candidate['score'], candidate['starting_frame'],
+                                                               candidate['ad_idx'])):
+        start = candidate['starting_frame']
+        # only detections starting less than an ad length before the candidate, or before it ends, can overlap it
+        first = bisect_left(kept_starts, start - max_length + 1)
+        last = bisect_left(kept_starts, start + ad_lengths[candidate['ad_idx']])
+        if any(overlaps(candidate, detection, ad_lengths, max_overlap) for detection in kept[first:last]):
+            continue
+        position = bisect_right(kept_starts, start)
+        kept_starts.insert(position, start)
+        kept.insert(position, candidate)
+    return kept
+
+
+def temporal_nms(detections, ad_lengths, max_overlap=NMS_MAX_OVERLAP):
+    """
+    Keep one detection per airing, as OnlineAdsDetector does, see score_ordered_nms
+    :param detections: Detections, as returned by ads_detector
+    :param ad_lengths: List of frames sampled for each ad
+    :param max_overlap: Largest overlap, as a fraction of the shorter ad, between kept detections; None to keep all
+    :return: Kept detections, sorted by starting frame
+    """
+    return score_ordered_nms(detections, ad_lengths, max_overlap)
+
+
+def online_ads_detector(video_features_chunks, ads_features, k=K, hamming=False, index=None, on_event=None):
+    """
+    Identify ad appearances in a video given as a stream of feature chunks, one event per airing, in memory bounded
+    by the chunk size and the longest ad.
+    :param video_features_chunks: Iterable of features of consecutive video frames, or of tuples (features,
+        timestamps), e.g. feature_extraction.iter_features_from_video
+    :param ads_features: Features of each frame, of each ad (shape: [ad_no, sampled_frames, features])
+    :param k: k of the KNN
+    :param hamming: Flag to compare bit-packed features by Hamming distance
+    :param index: Optional ann_index.IVFIndex or projection.ProjectionIndex built over ads_features
+    :param on_event: Optional function called with each event as soon as it is final
+    :return: List of events, sorted by starting frame, as the detections of ads_detector
+    """
+    flattened_ads = flatten_ads_features(ads_features)
+    detector = OnlineAdsDetector(get_ad_lengths_in_frames(ads_features))
+    events = []
+    for chunk in video_features_chunks:
+        chunk, timestamps = chunk if isinstance(chunk, tuple) else (chunk, None)
+        with METRICS.timer("knn"):
+            knn = search_knn(chunk, flattened_ads, k, hamming=hamming, index=index)
+        with METRICS.timer("ads_detector"):
+            chunk_events = detector.feed(knn, timestamps)
+        for event in chunk_events:
+            if on_event is not None:
+                on_event(event)
+        events += chunk_events
+        print("info: {} frames processed".format(detector.frames))
+    with METRICS.timer("ads_detector"):
+        last_events = detector.flush()
+    for event in last_events:
+        if on_event is not None:
+            on_event(event)
+    return sorted(events + last_events, key=lambda event: event['starting_frame'])
@@ -0,0 +1,143 @@
+"""
+Multi-process KNN over shared memory.
+
+The video features and the ad frame matrix are copied once into multiprocessing.shared_memory blocks, which the
+workers of a process pool attach to instead of receiving pickled copies. Work is sharded by video frame range and
+by group of ad partitions (the frames of each ad, in partitioned_knn). Ranges start at multiples of block_size, so
+each shard searches the same blocks of video frames against the same ad matrix as the single process search, and the
+top k of each partition, as well as their merge, are bit-identical to the single process path.
+"""
+from multiprocessing import Pool
+
+import numpy
+
+from src.configurations import K, KNN_BLOCK_SIZE, KNN_WORKERS
+from src.metrics import METRICS
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8
+    shared_memory = None
+
+# shards per worker, so workers finishing early take more work instead of waiting for the slowest one
+SHARDS_PER_WORKER = 4
+
+# arrays and parameters of the search, attached once per worker process
+_shard_state = {}
+
+
+def search_partitions(search, video_features, ads_matrix, partitions, k=K, block_size=KNN_BLOCK_SIZE,
+                      workers=KNN_WORKERS):
+    """
+    Top k of each video frame within each partition of the ad frame matrix, searched by a pool of processes.
+    :param search: Search function, video_tools.knn_search or video_tools.hamming_knn_search
+    :param video_features: Features of each frame of the video (shape: [sampled_frames, features])
+    :param ads_matrix: Features of every ad frame (shape: [total_ad_frames, features])
+    :param partitions: List of (start, end) ranges of ads_matrix rows searched separately, e.g. the frames of each ad
+    :param k: k of the KNN
+    :param block_size: Number of video frames compared at once
+    :param workers: Amount of processes; 1 searches in this process
+    :return: List with a tuple (columns, distances) per partition, as search over those rows returns them
+    """
+    if workers > 1 and shared_memory is None:
+        print("warning: multiprocessing.shared_memory needs Python 3.8, searching the knn in a single process")
+        workers = 1
+    if workers <= 1:
+        return [search(video_features, ads_matrix[start:end], k, block_size) for start, end in partitions]
+
+    video_features = numpy.asarray(video_features)
+    video_features = video_features.reshape(video_features.shape[0], -1)
+    ads_matrix = numpy.asarray(ads_matrix)
+    blocks = []
+    try:
+        video_block, video_descriptor = share(video_features)
+        blocks.append(video_block)
+        ads_block, ads_descriptor = share(ads_matrix)
+        blocks.append(ads_block)
+
+        shards = shard_ranges(video_features.shape[0], partitions, workers * SHARDS_PER_WORKER, block_size)
+        results = [[] for _ in partitions]
+        with Pool(workers, initializer=_init_worker,
+                  initargs=(search, video_descriptor, ads_descriptor, partitions, k, block_size)) as pool:
+            for (_, _, partition_idx), (shard_results, worker_metrics) in zip(shards,
+                                                                              pool.imap(_search_shard, shards)):
+                # shards of a partition come in video frame order
+                for partition, shard_result in zip(partition_idx, shard_results):
+                    results[partition].append(shard_result)
+                METRICS.merge(worker_metrics)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return [(numpy.concatenate([columns for columns, _ in partition_results]),
+             numpy.concatenate([distances for _, distances in partition_results]))
+            for partition_results in results]
+
+
+def shard_ranges(frames, partitions, target_shards, block_size=KNN_BLOCK_SIZE):
+    """
+    Split the search of every video frame against every partition into shards
+    :param frames: Amount of video frames
+    :param partitions: List of (start, end) ranges of ad frame matrix rows
+    :param target_shards: Amount of shards to aim for
+    :param block_size: Video frame ranges start at multiples of it
+    :return: List of (row_start, row_end, partition_idx) shards, partition_idx being the partitions searched; shards
+        of the same partitions are in video frame order
+    """
+    blocks = max(1, -(-frames // block_size))
+    row_ranges = min(blocks, target_shards)
+    rows_per_range = -(-blocks // row_ranges) * block_size
+    groups = max(1, min(len(partitions), -(-target_shards // row_ranges)))
+
+    # contiguous groups of partitions with about the same amount of ad frames
+    sizes = numpy.array([end - start for start, end in partitions], dtype=numpy.float64)
+    boundaries = numpy.searchsorted(numpy.cumsum(sizes), sizes.sum() * numpy.arange(1, groups) / groups)
+    partition_groups = [group.tolist() for group in numpy.split(numpy.arange(len(partitions)), boundaries)
+                        if len(group)]
+    return [(row_start, min(row_start + rows_per_range, frames), group)
+            for group in partition_groups for row_start in range(0, max(1, frames), rows_per_range)]
+
+
+def share(array):
+    """
+    Copy an array into a new shared memory block
+    :param array: Numpy array
+    :return: Tuple (block, descriptor); the block must be closed and unlinked by the caller, and the descriptor
+        attaches to it with attach
+    """
+    array = numpy.ascontiguousarray(array)
+    block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    numpy.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+    return block, (block.name, array.shape, array.dtype.str)
+
+
+def attach(descriptor):
+    """
+    Attach to an array shared with share
+    :param descriptor: Descriptor returned by share
+    :return: Tuple (block, array), the array being backed by the block
+    """
+    name, shape, dtype = descriptor
+    block = shared_memory.SharedMemory(name=name)
+    return block, numpy.ndarray(shape, numpy.dtype(dtype), buffer=block.buf)
+
+
+def _init_worker(search, video_descriptor, ads_descriptor, partitions, k, block_size):
+    video_block, video_features = attach(video_descriptor)
+    ads_block, ads_matrix = attach(ads_descriptor)
+    # blocks are kept referenced so the arrays stay valid during the life of the worker
+    _shard_state.update(search=search, blocks=(video_block, ads_block), video_features=video_features,
+                        ads_matrix=ads_matrix, partitions=partitions, k=k, block_size=block_size)
+
+
+def _search_shard(shard):
+    row_start, row_end, partition_idx = shard
+    partitions = _shard_state['partitions']
+    # send back only the metrics of this shard, to be merged into the parent's
+    METRICS.reset()
+    video_features = _shard_state['video_features'][row_start:row_end]
+    ads_matrix = _shard_state['ads_matrix']
+    return [_shard_state['search'](video_features, ads_matrix[partitions[idx][0]:partitions[idx][1]],
+                                   _shard_state['k'], _shard_state['block_size'])
+            for idx in partition_idx], METRICS
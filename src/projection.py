@@ -0,0 +1,272 @@
+"""
+KNN over a low dimensional projection of the ad frames, re-ranked with exact distances.
+
+Ad frames are projected with PCA (fitted on the ad library) or with a random gaussian projection, down to
+PROJECTION_DIMENSIONS. Each query frame is compared against every ad frame in the projected space to get a
+shortlist of PROJECTION_SHORTLIST candidates, which are then re-ranked with exact distances over the original
+features (Hamming for bit-packed features, euclidean otherwise). The projection is fitted once per ad library and
+persisted next to the ad features in the "features" cache.
+
+Usage (top k agreement vs exact search report):
+$ python -m src.projection "full-length video filename" "ad video-clip folder"
+"""
+import sys
+import time
+
+import numpy
+
+from src import cache_manager
+from src.ann_index import KMEANS_MAX_TRAINING_ROWS, _as_vectors
+from src.metrics import METRICS
+from src.configurations import K, KNN_BLOCK_SIZE, ANN_NPROBE, PROJECTION_METHOD, PROJECTION_DIMENSIONS, \
+    PROJECTION_SHORTLIST
+from src.video_tools import knn_search, hamming_knn_search, as_uint64_words, popcount
+
+PROJECTION_METHODS = ("pca", "random")
+# minimum fraction of the exact top k that the projected search must find, see agreement_report
+TARGET_AGREEMENT = 0.95
+
+
+class ProjectionIndex:
+    """
+    Linear projection of the ad frames plus the projected ad frames, searched as ann_index.IVFIndex is.
+    Shortlists are re-ranked with exact distances, so a shortlist holding every ad frame returns exactly the brute
+    force result.
+    """
+
+    def __init__(self, ads_matrix, mean, components, hamming, method, shortlist=PROJECTION_SHORTLIST):
+        self.ads_matrix = ads_matrix
+        self.mean = mean
+        self.components = components
+        self.hamming = hamming
+        self.method = method
+        self.shortlist = shortlist
+        self.projected_ads = numpy.ascontiguousarray(self.project(ads_matrix), dtype=numpy.float32)
+        self.projected_sq_norms = numpy.einsum('ij,ij->i', self.projected_ads, self.projected_ads)
+
+    @property
+    def dimensions(self):
+        return self.components.shape[0]
+
+    @classmethod
+    def build(cls, ads_matrix, hamming=False, dimensions=PROJECTION_DIMENSIONS, method=PROJECTION_METHOD, seed=0,
+              shortlist=PROJECTION_SHORTLIST):
+        """
+        Fit the projection over the ad frames
+        :param ads_matrix: Features of every ad frame (shape: [total_ad_frames, features])
+        :param hamming: Flag indicating ads_matrix holds bit-packed features
+        :param dimensions: Dimensions of the projected space
+        :param method: "pca" to keep the directions of highest variance of the ad frames, "random" for a random
+            gaussian projection
+        :param seed: Seed of the training sample and of the random projection
+        :param shortlist: Candidates re-ranked per query frame
+        :return: ProjectionIndex
+        """
+        if method not in PROJECTION_METHODS:
+            raise ValueError("unknown projection method {}, expected one of {}".format(method, PROJECTION_METHODS))
+        ads_matrix = numpy.asarray(ads_matrix)
+        vectors = _as_vectors(ads_matrix, hamming)
+        dimensions = max(1, min(dimensions, vectors.shape[1]))
+        random = numpy.random.RandomState(seed)
+
+        training = vectors
+        if training.shape[0] > KMEANS_MAX_TRAINING_ROWS:
+            training = training[random.choice(training.shape[0], KMEANS_MAX_TRAINING_ROWS, replace=False)]
+        mean = training.mean(axis=0)
+        if method == "pca":
+            centered = (training - mean).astype(numpy.float64)
+            # eigenvectors of the covariance matrix, by decreasing eigenvalue
+            _, eigenvectors = numpy.linalg.eigh(numpy.dot(centered.T, centered))
+            components = eigenvectors[:, ::-1][:, :dimensions].T
+        else:
+            components = random.standard_normal((dimensions, vectors.shape[1])) / numpy.sqrt(dimensions)
+        print("info: {} projection fitted from {} to {} dimensions over {} ad frames".format(
+            method, vectors.shape[1], dimensions, ads_matrix.shape[0]))
+        return cls(ads_matrix, mean.astype(numpy.float32), numpy.ascontiguousarray(components, dtype=numpy.float32),
+                   hamming, method, shortlist)
+
+    def project(self, features):
+        """
+        Project features into the low dimensional space
+        :param features: Features, in the format of ads_matrix (shape: [rows, features])
+        :return: Projected features (shape: [rows, dimensions])
+        """
+        vectors = _as_vectors(features, self.hamming)
+        vectors -= self.mean
+        return numpy.dot(vectors, self.components.T)
+
+    def cache_tag(self, nprobe=None):
+        """
+        Part of the cache key of KNN results searched with this index
+        """
+        return "{}{}s{}".format(self.method, self.dimensions, self.shortlist)
+
+    def search(self, video_features, k=K, nprobe=ANN_NPROBE, block_size=KNN_BLOCK_SIZE):
+        """
+        KNN of each video frame against the ad frames: a shortlist by projected distance, re-ranked exactly.
+        :param video_features: Features of each frame of the video (shape: [sampled_frames, features])
+        :param k: k of the KNN
+        :param nprobe: Unused, accepted for compatibility with ann_index.IVFIndex.search
+        :param block_size: Number of video frames searched at once
+        :return: Tuple (columns, distances) with shape [video_frame, i_nearest_neighbor], as knn_search
+        """
+        k = min(k, self.ads_matrix.shape[0])
+        shortlist = min(max(k, self.shortlist), self.ads_matrix.shape[0])
+        video_features = numpy.asarray(video_features)
+        video_features = video_features.reshape(video_features.shape[0], -1)
+        if self.hamming:
+            ads_words = as_uint64_words(self.ads_matrix)
+        else:
+            ads_matrix = numpy.asarray(self.ads_matrix, dtype=numpy.float64)
+            ads_sq_norms = numpy.einsum('ij,ij->i', ads_matrix, ads_matrix)
+
+        columns = numpy.empty((video_features.shape[0], k), dtype=numpy.int64)
+        distances = numpy.empty((video_features.shape[0], k), dtype=numpy.uint32 if self.hamming else numpy.float64)
+        for block_start in range(0, video_features.shape[0], block_size):
+            block = video_features[block_start:block_start + block_size]
+            candidates = self._shortlist(block, shortlist)
+            if self.hamming:
+                block_words = as_uint64_words(block)
+                candidate_distances = popcount(numpy.bitwise_xor(ads_words[candidates], block_words[:, None]))
+                candidate_distances = candidate_distances.sum(axis=-1, dtype=numpy.uint32)
+            else:
+                # exact distances against the union of the shortlists of the block, in one matrix product, as
+                # knn_search computes them; consecutive frames share most of their candidates
+                union, union_columns = numpy.unique(candidates, return_inverse=True)
+                block = numpy.asarray(block, dtype=numpy.float64)
+                union_distances = numpy.dot(block, ads_matrix[union].T)
+                union_distances *= -2
+                union_distances += ads_sq_norms[union]
+                union_distances += numpy.einsum('ij,ij->i', block, block)[:, None]
+                numpy.maximum(union_distances, 0, out=union_distances)
+                candidate_distances = numpy.take_along_axis(union_distances,
+                                                            union_columns.reshape(candidates.shape), axis=1)
+            METRICS.count("distance_computations", candidates.size)
+            order = numpy.argsort(candidate_distances, axis=1, kind='stable')[:, :k]
+            columns[block_start:block_start + block_size] = numpy.take_along_axis(candidates, order, axis=1)
+            distances[block_start:block_start + block_size] = numpy.take_along_axis(candidate_distances, order,
+                                                                                    axis=1)
+        return columns, distances
+
+    def _shortlist(self, block, shortlist):
+        """
+        Shortlist of each frame of a block: the ad frames nearest in the projected space, sorted by column.
+        Projected distances only choose candidates, so they are computed in float32 and only partially sorted.
+        """
+        METRICS.count("projected_distance_computations", block.shape[0] * self.projected_ads.shape[0])
+        if shortlist >= self.projected_ads.shape[0]:
+            return numpy.tile(numpy.arange(self.projected_ads.shape[0]), (block.shape[0], 1))
+        projected = numpy.asarray(self.project(block), dtype=numpy.float32)
+        projected_distances = numpy.dot(projected, self.projected_ads.T)
+        projected_distances *= -2
+        projected_distances += self.projected_sq_norms
+        candidates = numpy.argpartition(projected_distances, shortlist - 1, axis=1)[:, :shortlist]
+        # sorted candidates make the stable sort of the exact distances break ties by column, as top_k does
+        candidates.sort(axis=1)
+        return candidates
+
+    def to_arrays(self):
+        """
+        Arrays needed to rebuild the index with from_arrays, other than the ad frame matrix
+        """
+        return {'mean': self.mean, 'components': self.components, 'hamming': numpy.asarray(self.hamming),
+                'method': numpy.asarray(self.method)}
+
+    @classmethod
+    def from_arrays(cls, arrays, ads_matrix, shortlist=PROJECTION_SHORTLIST):
+        return cls(ads_matrix, arrays['mean'], arrays['components'], bool(arrays['hamming']), str(arrays['method']),
+                   shortlist)
+
+
+def load_or_build_projection(ads_matrix, hamming=False, dimensions=PROJECTION_DIMENSIONS, method=PROJECTION_METHOD,
+                             shortlist=PROJECTION_SHORTLIST, use_cache=True):
+    """
+    Load the projection of an ad library from cache, fitting and caching it if it isn't available.
+    The cache is keyed by the content of the ad frame matrix, so it is refitted whenever the library changes.
+    :param ads_matrix: Features of every ad frame (shape: [total_ad_frames, features]), see flatten_ads_features
+    :param hamming: Flag indicating ads_matrix holds bit-packed features
+    :param dimensions: Dimensions of the projected space
+    :param method: Projection method, "pca" or "random"
+    :param shortlist: Candidates re-ranked per query frame
+    :param use_cache: Flag to use cached version if available
+    :return: ProjectionIndex
+    """
+    cache_key = cache_manager.cache_key(cache_manager.array_digest(ads_matrix), hamming, method, dimensions)
+    if use_cache:
+        stored = cache_manager.load_arrays("features", cache_key)
+        if stored is not None:
+            print("info: loading projection from cache")
+            return ProjectionIndex.from_arrays(stored, ads_matrix, shortlist)
+
+    with METRICS.timer("projection_build"):
+        index = ProjectionIndex.build(ads_matrix, hamming, dimensions, method, shortlist=shortlist)
+    cache_manager.save_arrays("features", cache_key, **index.to_arrays())
+    return index
+
+
+def agreement_report(index, video_features, k=K, shortlists=(5, 10, 20, 40, 80, 160), target=TARGET_AGREEMENT):
+    """
+    Compare the projected search against exact search for several shortlist sizes, and print the results.
+    Besides the top k agreement over every frame, the agreement of the nearest neighbor is reported over the frames
+    matching an ad (exact nearest distance below half the median one), which are the ones votes come from: the rest
+    of the top k of a frame that matches nothing is often a tie among many unrelated ad frames.
+    :param index: ProjectionIndex to be evaluated
+    :param video_features: Features of the query frames (shape: [sampled_frames, features])
+    :param k: k of the KNN
+    :param shortlists: Shortlist sizes to be evaluated, besides the configured one, which is warned about if it
+        misses the target
+    :param target: Top k agreement the search is expected to reach
+    :return: List of dicts with shortlist, agreement (fraction of the exact top k found), matched_agreement,
+        seconds, speedup and whether the target is met
+    """
+    search = hamming_knn_search if index.hamming else knn_search
+    start = time.time()
+    exact_columns, exact_distances = search(video_features, index.ads_matrix, k)
+    exact_seconds = time.time() - start
+    nearest_distances = exact_distances[:, 0].astype(numpy.float64)
+    matched = nearest_distances < numpy.median(nearest_distances) / 2
+
+    configured_shortlist = index.shortlist
+    report = []
+    print("{} of {} frames match an ad".format(matched.sum(), matched.size))
+    print("shortlist\tagreement@{}\tmatched@1\tseconds\tspeedup\ttarget {:.2f}".format(k, target))
+    print("exact\t1.0000\t1.0000\t{:.3f}\t1.00\tmet".format(exact_seconds))
+    for shortlist in sorted(set(shortlists) | {configured_shortlist}):
+        if shortlist < k:
+            continue
+        index.shortlist = shortlist
+        start = time.time()
+        columns, _ = index.search(video_features, k)
+        seconds = time.time() - start
+        found = sum(numpy.intersect1d(row, exact_row).size for row, exact_row in zip(columns, exact_columns))
+        agreement = 1.0 * found / exact_columns.size
+        matched_agreement = float(numpy.mean(columns[matched, 0] == exact_columns[matched, 0])) if matched.any() \
+            else 1.0
+        report.append({'shortlist': shortlist, 'agreement': agreement, 'matched_agreement': matched_agreement,
+                       'seconds': seconds, 'speedup': exact_seconds / seconds if seconds else float('inf'),
+                       'target_met': agreement >= target})
+        print("{}\t{:.4f}\t{:.4f}\t{:.3f}\t{:.2f}\t{}".format(shortlist, agreement, matched_agreement, seconds,
+                                                         report[-1]['speedup'],
+                                                         "met" if agreement >= target else "missed"))
+    index.shortlist = configured_shortlist
+    configured = [row for row in report if row['shortlist'] == configured_shortlist]
+    if configured and not configured[0]['target_met']:
+        print("warning: the configured PROJECTION_SHORTLIST of {} finds {:.4f} of the exact top {}, below the target "
+              "of {:.2f}; raise it to one meeting the target".format(configured_shortlist, configured[0]['agreement'],
+                                                                     k, target))
+    return report
+
+
+if __name__ == '__main__':
+    from src import feature_extraction
+    from src.feature_extraction import FeatureType
+    from src.video_tools import flatten_ads_features
+
+    if len(sys.argv) != 3:
+        raise AttributeError("Script receives 2 parameters: \"full-length video filename\" "
+                             "and \"ad video-clip folder\"")
+    ft_type = FeatureType.SOBEL_THRESH_PACKED
+    video_features = feature_extraction.extract_features_from_video(sys.argv[1], ft_type=ft_type)
+    ads_features, _ = feature_extraction.extract_features_from_video_folder(sys.argv[2], ft_type=ft_type)
+    ads_matrix, _, _ = flatten_ads_features(ads_features)
+    agreement_report(load_or_build_projection(ads_matrix, hamming=True), video_features)
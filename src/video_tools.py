@@ -1,149 +1,459 @@
 import numpy
 
-from hashlib import sha256
+from src import cache_manager
+from src.ad_library import AdLibrary
+from src.configurations import SAMPLES_PER_SECOND, APPEARANCES_OUTFILE, SCORE_THRESHOLD, K, \
+    KNN_BLOCK_SIZE, ANN_NPROBE, KNN_WORKERS
+from src.metrics import METRICS
+from src.parallel_knn import search_partitions
 
-from src.configurations import CACHE_FOLDER, SAMPLES_PER_SECOND, APPEARANCES_OUTFILE, SCORE_THRESHOLD
+# (low, high, bins) of the histograms of detection scores
+SCORE_HISTOGRAM = (0.0, 1.0, 20)
 
-DEBUG = True
-if DEBUG:
-    all_scores = []
-    passed_scores = []
-    all_scores_mean_n_std = lambda: (numpy.mean(all_scores), numpy.std(all_scores))
-    passed_scores_mean_n_std = lambda: (numpy.mean(passed_scores), numpy.std(passed_scores))
 
-
-def batch_knn(video_features, ads_features, k=5, use_cache=True):
+def batch_knn(video_features, ads_features, k=K, use_cache=True, block_size=KNN_BLOCK_SIZE, hamming=False,
+              index=None, nprobe=ANN_NPROBE, workers=KNN_WORKERS):
     """
     Calculates KNN of each video frame against every ad frame.
-    
+
+    Video frames are processed in blocks of block_size rows against a contiguous matrix holding the frames of
+    every ad, using the expansion |v - a|^2 = |v|^2 + |a|^2 - 2 v.a, so peak memory is bounded by
+    block_size * total_ad_frames distances.
+    Bit-packed features (FeatureType.SOBEL_THRESH_PACKED) are compared by Hamming distance instead, which ranks
+    neighbors exactly as euclidean distance does over the unpacked 0/255 features.
+
     :param k: k of the KNN
     :param use_cache: Flag to use cached version if available
+    :param block_size: Number of video frames compared at once against the ad frame matrix
+    :param hamming: Flag to compare bit-packed features by Hamming distance
+    :param index: Optional ann_index.IVFIndex or projection.ProjectionIndex built over ads_features; when given the
+        search is approximate
+    :param nprobe: Amount of index lists probed per video frame, trades speed for recall
+    :param workers: Amount of processes sharing the exact search, see parallel_knn; results are the same
     :param video_features: Features of each frame of the video (shape: [sampled_frames, features])
     :param ads_features: Features of each frame, of each ad (shape: [ad_no, sampled_frames, features])
-    :return: KNN of every frame of the video (shape: [video_frame, i_nearest_neighbor]) 
+    :return: Tuple (knn_ad_idx, knn_frame_idx) of integer arrays with shape [video_frame, i_nearest_neighbor],
+        holding the ad index and ad frame index of each neighbor, nearest first.
     """
+    with METRICS.timer("knn"):
+        return _batch_knn(video_features, ads_features, k, use_cache, block_size, hamming, index, nprobe, workers)
 
-    def distance(vec1, vec2):
-        return numpy.linalg.norm(numpy.asarray(vec1) - numpy.asarray(vec2))
 
-    cache_filename = sha256(
-        sha256(str(video_features).encode()).hexdigest().encode() +
-        sha256(str(ads_features).encode()).hexdigest().encode()
-    ).hexdigest()
-    cache_path = str(CACHE_FOLDER / "knn" / cache_filename) + str(k) + ".npy"
+def _batch_knn(video_features, ads_features, k, use_cache, block_size, hamming, index, nprobe, workers):
+    if index is None:
+        # exact results are cached per ad, so changes to the ad library only search the new ads
+        knn = partitioned_knn(video_features, ads_features, k, block_size, hamming, use_cache, workers)
+        print("info: knn calculated successfully")
+        return knn
+
+    cache_key = cache_manager.cache_key(
+        cache_manager.array_digest(video_features),
+        ads_features.key if isinstance(ads_features, AdLibrary) else cache_manager.array_digest(ads_features),
+        k,
+        "hamming" if hamming else "euclidean",
+        index.cache_tag(nprobe)
+    )
     if use_cache:
-        # check if features are cached
-        try:
-            features = numpy.load(cache_path)
+        # check if knn results are cached
+        knn = cache_manager.load("knn", cache_key)
+        if knn is not None:
             print("info: loading knn results from cache")
-            return features
-        except FileNotFoundError:
-            pass
-
-    knn_result = []
-    for frame_features in video_features:
-        neighbors = []
-        for ad_idx, ad_frames in enumerate(ads_features):
-            for ad_frame_idx, ad_frame_features in enumerate(ad_frames):
-                neighbors.append(("{}_{}".format(ad_idx, ad_frame_idx), distance(frame_features, ad_frame_features)))
-        knn = sorted(neighbors, key=lambda element: element[1])[:k]
-        knn_labels = []
-        for neighbor in knn:
-            knn_labels.append(neighbor[0])
-        knn_result.append(knn_labels)
+            return knn[0], knn[1]
+
+    knn_ad_idx, knn_frame_idx = search_knn(video_features, flatten_ads_features(ads_features), k, block_size,
+                                           hamming, index, nprobe, workers)
     print("info: knn calculated successfully")
 
-    try:
-        # save results to cache
-        numpy.save(cache_path, knn_result)
-    except IOError as e:
-        print("warning: error saving cached knn to {}; stacktrace: {}".format(cache_path, e))
-        pass
-    return knn_result
+    # save results to cache
+    cache_manager.save("knn", cache_key, numpy.stack((knn_ad_idx, knn_frame_idx)))
+    return knn_ad_idx, knn_frame_idx
+
+
+def partitioned_knn(video_features, ads_features, k=K, block_size=KNN_BLOCK_SIZE, hamming=False, use_cache=True,
+                    workers=KNN_WORKERS):
+    """
+    Exact KNN of each video frame against every ad frame, cached for the whole library and per (video, ad)
+    partition.
+
+    A library searched before is loaded from a single cache entry. Otherwise, the top k of each ad is loaded from
+    cache or searched, and the partitions are merged into the top k of the whole library, breaking ties by ad and
+    then by ad frame as a search over the whole library would. Adding an ad to the library only searches that ad;
+    removed ads simply aren't merged.
+
+    :param use_cache: Flag to use cached partitions if available
+    :param workers: Amount of processes searching the ads missing from cache
+    :return: Tuple (knn_ad_idx, knn_frame_idx) with shape [video_frame, i_nearest_neighbor], as batch_knn
+    """
+    search = hamming_knn_search if hamming else knn_search
+    if not hamming:
+        # convert once instead of once per ad
+        video_features = numpy.asarray(video_features, dtype=numpy.float64).reshape(len(video_features), -1)
+    video_key = cache_manager.array_digest(video_features)
+    if isinstance(ads_features, AdLibrary):
+        ad_keys = ads_features.ad_keys
+    else:
+        ad_keys = [cache_manager.array_digest(ad_features) for ad_features in ads_features]
+
+    metric = "hamming" if hamming else "euclidean"
+    library_key = ads_features.key if isinstance(ads_features, AdLibrary) else cache_manager.cache_key(*ad_keys)
+    library_cache_key = cache_manager.cache_key(video_key, "library", library_key, k, metric)
+    if use_cache:
+        knn = cache_manager.load_arrays("knn", library_cache_key)
+        if knn is not None:
+            print("info: loading knn results from cache")
+            return knn['ad_idx'], knn['frame_idx']
+
+    cache_keys = [cache_manager.cache_key(video_key, ad_key, k, metric) for ad_key in ad_keys]
+    partitions = [cache_manager.load_arrays("knn", cache_key) if use_cache else None for cache_key in cache_keys]
+    missing = [ad_idx for ad_idx, partition in enumerate(partitions) if partition is None]
+    if missing:
+        missing_ads = [numpy.asarray(ads_features[ad_idx]) for ad_idx in missing]
+        missing_ads = [ad_features.reshape(ad_features.shape[0], -1) for ad_features in missing_ads]
+        bounds = numpy.cumsum([0] + [ad_features.shape[0] for ad_features in missing_ads])
+        searched = search_partitions(search, video_features, numpy.concatenate(missing_ads),
+                                     list(zip(bounds[:-1], bounds[1:])), k, block_size, workers)
+        with cache_manager.batch_writes():
+            for ad_idx, (frame_idx, distances) in zip(missing, searched):
+                partitions[ad_idx] = {'frame_idx': frame_idx, 'distances': distances}
+                cache_manager.save_arrays("knn", cache_keys[ad_idx], **partitions[ad_idx])
+    METRICS.count("knn_ads_searched", len(missing))
+    print("info: knn searched {} of {} ads, {} loaded from cache".format(len(missing), len(ad_keys),
+                                                                         len(ad_keys) - len(missing)))
+    partition_frame_idx = [partition['frame_idx'] for partition in partitions]
+    partition_distances = [partition['distances'] for partition in partitions]
+
+    # columns are ordered by ad and then by ad frame among equal distances, as the columns of a whole library search
+    partition_ad_idx = [numpy.full(frame_idx.shape, ad_idx) for ad_idx, frame_idx in enumerate(partition_frame_idx)]
+    distances = numpy.concatenate(partition_distances, axis=1)
+    columns, _ = top_k(distances, min(k, distances.shape[1]))
+    knn_ad_idx = numpy.take_along_axis(numpy.concatenate(partition_ad_idx, axis=1), columns, axis=1)
+    knn_frame_idx = numpy.take_along_axis(numpy.concatenate(partition_frame_idx, axis=1), columns, axis=1)
+    cache_manager.save_arrays("knn", library_cache_key, ad_idx=knn_ad_idx, frame_idx=knn_frame_idx)
+    return knn_ad_idx, knn_frame_idx
+
+
+def search_knn(video_features, flattened_ads, k=K, block_size=KNN_BLOCK_SIZE, hamming=False, index=None,
+               nprobe=ANN_NPROBE, workers=KNN_WORKERS):
+    """
+    KNN of each video frame against every ad frame, without cache; see batch_knn for the parameters.
+    :param flattened_ads: Ad frames as returned by flatten_ads_features
+    :return: Tuple (knn_ad_idx, knn_frame_idx) with shape [video_frame, i_nearest_neighbor]
+    """
+    ads_matrix, row_ad_idx, row_frame_idx = flattened_ads
+    if index is not None:
+        columns, _ = index.search(video_features, k, nprobe, block_size)
+    else:
+        search = hamming_knn_search if hamming else knn_search
+        columns, _ = search_partitions(search, video_features, ads_matrix, [(0, ads_matrix.shape[0])], k, block_size,
+                                       workers)[0]
+    return row_ad_idx[columns], row_frame_idx[columns]
+
+
+def knn_search(video_features, ads_matrix, k=K, block_size=KNN_BLOCK_SIZE):
+    """
+    Blocked brute force KNN of each video frame against the rows of a contiguous ad frame matrix.
+    :param video_features: Features of each frame of the video (shape: [sampled_frames, features])
+    :param ads_matrix: Features of every ad frame (shape: [total_ad_frames, features])
+    :param k: k of the KNN
+    :param block_size: Number of video frames compared at once
+    :return: Tuple (columns, distances) with shape [video_frame, i_nearest_neighbor]; columns index ads_matrix rows
+        and distances are squared euclidean distances, nearest first.
+    """
+    video_features = numpy.asarray(video_features, dtype=numpy.float64).reshape(len(video_features), -1)
+    ads_matrix = numpy.asarray(ads_matrix, dtype=numpy.float64)
+    k = min(k, ads_matrix.shape[0])
+    ads_sq_norms = numpy.einsum('ij,ij->i', ads_matrix, ads_matrix)
+
+    METRICS.count("distance_computations", video_features.shape[0] * ads_matrix.shape[0])
+    columns = numpy.empty((video_features.shape[0], k), dtype=numpy.int64)
+    distances = numpy.empty((video_features.shape[0], k), dtype=numpy.float64)
+    for block_start in range(0, video_features.shape[0], block_size):
+        block = video_features[block_start:block_start + block_size]
+        block_distances = numpy.dot(block, ads_matrix.T)
+        block_distances *= -2
+        block_distances += ads_sq_norms
+        block_distances += numpy.einsum('ij,ij->i', block, block)[:, None]
+        numpy.maximum(block_distances, 0, out=block_distances)
+        block_columns, block_top = top_k(block_distances, k)
+        columns[block_start:block_start + block_size] = block_columns
+        distances[block_start:block_start + block_size] = block_top
+    return columns, distances
+
+
+def hamming_knn_search(video_features, ads_matrix, k=K, block_size=KNN_BLOCK_SIZE):
+    """
+    Blocked brute force KNN by Hamming distance between bit-packed features, using XOR and popcount over uint64
+    words.
+    :param video_features: Packed features of each frame of the video (shape: [sampled_frames, packed_bytes])
+    :param ads_matrix: Packed features of every ad frame (shape: [total_ad_frames, packed_bytes])
+    :param k: k of the KNN
+    :param block_size: Number of video frames compared at once
+    :return: Tuple (columns, distances) with shape [video_frame, i_nearest_neighbor]; columns index ads_matrix rows
+        and distances are the amount of differing bits, nearest first.
+    """
+    video_words = as_uint64_words(video_features)
+    ads_words = as_uint64_words(ads_matrix)
+    k = min(k, ads_words.shape[0])
+
+    METRICS.count("distance_computations", video_words.shape[0] * ads_words.shape[0])
+    columns = numpy.empty((video_words.shape[0], k), dtype=numpy.int64)
+    distances = numpy.empty((video_words.shape[0], k), dtype=numpy.uint32)
+    for block_start in range(0, video_words.shape[0], block_size):
+        block = video_words[block_start:block_start + block_size]
+        block_distances = numpy.zeros((block.shape[0], ads_words.shape[0]), dtype=numpy.uint32)
+        for word_idx in range(ads_words.shape[1]):
+            block_distances += popcount(numpy.bitwise_xor(block[:, word_idx, None], ads_words[None, :, word_idx]))
+        block_columns, block_top = top_k(block_distances, k)
+        columns[block_start:block_start + block_size] = block_columns
+        distances[block_start:block_start + block_size] = block_top
+    return columns, distances
+
+
+def as_uint64_words(packed_features):
+    """
+    View bit-packed features as rows of uint64 words, zero padding each row to a multiple of 8 bytes.
+    :param packed_features: Packed features (shape: [rows, packed_bytes])
+    :return: Array with shape [rows, words] and dtype uint64
+    """
+    packed_features = numpy.asarray(packed_features, dtype=numpy.uint8)
+    packed_features = packed_features.reshape(packed_features.shape[0], -1)
+    padding = -packed_features.shape[1] % 8
+    if padding:
+        packed_features = numpy.pad(packed_features, ((0, 0), (0, padding)), mode='constant')
+    return numpy.ascontiguousarray(packed_features).view(numpy.uint64)
+
+
+_POPCOUNT_TABLE = numpy.array([bin(byte).count("1") for byte in range(256)], dtype=numpy.uint8)
+
+
+def popcount(words):
+    """
+    Amount of set bits of each uint64 word
+    :param words: Array of dtype uint64
+    :return: Array of the same shape with the amount of set bits of each word
+    """
+    if hasattr(numpy, "bitwise_count"):
+        return numpy.bitwise_count(words)
+    # numpy < 2.0 lacks a popcount ufunc; count over the bytes of each word with a lookup table
+    return _POPCOUNT_TABLE[words.view(numpy.uint8)].reshape(words.shape + (8,)).sum(axis=-1, dtype=numpy.uint8)
+
+
+def top_k(distances, k):
+    """
+    Select the k smallest distances of each row, sorted by distance and then by column, so ties are resolved as
+    a stable sort over the candidates would.
+    :param distances: Distance matrix (shape: [rows, candidates])
+    :param k: Amount of neighbors to keep, at most the amount of candidates
+    :return: Tuple (columns, distances) of the k nearest candidates of each row (shape: [rows, k])
+    """
+    rows = distances.shape[0]
+    if k < distances.shape[1]:
+        # k-th smallest distance of each row; everything below it is kept, ties on it are kept by lowest column
+        kth_distance = numpy.partition(distances, k - 1, axis=1)[:, k - 1:k]
+        below = distances < kth_distance
+        on_kth = distances == kth_distance
+        selected = below | (on_kth & (numpy.cumsum(on_kth, axis=1) <= k - below.sum(axis=1, keepdims=True)))
+        candidates = numpy.nonzero(selected)[1].reshape(rows, k)
+    else:
+        candidates = numpy.broadcast_to(numpy.arange(distances.shape[1]), distances.shape)
+    candidate_distances = numpy.take_along_axis(distances, candidates, axis=1)
+    order = numpy.lexsort((candidates, candidate_distances), axis=1)
+    return numpy.take_along_axis(candidates, order, axis=1), numpy.take_along_axis(candidate_distances, order, axis=1)
+
+
+def flatten_ads_features(ads_features):
+    """
+    Stack the frames of every ad into a contiguous matrix.
+    :param ads_features: Features of each frame, of each ad (shape: [ad_no, sampled_frames, features])
+    :return: Tuple (ads_matrix, row_ad_idx, row_frame_idx); ads_matrix has shape [total_ad_frames, features] and
+        the other two map each of its rows to the ad index and the ad frame index it came from.
+    """
+    if isinstance(ads_features, AdLibrary):
+        return ads_features.flattened()
+    ads = [numpy.asarray(ad_features) for ad_features in ads_features]
+    ads = [ad.reshape(ad.shape[0], -1) for ad in ads]
+    ads_matrix = numpy.ascontiguousarray(numpy.concatenate(ads))
+    row_ad_idx = numpy.repeat(numpy.arange(len(ads)), [ad.shape[0] for ad in ads])
+    row_frame_idx = numpy.concatenate([numpy.arange(ad.shape[0]) for ad in ads])
+    return ads_matrix, row_ad_idx, row_frame_idx
 
 
-def ads_detector(knn_list, video_name, ad_lengths, ad_names):
+def ads_detector(knn, video_name, ad_lengths, ad_names, outfile=APPEARANCES_OUTFILE, timestamps=None,
+                 sample_positions=None):
     """
     Identify ad appearances in the video based on KNN results.
-    Export results to APPEARANCES_OUTFILE.
+    Export results to outfile.
     :param video_name: name of the video to be shown in outfile
     :param ad_names: names of ads to be shown in outfile
+    :param outfile: Path of the file to be written, None to skip exporting
     :param ad_lengths: List of frames sampled for each ad in the same order as the ads_features passed to the KNN.
-    :param knn_list: KNN of each frame of the original video.
+    :param knn: Tuple (knn_ad_idx, knn_frame_idx) of each frame of the original video, as returned by batch_knn.
+    :param timestamps: Optional time in seconds of each sampled frame of the video, see
+        feature_extraction.extract_features_from_video; detections then carry the exact 'starting_second'
+    :param sample_positions: Optional position of each sampled frame among the samples at n / sps seconds, for
+        videos sampled adaptively, see detect_ads
     :return: None
     """
-    ad_matching_list = []
-
-    for ad_idx, ad_length_in_frames in enumerate(ad_lengths):
-        # for each possible ad
-        # calculate a score list that represents the probability that the ad is starting at each frame of the video
-        ad_intersection_scores = []
-        ad_estimated_length_per_video_frame = []
-
-        for starting_frame_idx, _ in enumerate(knn_list):
-            # for each frame of the video, check if the ad starts at this video frame
-            # check the intersection of the ad's frames within the knn results
-            # if intersection is 0, then knn didn't discover any ad's frame starting in this frame
-            # if intersection is 1, then knn matched every ad's frame with corresponding video frame sequentially
-            ad_intersection_score = 0
-            intersection_frame_counter = 0
-
-            for ad_frame_idx in range(ad_length_in_frames):
-                # check if each ad frame matches sequentially within the KNN frames,
-                # starting in index: frame_idx UNTIL frame_idx+ad_length
-                ad_frame_name = "{}_{}".format(ad_idx, ad_frame_idx)  # KNN output format: {ad_idx}_{frame_idx}
-                try:
-                    knn_priority = list(knn_list[starting_frame_idx+ad_frame_idx]).index(ad_frame_name) + 1  # 1
-                    # means that this ad frame is the nearest
-                    # the score given decays as the matched frame is farther in the KNN result, 1 is max
-                    ad_intersection_score += 1.0 / knn_priority
-                    intersection_frame_counter = ad_frame_idx
-                    # if ad_frame_name in knn_list[relative_frame_idx]:
-                    #     ad_intersection_score += 1.0
-                    #     intersection_frame_counter = ad_frame_idx
-                except ValueError:
-                    # ad frame doesn't appear in the frame's knn
-                    pass
-                except IndexError:
-                    break
-            probability = 1.0 * ad_intersection_score / ad_length_in_frames
-            ad_intersection_scores.append(probability)
-            ad_estimated_length_per_video_frame.append(intersection_frame_counter)
-
-            if DEBUG:
-                all_scores.append(probability)
-            if float(probability) > SCORE_THRESHOLD:
-                # if knn discovered a sequence composed by at least a half of the ad's frames, then
-                # mark it as an occurrence
-                ad_matching_list.append({'ad_idx': ad_idx,
-                                         'ad_length_in_frames': intersection_frame_counter,
-                                         'score': probability,
-                                         'starting_frame': starting_frame_idx,
-                                         })
-                if DEBUG:
-                    passed_scores.append(probability)
-    # finally,
-    # export to file
-    ad_matching_list = sorted(ad_matching_list, key=lambda dic: dic['starting_frame'])
-    with open(APPEARANCES_OUTFILE, 'w') as fp:
-        for ad_detected in ad_matching_list:
-            fp.write('{}\t{}\t{}\t{}\n'.format(
-                video_name,
-                frame_idx_to_seconds(ad_detected['starting_frame']),
-                frame_idx_to_seconds(ad_detected['ad_length_in_frames']),
-                ad_names[ad_detected['ad_idx']],
-                #                ad_detected['score']
-            ))
-        print("info: Detected ads exported to {}".format(APPEARANCES_OUTFILE))
-    if DEBUG:
-        print("debug: score mean {}, std {}".format(all_scores_mean_n_std()[0], all_scores_mean_n_std()[1]))
-        print("debug: passed score mean {}, std {}".format(
-            passed_scores_mean_n_std()[0],
-            passed_scores_mean_n_std()[1])
-        )
+    ad_matching_list = detect_ads(knn_hits(knn), len(knn[0]), ad_lengths, timestamps, sample_positions)
+    if outfile is not None:
+        write_detections(ad_matching_list, video_name, ad_names, outfile)
     return ad_matching_list
 
 
+def detect_ads(hits, frames, ad_lengths, timestamps=None, sample_positions=None, score_threshold=SCORE_THRESHOLD):
+    """
+    Identify ad appearances in the video from the hits of its frames, see ads_detector
+    :param hits: Tuple (video_frame_idx, ad_idx, ad_frame_idx, rank), see knn_hits
+    :param frames: Amount of video frames
+    :param ad_lengths: Frames each ad score is divided by
+    :param timestamps: Optional time in seconds of each sampled frame of the video
+    :param sample_positions: Optional position of each sampled frame among the samples at n / sps seconds (see
+        sample_positions), for videos sampled adaptively (see feature_extraction.adaptive_samples). The hits of
+        each sampled frame then also stand for the skipped samples up to the next one, as if their KNN was the
+        same, and starting frames are positions.
+    :param score_threshold: Minimum score of a detection
+    :return: List of detections, sorted by starting frame
+    """
+    if sample_positions is not None:
+        sample_positions = numpy.asarray(sample_positions, dtype=numpy.int64)
+        frames = int(sample_positions[-1]) + 1 if len(sample_positions) else 0
+        hits = hold_hits(hits, sample_positions, frames)
+        if timestamps is not None:
+            # skipped samples are at n / sps seconds
+            grid_timestamps = frame_idx_to_seconds(numpy.arange(frames, dtype=numpy.float64))
+            grid_timestamps[sample_positions] = timestamps
+            timestamps = grid_timestamps
+    with METRICS.timer("ads_detector"):
+        # for each possible ad, a score that represents the probability that the ad is starting at each frame of
+        # the video; 0 means knn didn't discover any ad's frame starting in this frame, 1 means knn matched every
+        # ad's frame with the corresponding video frame sequentially
+        scores, matched_lengths = score_sequences(hits, ad_lengths, frames)
+        METRICS.count("candidates_scored", scores.size)
+        METRICS.observe("score", scores, SCORE_HISTOGRAM)
+
+        # if knn discovered a sequence composed by enough of the ad's frames, then mark it as an occurrence
+        ad_matching_list = []
+        for ad_idx, starting_frame_idx in zip(*numpy.nonzero(scores > score_threshold)):
+            ad_matching_list.append({'ad_idx': int(ad_idx),
+                                     'ad_length_in_frames': int(matched_lengths[ad_idx, starting_frame_idx]),
+                                     'score': float(scores[ad_idx, starting_frame_idx]),
+                                     'starting_frame': int(starting_frame_idx),
+                                     })
+            if timestamps is not None:
+                ad_matching_list[-1]['starting_second'] = round(float(timestamps[starting_frame_idx]), 3)
+        METRICS.observe("passed_score", [detection['score'] for detection in ad_matching_list], SCORE_HISTOGRAM)
+    return sorted(ad_matching_list, key=lambda dic: dic['starting_frame'])
+
+
+def write_detections(ad_matching_list, video_name, ad_names, outfile=APPEARANCES_OUTFILE):
+    """
+    Export detections to outfile, one appearance per line with format:
+    video_television \t segundos_inicio \t segundos_largo \t video_comercial
+    The start is the timestamp of the starting frame when detections carry it, and starting_frame / sps otherwise.
+    :param ad_matching_list: Detections, as returned by ads_detector
+    :param video_name: name of the video to be shown in outfile
+    :param ad_names: names of ads to be shown in outfile
+    :param outfile: Path of the file to be written
+    :return: None
+    """
+    write_detections_of_videos([(video_name, ad_matching_list)], ad_names, outfile)
+
+
+def write_detections_of_videos(detections_by_video, ad_names, outfile=APPEARANCES_OUTFILE):
+    """
+    Export the detections of several videos to a single outfile, in the format of write_detections
+    :param detections_by_video: List of (video_name, ad_matching_list), in the order they are written
+    :param ad_names: names of ads to be shown in outfile
+    :param outfile: Path of the file to be written
+    :return: None
+    """
+    with open(outfile, 'w') as fp:
+        for video_name, ad_matching_list in detections_by_video:
+            for ad_detected in ad_matching_list:
+                fp.write('{}\t{}\t{}\t{}\n'.format(video_name, *detection_seconds(ad_detected),
+                                                   ad_names[ad_detected['ad_idx']]))
+        print("info: Detected ads exported to {}".format(outfile))
+
+
+def detection_seconds(detection):
+    """
+    Start and length in seconds of a detection, as written to outfile
+    :param detection: Detection, as returned by ads_detector
+    :return: Tuple (start, length); the start is the timestamp of the starting frame when the detection carries it,
+        and starting_frame / sps otherwise
+    """
+    return (detection.get('starting_second', frame_idx_to_seconds(detection['starting_frame'])),
+            frame_idx_to_seconds(detection['ad_length_in_frames']))
+
+
+def knn_hits(knn):
+    """
+    Flatten KNN results into one hit per (video frame, neighbor).
+    :param knn: Tuple (knn_ad_idx, knn_frame_idx) with shape [video_frame, i_nearest_neighbor]
+    :return: Tuple (video_frame_idx, ad_idx, ad_frame_idx, rank) of flat integer arrays, ordered by video frame and
+        then by rank; rank 1 means the nearest neighbor.
+    """
+    knn_ad_idx, knn_frame_idx = (numpy.asarray(knn_result) for knn_result in knn)
+    frames, k = knn_ad_idx.shape
+    return (numpy.repeat(numpy.arange(frames), k), knn_ad_idx.ravel(), knn_frame_idx.ravel(),
+            numpy.tile(numpy.arange(1, k + 1), frames))
+
+
+def score_sequences(hits, ad_lengths, frames):
+    """
+    Score, for each ad and each video frame, how well the ad matches the video sequentially starting there.
+
+    A hit of ad frame f on video frame v votes 1 / rank for the ad starting at frame v - f (the diagonal of the
+    match), so accumulating every vote gives the score of all starting frames of all ads at once. Votes of each
+    diagonal are added in video frame order, which yields exactly the sums of checking every ad frame in turn.
+
+    :param hits: Tuple (video_frame_idx, ad_idx, ad_frame_idx, rank), see knn_hits
+    :param ad_lengths: List of frames sampled for each ad
+    :param frames: Amount of video frames
+    :return: Tuple (scores, matched_lengths) with shape [ad_idx, starting_frame]; scores are the votes divided by
+        the ad length, matched_lengths the last ad frame matched in that sequence (0 if none).
+    """
+    video_frame_idx, ad_idx, ad_frame_idx, rank = hits
+    starting_frame_idx = video_frame_idx - ad_frame_idx
+    valid = starting_frame_idx >= 0
+    flat_idx = ad_idx[valid] * frames + starting_frame_idx[valid]
+
+    votes = numpy.bincount(flat_idx, weights=1.0 / rank[valid], minlength=len(ad_lengths) * frames)
+    scores = votes.reshape(len(ad_lengths), frames) / numpy.asarray(ad_lengths, dtype=numpy.float64)[:, None]
+    matched_lengths = numpy.zeros(len(ad_lengths) * frames, dtype=numpy.int64)
+    numpy.maximum.at(matched_lengths, flat_idx, ad_frame_idx[valid])
+    return scores, matched_lengths.reshape(len(ad_lengths), frames)
+
+
+def hold_hits(hits, sample_positions, frames):
+    """
+    Place the hits of adaptively sampled frames at their positions, repeating them on the skipped positions up to
+    the next sampled frame, which looked the same.
+    :param hits: Tuple (video_frame_idx, ad_idx, ad_frame_idx, rank) of the sampled frames, see knn_hits
+    :param sample_positions: Increasing position of each sampled frame, see sample_positions
+    :param frames: Amount of positions; the last sampled frame stands for the positions up to it
+    :return: Hits over positions, ordered by position and then as given
+    """
+    video_frame_idx, ad_idx, ad_frame_idx, rank = hits
+    spans = numpy.diff(sample_positions, append=frames)[video_frame_idx]
+    repeated = numpy.repeat(numpy.arange(len(video_frame_idx)), spans)
+    # offset of each repetition from the position of its sampled frame
+    offsets = numpy.arange(len(repeated)) - numpy.repeat(numpy.cumsum(spans) - spans, spans)
+    positions = sample_positions[video_frame_idx][repeated] + offsets
+    order = numpy.argsort(positions, kind='stable')
+    return positions[order], ad_idx[repeated][order], ad_frame_idx[repeated][order], rank[repeated][order]
+
+
+def sample_positions(timestamps, sps=SAMPLES_PER_SECOND):
+    """
+    Position of each sampled frame among the samples at n / sps seconds, from its timestamp
+    :param timestamps: Time in seconds of each sampled frame, see feature_extraction.extract_features_from_video
+    :param sps: Samples per second of the sampling
+    :return: Integer array with the n of each sampled frame
+    """
+    return numpy.rint(numpy.asarray(timestamps, dtype=numpy.float64) * sps).astype(numpy.int64)
+
+
 def frame_idx_to_seconds(frame_idx, sps=SAMPLES_PER_SECOND):
     """
     Transform a frame_id to the timestamp in seconds of the video, based on the sampling configuration.
@@ -157,11 +467,12 @@ def frame_idx_to_seconds(frame_idx, sps=SAMPLES_PER_SECOND):
 def get_ad_lengths_in_frames(ads_features):
     """
     Self-explainatory
-    :param ads_features: has dimension [ad_idx, ad_frame_idx, feature_idx]
+    :param ads_features: has dimension [ad_idx, ad_frame_idx, feature_idx]; an AdLibrary is read from its table
     :return: Ad length in frames
     """
+    if isinstance(ads_features, AdLibrary):
+        return [int(length) for length in ads_features.lengths]
     ad_lengths_in_frames = []
     for ad_features in ads_features:
         ad_lengths_in_frames.append(ad_features.shape[0])
     return ad_lengths_in_frames
-
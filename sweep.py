@@ -0,0 +1,150 @@
+"""
+$ python sweep.py "full-length video filename" [...] "ad video-clip folder" [--k 1 3 5 10] [--thresholds 0.15 0.25 0.35]
+    [--ft-types SOBEL_THRESH_PACKED GRAY_SCALE] [--gt gt.txt] [--output sweep.tsv]
+
+Parameter sweep of K, SCORE_THRESHOLD and FeatureType, evaluated against the ground truth in memory.
+
+For each feature type, the features and the exact KNN of each TV video are computed once, at the largest K; neighbors
+are sorted nearest first, so the KNN of a smaller K is a slice of it. Each K is scored once with the lowest threshold,
+and the detections of every higher threshold are those scoring above it, so thresholds only filter detections before
+temporal NMS. Each configuration is evaluated with evaluar's interval-indexed matcher, and a table with its accuracy,
+false detections and runtime is written.
+"""
+import argparse
+import time
+
+import evaluar
+from adlookup import expand_video_filenames
+from src import feature_extraction, video_tools
+from src.configurations import K, SCORE_THRESHOLD
+from src.feature_extraction import FeatureType
+from src.online_detector import temporal_nms
+from src.video_tools import get_ad_lengths_in_frames
+
+COLUMNS = ("ft_type", "k", "threshold", "correctas", "falsas", "repetidas", "iou", "resultado", "features_seconds",
+           "knn_seconds", "detection_seconds")
+
+
+def sweep_detections(knn, ad_lengths, ks, thresholds, timestamps=None):
+    """
+    Detections of a video for every (K, threshold), from its KNN at the largest K
+    :param knn: Tuple (knn_ad_idx, knn_frame_idx) of the video, as returned by batch_knn with k >= max(ks)
+    :param ad_lengths: List of frames sampled for each ad
+    :param ks: Values of K
+    :param thresholds: Values of SCORE_THRESHOLD
+    :param timestamps: Optional time in seconds of each sampled frame of the video
+    :return: Dict mapping each (k, threshold) to a tuple (detections, seconds spent detecting them), detections as
+        adlookup.find_ads returns them
+    """
+    results = {}
+    for k in ks:
+        start = time.perf_counter()
+        candidates = video_tools.detect_ads(video_tools.knn_hits((knn[0][:, :k], knn[1][:, :k])), len(knn[0]),
+                                            ad_lengths, timestamps, score_threshold=min(thresholds))
+        scoring_seconds = time.perf_counter() - start
+        for threshold in thresholds:
+            start = time.perf_counter()
+            detections = temporal_nms([detection for detection in candidates if detection['score'] > threshold],
+                                      ad_lengths)
+            results[(k, threshold)] = detections, scoring_seconds + time.perf_counter() - start
+    return results
+
+
+def detection_lines(video_filename, detections, ad_video_names):
+    """
+    Detections as the lines adlookup.py writes, to be read by evaluar
+    """
+    return ["{}\t{}\t{}\t{}".format(video_filename, *video_tools.detection_seconds(detection),
+                                    ad_video_names[detection['ad_idx']]) for detection in detections]
+
+
+def sweep(video_filenames, ads_foldername, ks, thresholds, ft_types, detecciones_gt, workers=1):
+    """
+    Evaluate every combination of K, threshold and feature type
+    :param video_filenames: TV video filenames in DATA_FOLDER
+    :param ads_foldername: Ad video-clip folder in DATA_FOLDER
+    :param ks: Values of K
+    :param thresholds: Values of SCORE_THRESHOLD
+    :param ft_types: Feature types
+    :param detecciones_gt: Ground truth, as read by evaluar.leer_archivo_detecciones; airings in videos other than
+        video_filenames are ignored
+    :param workers: Amount of processes extracting features and searching the KNN
+    :return: List of rows, a dict with the COLUMNS of each configuration; features and KNN seconds are those of the
+        feature type, shared by its configurations
+    """
+    # every swept video counts, including those a configuration detects nothing in
+    videos_tv = {evaluar.get_videoname(video_filename) for video_filename in video_filenames}
+    detecciones_gt = evaluar.filtrar_gt_videos(videos_tv, detecciones_gt)
+    rows = []
+    for ft_type in ft_types:
+        hamming = ft_type == FeatureType.SOBEL_THRESH_PACKED
+        start = time.perf_counter()
+        ads_features, ad_video_names = feature_extraction.extract_features_from_video_folder(
+            ads_foldername, ft_type=ft_type, workers=workers)
+        ad_lengths = get_ad_lengths_in_frames(ads_features)
+        videos = [feature_extraction.extract_features_from_video(video_filename, ft_type=ft_type, workers=workers,
+                                                                 with_timestamps=True)
+                  for video_filename in video_filenames]
+        features_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        knns = [video_tools.batch_knn(video_features, ads_features, k=max(ks), hamming=hamming, workers=workers)
+                for video_features, _ in videos]
+        knn_seconds = time.perf_counter() - start
+
+        lines = {configuration: [] for configuration in ((k, threshold) for k in ks for threshold in thresholds)}
+        seconds = dict.fromkeys(lines, 0.0)
+        for video_filename, (_, timestamps), knn in zip(video_filenames, videos, knns):
+            for configuration, (detections, detection_seconds) in sweep_detections(knn, ad_lengths, ks, thresholds,
+                                                                                   timestamps).items():
+                lines[configuration] += detection_lines(video_filename, detections, ad_video_names)
+                seconds[configuration] += detection_seconds
+
+        for (k, threshold), configuration_lines in lines.items():
+            evaluation = evaluar.evaluar(evaluar.leer_lineas_detecciones(configuration_lines), detecciones_gt,
+                                         videos_tv)
+            rows.append(dict(evaluation, ft_type=ft_type.name, k=k, threshold=threshold,
+                             features_seconds=features_seconds, knn_seconds=knn_seconds,
+                             detection_seconds=seconds[(k, threshold)]))
+            print("info: {} K={} threshold={}: {} correct, {} false".format(ft_type.name, k, threshold,
+                                                                           evaluation['correctas'],
+                                                                           evaluation['falsas']))
+    return rows
+
+
+def write_table(rows, outfile):
+    """
+    Write the rows of a sweep as a tab separated table, best result first
+    :param rows: Rows, as returned by sweep
+    :param outfile: Path of the file to be written
+    :return: None
+    """
+    with open(outfile, 'w') as fp:
+        fp.write("\t".join(COLUMNS) + "\n")
+        for row in sorted(rows, key=lambda row: (-row['resultado'], -row['iou'])):
+            fp.write("\t".join(str(round(row[column], 3)) if isinstance(row[column], float) else str(row[column])
+                               for column in COLUMNS) + "\n")
+    print("info: Sweep results exported to {}".format(outfile))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Evaluate detections for every combination of K, score threshold "
+                                                 "and feature type, reusing features and KNN.")
+    parser.add_argument("video_filenames", nargs="+",
+                        help="full-length video filenames, or glob patterns, relative to DATA_FOLDER")
+    parser.add_argument("ads_foldername", help="ad video-clip folder")
+    parser.add_argument("--k", type=int, nargs="+", default=[1, 3, K], help="values of K")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[SCORE_THRESHOLD],
+                        help="values of SCORE_THRESHOLD")
+    parser.add_argument("--ft-types", nargs="+", default=[FeatureType.SOBEL_THRESH_PACKED.name],
+                        choices=[ft_type.name for ft_type in FeatureType], help="feature types")
+    parser.add_argument("--gt", default="gt.txt", help="ground truth, in the format of the detections file")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processes extracting features and searching the KNN")
+    parser.add_argument("--output", default="sweep.tsv", help="table to be written")
+    args = parser.parse_args()
+
+    rows = sweep(expand_video_filenames(args.video_filenames), args.ads_foldername, sorted(set(args.k)),
+                 sorted(set(args.thresholds)), [FeatureType[name] for name in args.ft_types],
+                 evaluar.leer_archivo_detecciones(args.gt), args.workers)
+    write_table(rows, args.output)
@@ -1,6 +1,48 @@
+import asyncio
+import json
+import os
+import tempfile
+import time
 import unittest
+from contextlib import contextmanager, ExitStack
+from multiprocessing import Pool
+from pathlib import Path
+from unittest import mock
 
-from src import feature_extraction, video_tools
+import cv2
+import numpy
+
+import adlookup
+import adlookupd
+import evaluar
+import sweep
+from src import feature_extraction, video_tools, ann_index, cache_manager, ad_library, metrics, coarse_to_fine, \
+    projection, frame_dedup, online_detector, fingerprint
+from src.metrics import METRICS
+
+
+@contextmanager
+def temporary_cache():
+    """
+    Point the cache at a temporary folder, so tests neither read nor leave entries in CACHE_FOLDER
+    """
+    with tempfile.TemporaryDirectory() as folder, mock.patch.object(cache_manager, 'CACHE_FOLDER', Path(folder)):
+        try:
+            yield Path(folder)
+        finally:
+            cache_manager.flush_accesses()
+
+
+# every test runs against a temporary cache; tests checking cache entries use a fresh one of their own
+_module_cache = ExitStack()
+
+
+def setUpModule():
+    _module_cache.enter_context(temporary_cache())
+
+
+def tearDownModule():
+    _module_cache.close()
 
 
 class TestFeatureExtraction(unittest.TestCase):
@@ -16,6 +58,71 @@ class TestFeatureExtraction(unittest.TestCase):
         )
         self.assertTrue(features.any())
 
+    def test_parallel_extraction_matches_sequential_extraction(self):
+        with tempfile.TemporaryDirectory() as folder:
+            write_test_video(Path(folder) / "video.avi", 200)
+            sequential = feature_extraction.extract_features_from_video(
+                "video.avi", data_folder_path=Path(folder), use_cache=False)
+            parallel = feature_extraction.extract_features_from_video(
+                "video.avi", data_folder_path=Path(folder), use_cache=False, workers=3)
+        numpy.testing.assert_array_equal(sequential, parallel)
+
+    def test_batch_features_match_opencv(self):
+        random = numpy.random.RandomState(0)
+        frames = [cv2.resize(random.randint(0, 256, (15, 20, 3)).astype(numpy.uint8), (160, 120))
+                  for _ in range(10)]
+        gray_frames = [cv2.cvtColor(cv2.resize(frame, (32, 32)), cv2.COLOR_BGR2GRAY) for frame in frames]
+        grad_x = numpy.asarray([cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3).ravel() for gray in gray_frames])
+        grad_y = numpy.asarray([cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=3).ravel() for gray in gray_frames])
+        thresh = numpy.asarray([cv2.threshold(numpy.sqrt(numpy.square(x) + numpy.square(y)), 100, 255,
+                                              cv2.THRESH_BINARY)[1] for x, y in zip(grad_x, grad_y)]).reshape(10, -1)
+
+        kernel = feature_extraction.FeatureKernel(feature_extraction.FeatureType.SOBEL_THRESH_BINARY, capacity=3,
+                                                  batch_size=4)
+        for frame in frames:
+            kernel.add(frame)
+        numpy.testing.assert_array_equal(kernel.features(), thresh)
+        concat = feature_extraction.frame_features(frames[0], feature_extraction.FeatureType.SOBEL_GRAD_CONCAT)
+        numpy.testing.assert_array_equal(concat, numpy.concatenate((grad_x[0], grad_y[0])))
+
+    def test_sampling_follows_timestamps(self):
+        with tempfile.TemporaryDirectory() as folder:
+            write_test_video(Path(folder) / "video.avi", 100, fps=25)
+            sequential, timestamps = feature_extraction.extract_features_from_video(
+                "video.avi", data_folder_path=Path(folder), use_cache=False, with_timestamps=True)
+            seeking, seeking_timestamps = feature_extraction.extract_features_from_video(
+                "video.avi", data_folder_path=Path(folder), use_cache=False, with_timestamps=True,
+                seek_min_frames=1)
+        # 4 seconds at 2 samples per second, each sample being the frame shown at n / 2 seconds
+        numpy.testing.assert_allclose(timestamps, numpy.arange(8) / 2.0, atol=0.5 / 25)
+        numpy.testing.assert_array_equal(sequential, seeking)
+        numpy.testing.assert_array_equal(timestamps, seeking_timestamps)
+
+
+def write_test_video(path, frames, fps=30, seed=0, splices=None, hold=1):
+    """
+    Write a video of random frames, each shown for hold frames; splices maps frame indexes to videos copied into
+    the video from there on
+    """
+    random = numpy.random.RandomState(seed)
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*'MJPG'), fps, (160, 120))
+    frame_idx = 0
+    while frame_idx < frames:
+        if splices and frame_idx in splices:
+            capture = cv2.VideoCapture(str(splices[frame_idx]))
+            retval, frame = capture.read()
+            while retval:
+                writer.write(frame)
+                frame_idx += 1
+                retval, frame = capture.read()
+            continue
+        if frame_idx % hold == 0:
+            frame = cv2.resize(random.randint(0, 256, (15, 20, 3)).astype(numpy.uint8), (160, 120),
+                               interpolation=cv2.INTER_NEAREST)
+        writer.write(frame)
+        frame_idx += 1
+    writer.release()
+
 
 class TestKNN(unittest.TestCase):
 
@@ -27,27 +134,648 @@ class TestKNN(unittest.TestCase):
 
         video_ftrs = video
         ads_ftrs = [ad0, ad1]
-        knn = video_tools.batch_knn(video_ftrs, ads_ftrs, use_cache=False)
+        knn_ad_idx, knn_frame_idx = video_tools.batch_knn(video_ftrs, ads_ftrs, k=1, use_cache=False)
         # manual detection
         # 1st ad
-        self.assertEqual(knn[7][0], '0_0')
-        self.assertEqual(knn[8][0], '0_1')
-        self.assertEqual(knn[9][0], '0_2')
+        self.assertEqual((knn_ad_idx[7][0], knn_frame_idx[7][0]), (0, 0))
+        self.assertEqual((knn_ad_idx[8][0], knn_frame_idx[8][0]), (0, 1))
+        self.assertEqual((knn_ad_idx[9][0], knn_frame_idx[9][0]), (0, 2))
 
         # 2nd ad
-        self.assertEqual(knn[3][0], '1_0')
-        self.assertEqual(knn[4][0], '1_1')
+        self.assertEqual((knn_ad_idx[3][0], knn_frame_idx[3][0]), (1, 0))
+        self.assertEqual((knn_ad_idx[4][0], knn_frame_idx[4][0]), (1, 1))
 
         # automated detection
-        detections = video_tools.ads_detector(knn, [len(ad0), len(ad1)])
-        # 1st ad
-        starting_frame = detections[0]['starting_frame']
-        for ad_frame_idx, ad_frame in enumerate(ad0):
-            self.assertEqual(video[starting_frame+ad_frame_idx], ad_frame)
+        detections = video_tools.ads_detector((knn_ad_idx, knn_frame_idx), "video", [len(ad0), len(ad1)],
+                                              ["ad0", "ad1"])
+        # the best scoring detection of each ad is its appearance
+        best = {}
+        for detection in detections:
+            if detection['score'] > best.get(detection['ad_idx'], {'score': 0})['score']:
+                best[detection['ad_idx']] = detection
+        for ad_idx, ad in enumerate(ads_ftrs):
+            starting_frame = best[ad_idx]['starting_frame']
+            for ad_frame_idx, ad_frame in enumerate(ad):
+                self.assertEqual(video[starting_frame+ad_frame_idx], ad_frame)
+        self.assertEqual([best[0]['starting_frame'], best[1]['starting_frame']], [7, 3])
+
+    def test_knn_search_matches_brute_force_sort(self):
+        random = numpy.random.RandomState(0)
+        # few distinct values, so many distances tie
+        ads_matrix = random.randint(0, 3, (200, 4))
+        video = random.randint(0, 3, (70, 4))
+        distances = ((video[:, None, :] - ads_matrix[None, :, :]) ** 2).sum(axis=2)
+        for k in (1, 5, 200):
+            expected = numpy.argsort(distances, axis=1, kind='stable')[:, :k]
+            columns, top_distances = video_tools.knn_search(video, ads_matrix, k=k, block_size=16)
+            numpy.testing.assert_array_equal(columns, expected)
+            numpy.testing.assert_array_equal(top_distances, numpy.take_along_axis(distances, expected, axis=1))
+            numpy.testing.assert_array_equal(video_tools.top_k(distances, k)[0], expected)
+
+    def test_hamming_knn_matches_euclidean(self):
+        random = numpy.random.RandomState(0)
+        ads = [random.rand(length, 1024) > 0.7 for length in (20, 30, 10)]
+        video = random.rand(100, 1024) > 0.7
+        video[40:70] = ads[1]
+
+        euclidean_knn = video_tools.batch_knn(video * 255.0, [ad * 255.0 for ad in ads], use_cache=False)
+        hamming_knn = video_tools.batch_knn(numpy.packbits(video, axis=1),
+                                            [numpy.packbits(ad, axis=1) for ad in ads],
+                                            use_cache=False, hamming=True)
+        numpy.testing.assert_array_equal(euclidean_knn[0], hamming_knn[0])
+        numpy.testing.assert_array_equal(euclidean_knn[1], hamming_knn[1])
+        numpy.testing.assert_array_equal(feature_extraction.unpack_features(numpy.packbits(video, axis=1)),
+                                         video * 255.0)
+
+    def test_ann_index_probing_every_list_is_exact(self):
+        random = numpy.random.RandomState(0)
+        ads = [numpy.packbits(random.rand(length, 1024) > 0.7, axis=1) for length in (40, 60, 30)]
+        video = numpy.packbits(random.rand(50, 1024) > 0.7, axis=1)
+        ads_matrix, _, _ = video_tools.flatten_ads_features(ads)
+
+        index = ann_index.IVFIndex.build(ads_matrix, hamming=True, nlist=8)
+        exact_knn = video_tools.batch_knn(video, ads, use_cache=False, hamming=True)
+        index_knn = video_tools.batch_knn(video, ads, use_cache=False, hamming=True, index=index, nprobe=8)
+        numpy.testing.assert_array_equal(exact_knn[0], index_knn[0])
+        numpy.testing.assert_array_equal(exact_knn[1], index_knn[1])
+
+    def test_ann_index_searches_the_probed_lists_of_each_frame(self):
+        random = numpy.random.RandomState(0)
+        ads_matrix = random.rand(300, 16)
+        video = random.rand(40, 16)
+        index = ann_index.IVFIndex.build(ads_matrix, nlist=12)
+        columns, distances = index.search(video, k=5, nprobe=2, block_size=16)
+        list_sizes = numpy.diff(index.list_offsets)
+        for row, frame in enumerate(video):
+            lists = video_tools.knn_search(frame[None], index.centroids, k=index.nlist)[0][0]
+            probed = max(2, numpy.searchsorted(numpy.cumsum(list_sizes[lists]), 5) + 1)
+            candidates = numpy.sort(numpy.concatenate([index.list_rows[index.list_offsets[l]:index.list_offsets[l + 1]]
+                                                       for l in lists[:probed]]))
+            expected_columns, expected_distances = video_tools.knn_search(frame[None], ads_matrix[candidates], k=5)
+            numpy.testing.assert_array_equal(columns[row], candidates[expected_columns[0]])
+            numpy.testing.assert_allclose(distances[row], expected_distances[0])
+
+    def test_parallel_knn_matches_single_process(self):
+        random = numpy.random.RandomState(0)
+        ads = [random.rand(length, 100) * 255 for length in (40, 7, 90, 3)]
+        video = random.rand(300, 100) * 255
+        packed_ads = [numpy.packbits(random.rand(length, 1024) > 0.7, axis=1) for length in (40, 7, 90)]
+        packed_video = numpy.packbits(random.rand(300, 1024) > 0.7, axis=1)
+        for video_features, ads_features, hamming in ((video, ads, False), (packed_video, packed_ads, True)):
+            single = video_tools.batch_knn(video_features, ads_features, use_cache=False, block_size=32,
+                                           hamming=hamming)
+            parallel = video_tools.batch_knn(video_features, ads_features, use_cache=False, block_size=32,
+                                             hamming=hamming, workers=3)
+            numpy.testing.assert_array_equal(single[0], parallel[0])
+            numpy.testing.assert_array_equal(single[1], parallel[1])
+
+    def test_projection_with_full_shortlist_is_exact(self):
+        random = numpy.random.RandomState(0)
+        ads = [random.randint(0, 8, (length, 64)) for length in (40, 60, 30)]
+        video = random.randint(0, 8, (50, 64))
+        ads_matrix, _, _ = video_tools.flatten_ads_features(ads)
+        exact_knn = video_tools.batch_knn(video, ads, use_cache=False)
+        for method in projection.PROJECTION_METHODS:
+            index = projection.ProjectionIndex.build(ads_matrix, dimensions=8, method=method, shortlist=130)
+            index_knn = video_tools.batch_knn(video, ads, use_cache=False, index=index)
+            numpy.testing.assert_array_equal(exact_knn[0], index_knn[0])
+            numpy.testing.assert_array_equal(exact_knn[1], index_knn[1])
+
+    def test_projection_shortlist_holds_the_nearest_projected_frames(self):
+        random = numpy.random.RandomState(0)
+        ads_matrix = random.randint(0, 8, (130, 64))
+        video = random.randint(0, 8, (50, 64))
+        index = projection.ProjectionIndex.build(ads_matrix, dimensions=8, shortlist=20)
+        expected, _ = video_tools.knn_search(index.project(video), index.project(ads_matrix), 20)
+        shortlist = index._shortlist(video, 20)
+        numpy.testing.assert_array_equal(numpy.sort(expected, axis=1), shortlist)
+
+    def test_agreement_report_warns_when_configured_shortlist_misses_target(self):
+        random = numpy.random.RandomState(0)
+        index = projection.ProjectionIndex.build(random.rand(200, 32), dimensions=2, method="random", shortlist=5)
+        with mock.patch('builtins.print') as printed:
+            report = projection.agreement_report(index, random.rand(30, 32), k=5, shortlists=(200,))
+        self.assertEqual([5, 200], [row['shortlist'] for row in report])
+        self.assertEqual([False, True], [row['target_met'] for row in report])
+        self.assertEqual(5, index.shortlist)
+        self.assertTrue(any(str(call[0][0]).startswith("warning: the configured PROJECTION_SHORTLIST of 5")
+                            for call in printed.call_args_list))
+
+    def test_ad_library_matches_per_ad_features(self):
+        random = numpy.random.RandomState(0)
+        ads = [random.rand(length, 16) for length in (4, 7, 2)]
+        lengths = numpy.array([len(ad) for ad in ads])
+        library = ad_library.AdLibrary(numpy.concatenate(ads), numpy.concatenate(([0], numpy.cumsum(lengths)[:-1])),
+                                       lengths, ["a", "b", "c"], ["", "", ""], "key")
+
+        for ad_features, library_features in zip(ads, library):
+            numpy.testing.assert_array_equal(ad_features, library_features)
+        self.assertEqual(video_tools.get_ad_lengths_in_frames(library), video_tools.get_ad_lengths_in_frames(ads))
+        for flattened, library_flattened in zip(video_tools.flatten_ads_features(ads), library.flattened()):
+            numpy.testing.assert_array_equal(flattened, library_flattened)
+
+    def test_ad_library_round_trips_through_the_cache(self):
+        ft_type = feature_extraction.FeatureType.SOBEL_THRESH_PACKED
+        with temporary_cache(), tempfile.TemporaryDirectory() as folder:
+            write_test_video(Path(folder) / "b.avi", 60, seed=2)
+            write_test_video(Path(folder) / "a.avi", 90, seed=1)
+            built, names = feature_extraction.extract_features_from_video_folder(folder, video_extensions=["avi"],
+                                                                                 ft_type=ft_type)
+            METRICS.reset()
+            loaded, loaded_names = feature_extraction.extract_features_from_video_folder(
+                folder, video_extensions=["avi"], ft_type=ft_type)
+            # the library is opened memory-mapped, without reading the features of each video
+            self.assertIsInstance(loaded.matrix, numpy.memmap)
+            self.assertEqual(METRICS.counters["cache_hits"], 2)
+            self.assertEqual((names, loaded_names, loaded.names), (["a", "b"], ["a", "b"], ["a", "b"]))
+            for name, built_features, loaded_features in zip(names, built, loaded):
+                expected = feature_extraction.extract_features_from_video(name + ".avi", ft_type=ft_type,
+                                                                          data_folder_path=Path(folder),
+                                                                          use_cache=False)
+                numpy.testing.assert_array_equal(built_features, expected)
+                numpy.testing.assert_array_equal(loaded_features, expected)
+
+    def test_partitioned_knn_after_library_changes(self):
+        random = numpy.random.RandomState(1)
+        ads = [numpy.packbits(random.rand(length, 1024) > 0.7, axis=1) for length in (30, 40, 20, 25)]
+        video = numpy.packbits(random.rand(100, 1024) > 0.7, axis=1)
+        video[10:50] = ads[1]
+
+        with temporary_cache():
+            video_tools.batch_knn(video, ads[:3], hamming=True)
+            # the added ad is searched, and a removed one isn't merged
+            for library, searched in ((ads, 1), (ads[:1] + ads[2:], 0)):
+                METRICS.reset()
+                incremental_knn = video_tools.batch_knn(video, library, hamming=True)
+                self.assertEqual(METRICS.counters["knn_ads_searched"], searched)
+                exact_knn = video_tools.search_knn(video, video_tools.flatten_ads_features(library), hamming=True)
+                numpy.testing.assert_array_equal(exact_knn[0], incremental_knn[0])
+                numpy.testing.assert_array_equal(exact_knn[1], incremental_knn[1])
+
+            # a library searched before is a single cache entry
+            METRICS.reset()
+            cached_knn = video_tools.batch_knn(video, ads, hamming=True)
+            self.assertEqual((METRICS.counters.get("knn_ads_searched"), METRICS.counters["cache_hits"]), (None, 1))
+            exact_knn = video_tools.search_knn(video, video_tools.flatten_ads_features(ads), hamming=True)
+            numpy.testing.assert_array_equal(exact_knn[0], cached_knn[0])
+            numpy.testing.assert_array_equal(exact_knn[1], cached_knn[1])
+
+
+class TestAdsDetector(unittest.TestCase):
+
+    def test_sequence_scores_match_frame_by_frame_scoring(self):
+        ad_lengths = [3, 4]
+        knn_ad_idx = numpy.array([[0, 1], [1, 0], [0, 1], [1, 0], [1, 0], [0, 1]])
+        knn_frame_idx = numpy.array([[0, 0], [1, 1], [2, 2], [3, 0], [0, 1], [2, 3]])
+        scores, matched_lengths = video_tools.score_sequences(
+            video_tools.knn_hits((knn_ad_idx, knn_frame_idx)), ad_lengths, len(knn_ad_idx))
+
+        for ad_idx, ad_length in enumerate(ad_lengths):
+            for starting_frame in range(len(knn_ad_idx)):
+                score, last_match = 0, 0
+                for ad_frame_idx in range(min(ad_length, len(knn_ad_idx) - starting_frame)):
+                    video_frame = starting_frame + ad_frame_idx
+                    row = list(zip(knn_ad_idx[video_frame], knn_frame_idx[video_frame]))
+                    if (ad_idx, ad_frame_idx) in row:
+                        score += 1.0 / (row.index((ad_idx, ad_frame_idx)) + 1)
+                        last_match = ad_frame_idx
+                self.assertEqual(scores[ad_idx, starting_frame], score / ad_length)
+                self.assertEqual(matched_lengths[ad_idx, starting_frame], last_match)
+
+    def test_online_detector_emits_one_event_per_airing(self):
+        random = numpy.random.RandomState(0)
+        ad_lengths = [5, 17, 9]
+        knn_ad_idx = random.randint(0, 3, (300, 5))
+        knn_frame_idx = random.randint(0, 5, (300, 5))
+        # an airing of ad 1 at frame 100, also matched one frame late by the second neighbors
+        knn_ad_idx[100:117, 0], knn_frame_idx[100:117, 0] = 1, numpy.arange(17)
+        knn_ad_idx[101:118, 1], knn_frame_idx[101:118, 1] = 1, numpy.arange(17)
+        knn_ad_idx[295:, 1], knn_frame_idx[295:, 1] = 2, numpy.arange(5)
+        knn = (knn_ad_idx, knn_frame_idx)
+        candidates = video_tools.detect_ads(video_tools.knn_hits(knn), len(knn_ad_idx), ad_lengths)
+        self.assertIn((101, 1), [(d['starting_frame'], d['ad_idx']) for d in candidates])
+
+        every_candidate = online_detector.OnlineAdsDetector(ad_lengths, max_overlap=None)
+        self.assertEqual(sorted(every_candidate.feed(knn) + every_candidate.flush(),
+                                key=lambda d: (d['starting_frame'], d['ad_idx'])), candidates)
+
+        # emitted max(ad_lengths) - 1 frames after the last ad of its window of chained candidates ends
+        windows = []
+        for candidate in candidates:
+            chained = [window for window in windows
+                       if any(online_detector.overlaps(candidate, d, ad_lengths, 0.5) for d in window)]
+            windows = [window for window in windows if all(window is not other for other in chained)] + \
+                [sum(chained, [candidate])]
+        closing_frames = {}
+        for window in windows:
+            closing_frame = max(d['starting_frame'] + ad_lengths[d['ad_idx']] - 1 for d in window) + 16
+            closing_frames.update(((d['starting_frame'], d['ad_idx']), closing_frame) for d in window)
+        detector = online_detector.OnlineAdsDetector(ad_lengths, max_overlap=0.5)
+        events = []
+        for frame, row in enumerate(zip(*knn)):
+            for event in detector.push(*row):
+                self.assertEqual(frame, closing_frames[(event['starting_frame'], event['ad_idx'])])
+                events.append(event)
+        events += detector.flush()
+        self.assertEqual(sorted(events, key=lambda d: d['starting_frame']),
+                         online_detector.temporal_nms(candidates, ad_lengths, 0.5))
+        self.assertEqual([d['starting_frame'] for d in events if d['ad_idx'] == 1], [100])
+
+    def test_streamed_chunks_match_batch_detection(self):
+        with tempfile.TemporaryDirectory() as folder:
+            folder = Path(folder).resolve()
+            (folder / "ads").mkdir()
+            write_test_video(folder / "ads" / "ad.mp4", 300, seed=1)
+            write_test_video(folder / "ads" / "other_ad.mp4", 240, seed=2)
+            write_test_video(folder / "video.mp4", 1500, seed=0,
+                             splices={300: folder / "ads" / "other_ad.mp4", 900: folder / "ads" / "ad.mp4"})
+            library = adlookup.load_library(str(folder / "ads"), feature_extraction.FeatureType.SOBEL_THRESH_PACKED,
+                                            dedup=False)
+            batch = adlookup.find_ads(str(folder / "video.mp4"), **library)
+            iter_features_from_video = feature_extraction.iter_features_from_video
+            # chunks much shorter than the video and than the ads, so airings span several chunks
+            with mock.patch.object(feature_extraction, 'iter_features_from_video',
+                                   lambda *args, **kwargs: iter_features_from_video(*args, chunk_size=7, **kwargs)):
+                streamed = adlookup.find_ads(str(folder / "video.mp4"), stream=True, **library)
+        self.assertEqual([(detection['ad_idx'], detection['starting_frame']) for detection in batch],
+                         [(1, 20), (0, 60)])
+        self.assertEqual(streamed, batch)
+
+    def test_online_detector_memory_is_bounded_along_a_chain(self):
+        # an airing of a 30 frame ad starting every 10 frames, scoring 1, 1/3 and 1/2 in turn, each overlapping the
+        # next by 20 frames, so every candidate is chained
+        frames = numpy.arange(3000)[:, None]
+        knn = (numpy.zeros((3000, 3), dtype=numpy.int64), (frames + numpy.array([0, 10, 20])) % 30)
+        candidates = video_tools.detect_ads(video_tools.knn_hits(knn), 3000, [30])
+        self.assertEqual(len(candidates), 298)
+        detector = online_detector.OnlineAdsDetector([30], max_window=8)
+        events = []
+        largest_window = 0
+        for row in zip(*knn):
+            events += detector.push(*row)
+            largest_window = max([largest_window] + [len(window['candidates']) for window in detector.windows])
+        events += detector.flush()
+        self.assertLessEqual(largest_window, 8 + 3)
+        self.assertEqual(events, online_detector.temporal_nms(candidates, [30]))
+        self.assertEqual([event['starting_frame'] for event in events], list(range(0, 2971, 30)))
+
+    def test_chained_overlaps_keep_the_first_airing(self):
+        ad_lengths = [30, 30, 30]
+        candidates = [{'ad_idx': 0, 'ad_length_in_frames': 29, 'score': 0.5, 'starting_frame': 0},
+                      {'ad_idx': 1, 'ad_length_in_frames': 29, 'score': 0.6, 'starting_frame': 14},
+                      {'ad_idx': 2, 'ad_length_in_frames': 29, 'score': 0.7, 'starting_frame': 28}]
+        # the second overlaps both others, but suppressed by the third it can't suppress the first
+        self.assertEqual(online_detector.temporal_nms(candidates, ad_lengths, 0.5), [candidates[0], candidates[2]])
+        self.assertEqual(online_detector.temporal_nms(candidates[::-1], ad_lengths, 0.5),
+                         [candidates[0], candidates[2]])
+
+        # the same airings matched by the third, second and first neighbors, scoring 1/3, 1/2 and 1
+        knn_ad_idx = numpy.zeros((100, 3), dtype=numpy.int64)
+        knn_frame_idx = numpy.full((100, 3), 40)  # too few votes at a single starting frame to be detected
+        for candidate in candidates:
+            column = 2 - candidate['ad_idx']
+            frames = slice(candidate['starting_frame'], candidate['starting_frame'] + 30)
+            knn_ad_idx[frames, column], knn_frame_idx[frames, column] = candidate['ad_idx'], numpy.arange(30)
+        knn = (knn_ad_idx, knn_frame_idx)
+        detector = online_detector.OnlineAdsDetector(ad_lengths, score_threshold=0.3, max_overlap=0.5)
+        events = detector.feed(knn) + detector.flush()
+        self.assertEqual([(d['starting_frame'], d['ad_idx']) for d in events], [(0, 0), (28, 2)])
+
+    def test_coarse_to_fine_matches_single_pass(self):
+        ft_type = feature_extraction.FeatureType.SOBEL_THRESH_PACKED
+        with tempfile.TemporaryDirectory() as folder:
+            folder = Path(folder)
+            write_test_video(folder / "ad.avi", 300, seed=1)
+            write_test_video(folder / "other_ad.avi", 240, seed=2)
+            write_test_video(folder / "video.avi", 2400, seed=0, splices={900: folder / "ad.avi"})
+            ads = [feature_extraction.extract_features_from_video(filename, ft_type=ft_type, data_folder_path=folder,
+                                                                  use_cache=False)
+                   for filename in ("ad.avi", "other_ad.avi")]
+            video, timestamps = feature_extraction.extract_features_from_video(
+                "video.avi", ft_type=ft_type, data_folder_path=folder, use_cache=False, with_timestamps=True)
+            knn = video_tools.batch_knn(video, ads, use_cache=False, hamming=True)
+            single_pass = video_tools.ads_detector(knn, "video", video_tools.get_ad_lengths_in_frames(ads),
+                                                   ["ad", "other_ad"], outfile=None, timestamps=timestamps)
+            two_pass = [coarse_to_fine.coarse_to_fine_ads_detector("video.avi", ads, ["ad", "other_ad"], ft_type,
+                                                                   data_folder_path=folder, use_cache=False,
+                                                                   outfile=None, workers=workers)
+                        for workers in (1, 2)]
+        self.assertTrue(any(detection['ad_idx'] == 0 for detection in single_pass))
+        self.assertEqual(two_pass, [single_pass, single_pass])
+
+    def test_adaptive_sampling_matches_uniform_sampling_on_static_shots(self):
+        ft_type = feature_extraction.FeatureType.SOBEL_THRESH_PACKED
+        with tempfile.TemporaryDirectory() as folder:
+            folder = Path(folder)
+            write_test_video(folder / "ad.avi", 300, seed=1)
+            write_test_video(folder / "static.avi", 450, seed=2, hold=450)
+            write_test_video(folder / "video.avi", 2400, seed=0,
+                             splices={300: folder / "static.avi", 900: folder / "ad.avi", 1500: folder / "static.avi"})
+            ads = [feature_extraction.extract_features_from_video("ad.avi", ft_type=ft_type, data_folder_path=folder,
+                                                                  use_cache=False)]
+            detections = []
+            for adaptive in (False, True):
+                video, timestamps = feature_extraction.extract_features_from_video(
+                    "video.avi", ft_type=ft_type, data_folder_path=folder, use_cache=False, with_timestamps=True,
+                    adaptive=adaptive)
+                knn = video_tools.batch_knn(video, ads, use_cache=False, hamming=True)
+                positions = video_tools.sample_positions(timestamps) if adaptive else None
+                detections.append(video_tools.ads_detector(knn, "video", [len(ads[0])], ["ad"], outfile=None,
+                                                           sample_positions=positions))
+                if adaptive:
+                    # 15 seconds of each static shot are sampled once every ADAPTIVE_MAX_GAP_SECONDS at most
+                    self.assertLessEqual(len(video), 160 - 2 * (30 - 4))
+        self.assertTrue(detections[0])
+        self.assertEqual(detections[1], detections[0])
+
+    def test_fingerprints_find_airings_off_the_sampling_phase(self):
+        ft_type = feature_extraction.FeatureType.SOBEL_THRESH_PACKED
+        phases = 4
+        with tempfile.TemporaryDirectory() as folder:
+            folder = Path(folder)
+            write_test_video(folder / "ad.avi", 240, fps=24, seed=1)
+            write_test_video(folder / "other_ad.avi", 240, fps=24, seed=3)
+            # at 2 samples per second, the second airing starts a quarter of a sampling period late
+            write_test_video(folder / "video.avi", 2400, fps=24, seed=0,
+                             splices={480: folder / "ad.avi", 1443: folder / "ad.avi"})
+            dense_ads = [feature_extraction.extract_features_from_video(
+                name, sps=video_tools.SAMPLES_PER_SECOND * phases, ft_type=ft_type, data_folder_path=folder,
+                use_cache=False) for name in ("ad.avi", "other_ad.avi")]
+            video = feature_extraction.extract_features_from_video("video.avi", ft_type=ft_type,
+                                                                   data_folder_path=folder, use_cache=False)
+        index = fingerprint.FingerprintIndex.build([[ad[phase::phases] for phase in range(phases)]
+                                                    for ad in dense_ads], hamming=True)
+        detections = online_detector.temporal_nms(index.detect(video), index.ad_lengths)
+        self.assertEqual([(d['ad_idx'], d['starting_frame']) for d in detections], [(0, 40), (0, 120)])
+
+    def test_frame_clusters_match_leader_clustering(self):
+        random = numpy.random.RandomState(0)
+        # 150 distinct frames, most of them repeated, so representatives are found along many blocks
+        ads_matrix = random.randint(0, 256, (150, 16))[random.randint(0, 150, 400)]
+        threshold = 0.1 * frame_dedup.normalized_distance_scale(16)
+        leaders, expected = [], []
+        for row in ads_matrix:
+            distances = [((row - ads_matrix[leader]) ** 2).sum() for leader in leaders]
+            if not distances or min(distances) > threshold:
+                leaders.append(len(expected))
+                expected.append(len(leaders) - 1)
+            else:
+                expected.append(int(numpy.argmin(distances)))
+        for block_size in (7, 64, 400):
+            representative_rows, assignment = frame_dedup.cluster_frames(ads_matrix, max_distance=0.1,
+                                                                         block_size=block_size)
+            self.assertEqual(list(representative_rows), leaders)
+            self.assertEqual(list(assignment), expected)
+
+    def test_deduplicated_library_scores_every_ad_frame(self):
+        random = numpy.random.RandomState(0)
+        black = numpy.zeros((2, 64))
+        end_card = random.randint(1, 256, (3, 64))
+        ads = [numpy.concatenate((black, random.randint(1, 256, (15, 64)), end_card)),
+               numpy.concatenate((black, random.randint(1, 256, (25, 64)), end_card))]
+        video = numpy.concatenate((random.randint(1, 256, (30, 64)), ads[0], random.randint(1, 256, (30, 64))))
+
+        deduped = frame_dedup.deduplicate(ads, max_distance=0.01, min_information=0.5)
+        # black frames and the end card are kept once, and the black frame is a stop-frame
+        self.assertEqual(len(deduped.representative_rows), 1 + 15 + 3 + 25)
+        self.assertEqual(len(deduped.searched), 15 + 3 + 25)
+        representative_knn = deduped.search(video, k=2)
+        detections = video_tools.detect_ads(deduped.hits(representative_knn), len(video), [20, 30])
+        # every frame of the ad but the black ones votes for its starting frame
+        self.assertEqual([(d['ad_idx'], d['starting_frame'], d['score']) for d in detections], [(0, 30, 0.9)])
+        # the nearest neighbor of the first end card frame votes for both ads
+        _, ad_idx, ad_frame_idx, rank = deduped.hits(representative_knn[47:48, :1])
+        self.assertEqual(list(zip(ad_idx, ad_frame_idx, rank)), [(0, 17, 1), (1, 27, 1)])
+
+
+class TestBatchMode(unittest.TestCase):
+
+    def test_video_patterns_expand_in_order_without_repeats(self):
+        with tempfile.TemporaryDirectory() as folder:
+            for filename in ("b.mp4", "a.mp4", "c.mpg"):
+                (Path(folder) / filename).touch()
+            with mock.patch.object(adlookup, 'DATA_FOLDER', Path(folder)):
+                video_filenames = adlookup.expand_video_filenames(["c.mpg", "*.mp4", "a.mp4", "missing.mp4"])
+        self.assertEqual(video_filenames, ["c.mpg", "a.mp4", "b.mp4", "missing.mp4"])
+
+    def test_detections_of_videos_are_written_to_one_file(self):
+        detections = [{'ad_idx': 1, 'ad_length_in_frames': 20, 'score': 0.9, 'starting_frame': 10},
+                      {'ad_idx': 0, 'ad_length_in_frames': 9, 'score': 0.5, 'starting_frame': 40,
+                       'starting_second': 20.021}]
+        with tempfile.TemporaryDirectory() as folder:
+            outfile = str(Path(folder) / "detecciones.txt")
+            video_tools.write_detections_of_videos([("b.mp4", detections), ("a.mp4", []), ("c.mp4", detections[:1])],
+                                                   ["ad0", "ad1"], outfile)
+            with open(outfile) as fp:
+                lines = fp.read().splitlines()
+        self.assertEqual(lines, ["b.mp4\t5.0\t10.0\tad1", "b.mp4\t20.021\t4.5\tad0", "c.mp4\t5.0\t10.0\tad1"])
+
+    def test_worker_pool_matches_sequential_detection(self):
+        with temporary_cache(), tempfile.TemporaryDirectory() as folder:
+            folder = Path(folder).resolve()
+            (folder / "ads").mkdir()
+            write_test_video(folder / "ads" / "ad.mp4", 300, seed=1)
+            video_filenames = [str(folder / "video0.mp4"), str(folder / "video1.mp4")]
+            write_test_video(video_filenames[0], 1200, seed=0, splices={600: folder / "ads" / "ad.mp4"})
+            write_test_video(video_filenames[1], 900, seed=2, splices={90: folder / "ads" / "ad.mp4"})
+            library = adlookup.load_library(str(folder / "ads"), feature_extraction.FeatureType.SOBEL_THRESH_PACKED)
+            expected = [adlookup.find_ads(video_filename, **library) for video_filename in video_filenames]
+            with Pool(2, initializer=adlookup._init_worker,
+                      initargs=(library['ads_features'], library['ad_video_names'], library['ft_type'],
+                                library['index'], False, False, library['deduped'], library['fingerprints'])) as pool:
+                results = pool.map(adlookup._find_ads_in_worker, video_filenames)
+        self.assertEqual([detections for detections, _ in results], expected)
+        self.assertEqual([[detection['starting_frame'] for detection in detections] for detections in expected],
+                         [[40], [6]])
+        self.assertTrue(all(worker_metrics.timers for _, worker_metrics in results))
+
+
+class TestDaemon(unittest.TestCase):
+
+    def test_daemon_answers_as_find_ads_and_reloads_library(self):
+        with tempfile.TemporaryDirectory() as folder:
+            folder = Path(folder).resolve()
+            (folder / "ads").mkdir()
+            write_test_video(folder / "ads" / "ad.mp4", 300, seed=1)
+            write_test_video(folder / "video.mp4", 1200, seed=0, splices={600: folder / "ads" / "ad.mp4"})
+            library = adlookup.load_library(str(folder / "ads"), feature_extraction.FeatureType.SOBEL_THRESH_PACKED)
+            expected = adlookup.find_ads(str(folder / "video.mp4"), **library)
+            daemon = adlookupd.DetectionDaemon(str(folder / "ads"), poll_seconds=0.2)
+            socket_path = str(folder / "adlookupd.sock")
+
+            async def reloaded():
+                while daemon.version < 2:
+                    await asyncio.sleep(0.05)
+
+            async def run():
+                server = asyncio.ensure_future(daemon.serve(socket_path))
+                while not Path(socket_path).exists():
+                    await asyncio.sleep(0.1)
+                reader, writer = await asyncio.open_unix_connection(socket_path)
+                writer.write(b'{"video": "%s", "id": 1}\n{"video": "missing.mp4", "id": 2}\n'
+                             % str(folder / "video.mp4").encode())
+                answers = [json.loads(await reader.readline()) for _ in range(2)]
+                writer.close()
+                self.assertEqual(daemon.version, 1)
+                # picked up by the watcher once the folder stays the same for a whole poll
+                write_test_video(folder / "ads" / "other_ad.mp4", 240, seed=2)
+                await asyncio.wait_for(reloaded(), 60)
+                status = await daemon.answer('{"command": "status"}')
+                server.cancel()
+                await asyncio.gather(server, return_exceptions=True)
+                return answers, status
+
+            answers, status = asyncio.run(run())
+        answers = {answer['id']: answer for answer in answers}
+        self.assertIn('error', answers[2])
+        self.assertTrue(expected)
+        self.assertEqual([(detection['ad'], detection['start'], detection['score'])
+                          for detection in answers[1]['detections']],
+                         [(library['ad_video_names'][detection['ad_idx']], detection['starting_second'],
+                           detection['score']) for detection in expected])
+        self.assertEqual((status['library'], status['ads']), (2, ["ad", "other_ad"]))
+
+
+class TestSweep(unittest.TestCase):
+
+    def test_indexed_ground_truth_matches_linear_scan(self):
+        random = numpy.random.RandomState(0)
+
+        def lines(amount):
+            return ["tv{}\t{}\t{}\tad{}".format(random.randint(2), round(random.uniform(0, 300), 1),
+                                                 round(random.uniform(1, 40), 1), random.randint(3))
+                    for _ in range(amount)]
+        detecciones_gt = evaluar.leer_lineas_detecciones(lines(200))
+        indice_gt = evaluar.IndiceGT(detecciones_gt)
+        for det in evaluar.leer_lineas_detecciones(lines(300)):
+            best, best_inter = None, 0
+            for det_gt in detecciones_gt:
+                if det_gt.television == det.television and det_gt.comercial == det.comercial and \
+                        evaluar.interseccion(det, det_gt) > best_inter:
+                    best, best_inter = det_gt, evaluar.interseccion(det, det_gt)
+            self.assertEqual(evaluar.buscar_gt(det, indice_gt), (best, best_inter))
+
+    def test_sliced_knn_detections_match_knn_at_each_k(self):
+        random = numpy.random.RandomState(0)
+        ads = [random.randint(0, 256, (20, 64)), random.randint(0, 256, (30, 64))]
+        # noisy copies of the ads, so smaller K loses some of their frames
+        video = numpy.concatenate((random.randint(0, 256, (40, 64)), ads[0] + random.randint(-60, 60, (20, 64)),
+                                   random.randint(0, 256, (10, 64)), ads[1] + random.randint(-60, 60, (30, 64))))
+        ad_lengths = [20, 30]
+        results = sweep.sweep_detections(video_tools.batch_knn(video, ads, k=5, use_cache=False), ad_lengths,
+                                         [1, 5], [0.1, 0.5])
+        for k in (1, 5):
+            knn = video_tools.batch_knn(video, ads, k=k, use_cache=False)
+            for threshold in (0.1, 0.5):
+                expected = online_detector.temporal_nms(video_tools.detect_ads(
+                    video_tools.knn_hits(knn), len(video), ad_lengths, score_threshold=threshold), ad_lengths)
+                self.assertEqual(results[(k, threshold)][0], expected)
+        self.assertEqual([d['starting_frame'] for d in results[(5, 0.5)][0]], [40, 70])
+
+    def test_airings_of_videos_without_detections_are_missed(self):
+        with tempfile.TemporaryDirectory() as folder, temporary_cache():
+            folder = Path(folder).resolve()
+            (folder / "ads").mkdir()
+            write_test_video(folder / "ads" / "ad.mp4", 300, seed=1)
+            write_test_video(folder / "aired.mp4", 600, seed=0, splices={210: folder / "ads" / "ad.mp4"})
+            # the ground truth lists an airing in this video too, which no configuration can find
+            write_test_video(folder / "missed.mp4", 600, seed=2)
+            detecciones_gt = evaluar.leer_lineas_detecciones(["{}\t7.0\t10.0\tad".format(folder / "aired.mp4"),
+                                                               "{}\t5.0\t10.0\tad".format(folder / "missed.mp4"),
+                                                               "other.mp4\t5.0\t10.0\tad"])
+            rows = sweep.sweep([str(folder / "aired.mp4"), str(folder / "missed.mp4")], str(folder / "ads"), [1, 3],
+                               [0.25], [feature_extraction.FeatureType.SOBEL_THRESH_PACKED], detecciones_gt)
+        for row in rows:
+            self.assertEqual((row['correctas'], row['falsas'], row['relevantes']), (1, 0, 2))
+            self.assertEqual(row['resultado'], 0.5)
+
+
+class TestCacheManager(unittest.TestCase):
+
+    def test_array_digest_covers_whole_array(self):
+        features = numpy.zeros((5000, 1024), dtype=numpy.float32)
+        changed_features = features.copy()
+        changed_features[2500, 512] = 255
+        # str() of both arrays is the same, since numpy summarizes large arrays
+        self.assertEqual(str(features), str(changed_features))
+        self.assertNotEqual(cache_manager.array_digest(features), cache_manager.array_digest(changed_features))
+        self.assertNotEqual(cache_manager.array_digest(features), cache_manager.array_digest(features[:, :512]))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        with temporary_cache() as folder:
+            for name in ("a", "b", "c"):
+                cache_manager.save("test", name, numpy.zeros(1000))
+                time.sleep(0.01)
+            cache_manager.load("test", "a")
+            cache_manager.flush_accesses()
+            entry_bytes = os.path.getsize(str(folder / "test" / "a.npy"))
+            cache_manager.evict(max_bytes=2 * entry_bytes)
+            self.assertIsNotNone(cache_manager.load("test", "a"))
+            self.assertIsNone(cache_manager.load("test", "b"))
+            self.assertIsNotNone(cache_manager.load("test", "c"))
+
+    def test_entries_written_in_a_batch_are_evicted_once_and_kept(self):
+        with temporary_cache() as folder:
+            cache_manager.save("test", "a", numpy.zeros(1000))
+            entry_bytes = os.path.getsize(str(folder / "test" / "a.npy"))
+            with mock.patch.object(cache_manager, 'CACHE_MAX_BYTES', 2.5 * entry_bytes):
+                with cache_manager.batch_writes():
+                    for name in ("b", "c", "d"):
+                        time.sleep(0.01)
+                        cache_manager.save("test", name, numpy.zeros(1000))
+                    self.assertEqual(len(list((folder / "test").iterdir())), 4)
+                self.assertEqual(sorted(path.name for path in (folder / "test").iterdir()),
+                                 ["b.npy", "c.npy", "d.npy"])
+            # the matrix of a library isn't evicted when its tables are written
+            with mock.patch.object(cache_manager, 'CACHE_MAX_BYTES', 1):
+                library = ad_library.AdLibrary.build([numpy.ones((3, 4)), numpy.ones((2, 4))], ["k0", "k1"],
+                                                     ["a", "b"])
+                self.assertIsInstance(library.matrix, numpy.memmap)
+
+    def test_manifest_matches_entries_and_hits_are_written_once(self):
+        with temporary_cache() as folder:
+            cache_manager.save("test", "a", numpy.zeros(10))
+            cache_manager.save_arrays("test", "b", x=numpy.ones(20))
+            (folder / "test" / "b.npz").unlink()
+            manifest_path = folder / cache_manager.MANIFEST_FILENAME
+            saved_manifest = manifest_path.read_text()
+            for _ in range(3):
+                cache_manager.load("test", "a")
+            # hits are kept in memory until the manifest is written
+            self.assertEqual(manifest_path.read_text(), saved_manifest)
+            cache_manager.flush_accesses()
+            manifest = json.loads(manifest_path.read_text())
+            self.assertEqual(list(manifest), ["test/a.npy"])
+            self.assertEqual(manifest["test/a.npy"]['bytes'], os.path.getsize(str(folder / "test" / "a.npy")))
+            self.assertGreater(manifest["test/a.npy"]['last_access'],
+                               json.loads(saved_manifest)["test/a.npy"]['last_access'])
+
+    def test_file_fingerprint_changes_when_file_is_replaced(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = Path(folder) / "video.mp4"
+            path.write_bytes(b"a" * 4096)
+            fingerprint = cache_manager.file_fingerprint(path)
+            modified = os.stat(str(path)).st_mtime_ns
+            # same size and modification time, different content
+            cache_manager.save_atomically(str(path), lambda fp: fp.write(b"b" * 4096))
+            os.utime(str(path), ns=(modified, modified))
+            self.assertNotEqual(cache_manager.file_fingerprint(path), fingerprint)
+            self.assertEqual(cache_manager.file_fingerprint(path), cache_manager.file_fingerprint(path))
+
+
+class TestMetrics(unittest.TestCase):
 
-        starting_frame = detections[1]['starting_frame']
-        for ad_frame_idx, ad_frame in enumerate(ad1):
-            self.assertEqual(video[starting_frame+ad_frame_idx], ad_frame)
+    def test_running_stats_match_numpy(self):
+        values = numpy.random.RandomState(0).rand(10000) * 1000 + 1e6
+        stats, other = metrics.RunningStats(), metrics.RunningStats()
+        for batch in numpy.array_split(values[:7000], 13):
+            stats.update(batch)
+        other.update(values[7000:])
+        stats.merge(other)
+        self.assertEqual(stats.count, values.size)
+        self.assertAlmostEqual(stats.mean, values.mean(), places=6)
+        self.assertAlmostEqual(stats.variance, values.var(), places=6)
+        self.assertEqual((stats.min, stats.max), (values.min(), values.max()))
 
 
 if __name__ == '__main__':